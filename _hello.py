@@ -1,5 +1,62 @@
+from time import perf_counter
+import socket
+
+from hello.metrics import call_name
+
+
 class _BaseHelloApp():
-    pass
 
+    # what a request that ran out of time raises, for the timeout policy
+    _timeout_errors = (socket.timeout,)
+
+    @staticmethod
+    def _idempotent(call):
+        """ Calls that only read (getMainValues, getReport, ...) are
+        safe for the transport to send again if the reply is lost.
+        Anything else might get acted on twice. """
+        return call.startswith('get')
+
+    def _request_started(self, url):
+        """ Start the metrics / timeout policy bookkeeping for one
+        request. Every client's _send_request_raw goes through this
+        and _request_done, so that they all record the same things.
+
+        @return: (call, timeout, start) to hand to _request_done, or
+                 None if there's nothing to record
+        """
+        policy = self.timeouts
+        if self.metrics is None and policy is None:
+            return None
+        call = call_name(url)
+        timeout = None
+        if policy is not None:
+            timeout = policy.timeout_for(call, self._ipv4, self._connection.timeout)
+        return call, timeout, perf_counter()
 
-    
\ No newline at end of file
+    def _request_done(self, started, rsp=None, error=None, stream=False):
+        """
+        @param started: what _request_started returned
+        @param rsp: the response, if there was one
+        @param error: the exception, if the request failed
+        @param stream: rsp's body is still unread. Its size is taken
+                       from Content-Length rather than by reading it.
+        """
+        call, _, start = started
+        elapsed = perf_counter() - start
+        metrics = self.metrics
+        policy = self.timeouts
+        if metrics is not None:
+            nbytes = None
+            if stream and rsp is not None:
+                nbytes = int(rsp.headers.get('Content-Length') or 0)
+            metrics.observe_request(call, self._ipv4, elapsed, rsp, error, nbytes)
+        if policy is not None:
+            if error is not None:
+                if isinstance(error, self._timeout_errors):
+                    policy.observe_timeout(call, self._ipv4)
+            # retried requests include backoff time, don't learn from them
+            elif not getattr(rsp, 'retries', 0):
+                policy.observe(call, self._ipv4, elapsed)
+        if rsp is not None:
+            # so that parse time gets filed under the right call
+            rsp.hello_call = call
@@ -0,0 +1,378 @@
+"""
+Incremental alarm sync across reactors.
+
+getAlarms hands back a reactor's alarm log as one cluster of
+comma-joined columns ("alarmIDs", "type", ...), and asking for all of
+it every time gets slower as the log grows. AlarmSync remembers the
+highest alarm ID it has seen on each reactor, only asks for alarms
+after that, and keeps everything it has fetched in an AlarmStore,
+indexed by reactor and ID, by type and by time:
+
+    sync = AlarmSync(['192.168.1.6', '192.168.1.7'])
+    sync.sync()                     # new alarms, all reactors at once
+    sync.store.unacked()            # fleet wide, from the local store
+    sync.store.by_type('Temperature')
+
+Incremental fetches rely on getAlarms(mode, count, id) returning up to
+`count` alarms starting at ID `id`. A server that ignores the start ID
+hands back the same oldest alarms for every page. When that happens,
+AlarmSync asks for the whole log in one call instead, so it still gets
+the right answer, just without the savings.
+
+getAlarms doesn't say whether an alarm has been acknowledged, only
+getUnAckCount does (as a total). So the store only knows about alarms
+cleared through AlarmSync.
+"""
+from bisect import bisect_left, insort
+import logging
+import threading
+
+from hello.fleet import HelloFleet
+from hello.hello3 import _parse_date
+
+__author__ = 'Nathan Starkweather'
+
+_logger = logging.getLogger(__name__)
+
+
+def _split(s):
+    # an empty column comes through as "None"
+    if not s or s == 'None':
+        return []
+    return s.split(",")
+
+
+def parse_alarms(cluster, reactor=None):
+    """ Turn a getAlarms cluster into Alarms.
+
+    Every string field with one entry per alarm ID is a column. Other
+    fields (totals and such) are left out.
+
+    @param cluster: getAlarms() result
+    @param reactor: reactor to tag the alarms with
+    @rtype: list[Alarm]
+    """
+    ids = _split(cluster.get('alarmIDs', ''))
+    n = len(ids)
+    columns = {}
+    for name, val in cluster.items():
+        if name == 'alarmIDs' or not isinstance(val, str):
+            continue
+        parts = _split(val)
+        if len(parts) == n + 1 and parts[0] == '':
+            # joined onto an empty string
+            parts = parts[1:]
+        if len(parts) == n + 1 and parts[-1] == '':
+            parts = parts[:-1]
+        if len(parts) == n:
+            columns[name] = parts
+    alarms = []
+    for i, id in enumerate(ids):
+        try:
+            id = int(id)
+        except ValueError:
+            _logger.warning("Skipping alarm with bad ID %r from %s", id, reactor)
+            continue
+        alarms.append(Alarm(reactor, id, {name: col[i] for name, col in columns.items()}))
+    return alarms
+
+
+class Alarm():
+    """ One alarm from a reactor's log.
+
+    @ivar fields: the alarm's columns from getAlarms, as strings
+    @ivar acked: cleared through AlarmSync. getAlarms doesn't report
+                 the acknowledged state, so that's all we know.
+    """
+    __slots__ = ('reactor', 'id', 'fields', 'acked', '_time')
+
+    # column names to look in for the time
+    time_fields = ('time', 'date', 'timestamp')
+
+    def __init__(self, reactor, id, fields=None, acked=False):
+        self.reactor = reactor
+        self.id = id
+        self.fields = fields or {}
+        self.acked = acked
+        self._time = False
+
+    @property
+    def type(self):
+        return self.fields.get('type')
+
+    @property
+    def time(self):
+        """ When the alarm went off, or None if the server didn't
+        say in a form we can read. """
+        if self._time is False:
+            self._time = None
+            for name in self.time_fields:
+                s = self.fields.get(name)
+                if s:
+                    try:
+                        self._time = _parse_date(s)
+                    except ValueError:
+                        pass
+                    break
+        return self._time
+
+    @property
+    def key(self):
+        return self.reactor, self.id
+
+    def __repr__(self):
+        return "<%s %s #%d %s%s>" % (self.__class__.__name__, self.reactor, self.id, self.type,
+                                     " acked" if self.acked else "")
+
+
+class AlarmStore():
+    """ Thread safe in-memory index of alarms from any number of
+    reactors, by (reactor, id), by type and by time. """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._alarms = {}     # (reactor, id) -> Alarm
+        self._by_type = {}    # type -> set of keys
+        self._by_time = []    # sorted (timestamp, reactor, id)
+        self._unacked = {}    # reactor -> set of ids
+        self._max_ids = {}    # reactor -> highest id seen
+
+    # ----- updates -----
+
+    def _unindex(self, alarm):
+        key = alarm.key
+        del self._alarms[key]
+        keys = self._by_type.get(alarm.type)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_type[alarm.type]
+        t = alarm.time
+        if t is not None:
+            entry = (t.timestamp(), alarm.reactor, alarm.id)
+            i = bisect_left(self._by_time, entry)
+            if i < len(self._by_time) and self._by_time[i] == entry:
+                del self._by_time[i]
+        self._unacked.get(alarm.reactor, set()).discard(alarm.id)
+
+    def add(self, alarm):
+        """ Add an alarm, or replace the one with the same reactor and
+        ID. A replaced alarm stays acknowledged if it was. """
+        with self._lock:
+            old = self._alarms.get(alarm.key)
+            if old is not None:
+                alarm.acked = alarm.acked or old.acked
+                self._unindex(old)
+            key = alarm.key
+            self._alarms[key] = alarm
+            self._by_type.setdefault(alarm.type, set()).add(key)
+            t = alarm.time
+            if t is not None:
+                insort(self._by_time, (t.timestamp(), alarm.reactor, alarm.id))
+            unacked = self._unacked.setdefault(alarm.reactor, set())
+            if not alarm.acked:
+                unacked.add(alarm.id)
+            if alarm.id > self._max_ids.get(alarm.reactor, 0):
+                self._max_ids[alarm.reactor] = alarm.id
+
+    def replace(self, reactor, alarms):
+        """ Swap the reactor's alarms for `alarms` (a full download).
+        Alarms acknowledged here stay acknowledged. """
+        with self._lock:
+            acked = {a.id for a in self.alarms(reactor) if a.acked}
+            self.drop(reactor)
+            # the watermark stays where it was, even if the newest
+            # alarms were cleared off the server
+            for a in alarms:
+                if a.id in acked:
+                    a.acked = True
+                self.add(a)
+
+    def drop(self, reactor):
+        """ Forget the reactor's alarms, but not its watermark. """
+        with self._lock:
+            for a in self.alarms(reactor):
+                self._unindex(a)
+
+    def acknowledge(self, reactor, ids=None, type=None):
+        """ Mark alarms acknowledged: `ids`, every alarm of `type`, or
+        with neither, all of the reactor's alarms. """
+        with self._lock:
+            if ids is not None:
+                alarms = [self._alarms[(reactor, id)] for id in ids if (reactor, id) in self._alarms]
+            elif type is not None:
+                alarms = self.by_type(type, reactor)
+            else:
+                alarms = self.alarms(reactor)
+            for a in alarms:
+                a.acked = True
+                self._unacked[reactor].discard(a.id)
+
+    # ----- lookups -----
+
+    def max_id(self, reactor):
+        """ Highest alarm ID seen on the reactor, 0 for none """
+        return self._max_ids.get(reactor, 0)
+
+    def reactors(self):
+        with self._lock:
+            return list(self._max_ids)
+
+    def get(self, reactor, id, default=None):
+        return self._alarms.get((reactor, id), default)
+
+    def alarms(self, reactor=None):
+        """ Alarms of one reactor, or all, by reactor and ID """
+        with self._lock:
+            if reactor is None:
+                keys = sorted(self._alarms)
+            else:
+                keys = sorted(k for k in self._alarms if k[0] == reactor)
+            return [self._alarms[k] for k in keys]
+
+    def by_type(self, type, reactor=None):
+        with self._lock:
+            keys = self._by_type.get(type, ())
+            return [self._alarms[k] for k in sorted(keys) if reactor is None or k[0] == reactor]
+
+    def between(self, start, end=None, reactor=None):
+        """ Alarms that went off in [start, end), oldest first. Alarms
+        without a readable time aren't included.
+
+        @type start: datetime.datetime
+        @type end: datetime.datetime | None
+        """
+        lo = (start.timestamp(),)
+        with self._lock:
+            i = bisect_left(self._by_time, lo)
+            hi = None if end is None else bisect_left(self._by_time, (end.timestamp(),))
+            return [self._alarms[(r, id)] for _, r, id in self._by_time[i:hi]
+                    if reactor is None or r == reactor]
+
+    def unacked(self, reactor=None):
+        """ Unacknowledged alarms of one reactor, or all, by reactor and ID """
+        with self._lock:
+            if reactor is not None:
+                return [self._alarms[(reactor, id)] for id in sorted(self._unacked.get(reactor, ()))]
+            return [self._alarms[(r, id)] for r in sorted(self._unacked) for id in sorted(self._unacked[r])]
+
+    def unacked_count(self, reactor):
+        return len(self._unacked.get(reactor, ()))
+
+    def __len__(self):
+        return len(self._alarms)
+
+    def __iter__(self):
+        return iter(self.alarms())
+
+
+class AlarmSync():
+    """ Keeps an AlarmStore up to date with a set of reactors.
+
+    @param reactors: ipv4 strings or HelloApps, or a HelloFleet to use
+    @param store: AlarmStore to fill, or None for a new one
+    @param batch: alarms per getAlarms call
+    @param mode: getAlarms mode for "`batch` alarms starting at an ID"
+    @param deadline: seconds each reactor has per sweep, if the fleet
+                     is ours
+    """
+    def __init__(self, reactors, store=None, batch=100, mode='first', deadline=10):
+        if isinstance(reactors, HelloFleet):
+            self.fleet = reactors
+            self._owns_fleet = False
+        else:
+            self.fleet = HelloFleet(reactors, deadline=deadline)
+            self._owns_fleet = True
+        self.store = store if store is not None else AlarmStore()
+        self.batch = batch
+        self.mode = mode
+
+    def _fetch_after(self, app, reactor, after):
+        alarms = []
+        while True:
+            page = parse_alarms(app.getAlarms(self.mode, self.batch, after + 1), reactor)
+            if len(page) == self.batch and min(a.id for a in page) <= after:
+                # the server ignored the start ID, so paging would never
+                # get past the first page
+                _logger.debug("%s ignores the getAlarms start ID, fetching the whole log", reactor)
+                return alarms + [a for a in self._fetch_all(app, reactor) if a.id > after]
+            page = [a for a in page if a.id > after]
+            alarms.extend(page)
+            if len(page) < self.batch:
+                return alarms
+            after = max(a.id for a in page)
+
+    def _fetch_all(self, app, reactor):
+        """ The whole alarm log, without relying on the start ID: ask
+        for twice as many at a time until the reply comes back short. """
+        n = self.batch
+        while True:
+            n *= 2
+            alarms = parse_alarms(app.getAlarms(self.mode, n, 1), reactor)
+            if len(alarms) < n:
+                return alarms
+
+    def _sync_one(self, app, full=False):
+        """ Runs on the fleet's worker threads.
+        @return: number of alarms fetched
+        """
+        reactor = app.ipv4
+        if full:
+            alarms = self._fetch_after(app, reactor, 0)
+            self.store.replace(reactor, alarms)
+        else:
+            alarms = self._fetch_after(app, reactor, self.store.max_id(reactor))
+            for a in alarms:
+                self.store.add(a)
+        return len(alarms)
+
+    def sync(self, full=False):
+        """ Fetch new alarms from every reactor.
+
+        @param full: download the whole alarm log instead, for
+                     alarms that were cleared elsewhere
+        @return: reactor -> FleetResult, with the number of alarms
+                 fetched as the value
+        @rtype: dict[str, hello.fleet.FleetResult]
+        """
+        return self.fleet.run(self._sync_one, full)
+
+    def unacked(self):
+        """ Alarms on every reactor that haven't been cleared through
+        us. Alarms acknowledged elsewhere (the web UI, another client)
+        can't be told apart; fleet.run('getUnAckCount') has the
+        reactors' own counts.
+
+        @rtype: list[Alarm]
+        """
+        return self.store.unacked()
+
+    # ----- acknowledging -----
+
+    def _app(self, reactor):
+        for r in self.fleet.reactors:
+            if r == reactor or getattr(r, 'ipv4', None) == reactor:
+                return self.fleet.app(r)
+        raise KeyError(reactor)
+
+    def clear(self, reactor, id):
+        """ clearAlarm on the reactor, and mark it acknowledged here """
+        self._app(reactor).clearAlarm(id)
+        self.store.acknowledge(reactor, [id])
+
+    def clear_type(self, reactor, type):
+        self._app(reactor).clearAlarmsByType(type)
+        self.store.acknowledge(reactor, type=type)
+
+    def clear_all(self, reactor):
+        self._app(reactor).clearAllAlarms()
+        self.store.acknowledge(reactor)
+
+    def close(self):
+        if self._owns_fleet:
+            self.fleet.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
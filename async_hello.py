@@ -0,0 +1,434 @@
+"""
+asyncio version of hello3.HelloApp.
+
+Every server call is a coroutine, and all calls made through
+one AsyncHelloApp share a small pool of keep-alive connections
+on the running event loop. This lets one process keep requests
+in flight against many reactors at once without tying up a
+thread per request:
+
+    async def poll(ips):
+        apps = [AsyncHelloApp(ip) for ip in ips]
+        return await asyncio.gather(*(a.gpmv() for a in apps))
+
+Response parsing (HelloXML, BatchListXML) and cookie handling
+are shared with hello3, so results are identical to the
+blocking client.
+"""
+import asyncio
+import io
+import ssl
+from http.client import HTTPException, parse_headers
+from json import loads as json_loads
+from urllib.parse import quote
+
+from hello.hello3 import BaseHelloApp, HelloXML, BatchListXML, HelloError, \
+    ServerCallError, sanitize_url, lowercase_methods, _parse_report_reply
+from hello.metrics import call_name
+
+__author__ = 'Nathan Starkweather'
+
+
+# same "safe" set requests uses when requoting urls, so that
+# query strings built for hello3.HelloApp go out unchanged.
+_url_safe = "!#$%&'()*+,/:;=?@[]~"
+
+
+class AsyncResponse():
+    """ Fully read response. Mimics the parts of the requests
+    response object hello3 relies on (status_code, headers,
+    content, read()).
+    """
+    def __init__(self, status, reason, headers, content):
+        self.status_code = self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+        self.read = io.BytesIO(content).read
+
+
+class AsyncConnectionPool():
+    """ Keep-alive HTTP/1.1 connections to a single host.
+
+    Quacks like hello3.HTTPSSession so that it can be used as
+    BaseHelloApp.ConnectionFactory, except that do_request()
+    is a coroutine. Connections are opened lazily, on the event
+    loop that first uses them.
+    """
+    def __init__(self, host, port=None, timeout=5, max_connections=8, use_ssl=True):
+        if port is None and ':' in host:
+            host, port = host.rsplit(':', 1)
+            port = int(port)
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self._use_ssl = use_ssl
+        self._ssl = ssl._create_unverified_context() if use_ssl else None
+        self._host_header = host if port is None else "%s:%d" % (host, port)
+        self._idle = []
+        self._sem = None
+
+    def connect(self):
+        # connections are opened on demand by do_request()
+        pass
+
+    def close(self):
+        idle = self._idle
+        self._idle = []
+        for _, writer in idle:
+            writer.close()
+
+    async def aclose(self):
+        idle = self._idle
+        self._idle = []
+        for _, writer in idle:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, ssl.SSLError):
+                pass
+
+    async def _open(self):
+        port = self.port or (443 if self._use_ssl else 80)
+        return await asyncio.open_connection(self.host, port, ssl=self._ssl)
+
+    async def _acquire(self):
+        while self._idle:
+            reader, writer = conn = self._idle.pop()
+            if writer.is_closing() or reader.at_eof():
+                writer.close()
+                continue
+            return conn, True
+        return await self._open(), False
+
+    async def do_request(self, meth, url, body=None, headers=None, timeout=None, idempotent=False):
+        """
+        @param idempotent: the request is safe to send twice. Same rule
+                           as Transport.do_request: a request that fails
+                           on a reused connection before it's all sent is
+                           always sent again, one that fails after only
+                           if this is set.
+        """
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.max_connections)
+        async with self._sem:
+            return await asyncio.wait_for(self._request(meth, url, body, headers or {}, idempotent),
+                                          self.timeout if timeout is None else timeout)
+
+    async def _request(self, meth, url, body, headers, idempotent):
+        while True:
+            conn, reused = await self._acquire()
+            sent = False
+            try:
+                await self._send(conn[1], meth, url, body, headers)
+                sent = True
+                rsp, keep_alive = await self._read_response(conn[0], meth)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                conn[1].close()
+                # The server is free to drop an idle keep-alive
+                # connection at any time, so only a failure on a
+                # fresh connection is a real error. Once the request
+                # is out, the server may have acted on it, so it's
+                # only sent again if that's harmless.
+                if reused and (not sent or idempotent):
+                    continue
+                raise
+            except BaseException:
+                conn[1].close()
+                raise
+            if keep_alive:
+                self._idle.append(conn)
+            else:
+                conn[1].close()
+            return rsp
+
+    async def _send(self, writer, meth, url, body, headers):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        lines = ["%s %s HTTP/1.1" % (meth, quote(url, safe=_url_safe)),
+                 "Host: " + self._host_header]
+        if body:
+            lines.append("Content-Length: %d" % len(body))
+        for k, v in headers.items():
+            lines.append("%s: %s" % (k, v))
+        lines.append("\r\n")
+        writer.write("\r\n".join(lines).encode('latin-1') + (body or b""))
+        await writer.drain()
+
+    async def _read_response(self, reader, meth):
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Server closed connection")
+        version, status, *reason = status_line.decode('latin-1').split(None, 2)
+        status = int(status)
+        reason = reason[0].strip() if reason else ""
+
+        buf = []
+        while True:
+            line = await reader.readline()
+            buf.append(line)
+            if line in (b"\r\n", b"\n", b""):
+                break
+        hdrs = parse_headers(io.BytesIO(b"".join(buf)))
+
+        keep_alive = version == "HTTP/1.1" and \
+            (hdrs.get("Connection") or "").lower() != "close"
+        if meth == "HEAD" or status in (204, 304) or 100 <= status < 200:
+            content = b""
+        elif (hdrs.get("Transfer-Encoding") or "").lower() == "chunked":
+            content = await self._read_chunked(reader)
+        elif hdrs.get("Content-Length") is not None:
+            content = await reader.readexactly(int(hdrs["Content-Length"]))
+        else:
+            content = await reader.read()
+            keep_alive = False
+        return AsyncResponse(status, reason, hdrs, content), keep_alive
+
+    async def _read_chunked(self, reader):
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b";", 1)[0], 16)
+            if not size:
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        # trailers
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        return b"".join(chunks)
+
+
+@lowercase_methods
+class AsyncHelloApp(BaseHelloApp):
+    """ Coroutine version of hello3.HelloApp.
+
+    Instances must only be used from a single event loop.
+    """
+    ConnectionFactory = AsyncConnectionPool
+    _timeout_errors = (asyncio.TimeoutError,)
+
+    def __init__(self, ipv4, headers=None, timeout=5, verbose_errors=False, max_connections=8, connect=True):
+        super().__init__(ipv4, headers, timeout, verbose_errors, connect=connect)
+        self._connection.max_connections = max_connections
+        self._user = ""
+        self._password = ""
+
+    async def aclose(self):
+        await self._connection.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+    async def _do_request(self, url, timeout=None):
+        return await self._connection.do_request('GET', url, None, self._request_headers(), timeout,
+                                                 self._idempotent(call_name(url)))
+
+    async def _guarded_request(self, url, timeout=None):
+        breakers = self.breakers
+        if breakers is None:
+            return await self._do_request(url, timeout)
+        breaker = breakers.get(self._ipv4)
+        breaker.before()
+        try:
+            rsp = await self._do_request(url, timeout)
+        except (OSError, HTTPException, asyncio.TimeoutError):
+            breaker.failure()
+            if self.metrics is not None:
+                self.metrics.track_breakers(breakers)
+            raise
+        except BaseException:
+            breaker.abort()
+            raise
+        breaker.success()
+        return rsp
+
+    async def _send_request_raw(self, url):
+        started = self._request_started(url)
+        if started is None:
+            rsp = await self._guarded_request(url)
+        else:
+            try:
+                rsp = await self._guarded_request(url, started[1])
+            except Exception as e:
+                self._request_done(started, error=e)
+                raise
+            self._request_done(started, rsp)
+        self._update_cookie(rsp)
+        return rsp
+
+    async def call(self, call, **kw):
+        args = "&".join("%s=%s" % (k, v) for k, v in kw.items())
+        query = "?call=%s%s%s" % (call, "&" if args else "", args)
+        return await self.send_request(query)
+
+    async def call_validate(self, call, **kw):
+        json = kw.get('json', False)
+        rsp = await self.call(call, **kw)
+        return self._validate_rsp(rsp, json)
+
+    async def send_request(self, query):
+        return await self._send_request_raw(self._urlbase + query)
+
+    def _validate_rsp(self, rsp, json):
+        if json:
+            return self._verify_json(json_loads(rsp.content.decode()))
+        return self._verify_xml(HelloXML(rsp.content))
+
+    async def _get_xml(self, query, cls=HelloXML):
+        rsp = await self.send_request(query)
+        xml = cls(rsp.content)
+        if not xml.result:
+            raise ServerCallError(xml.msg)
+        return xml
+
+    async def _set(self, query):
+        rsp = await self.send_request(query)
+        return self._validate_rsp(rsp, False)
+
+    async def login(self, user='user1', pwd='12345'):
+        query = "?&call=login&val1=%s&val2=%s&json=1" % (user, pwd)
+        rsp = await self.send_request(query)
+        return self._validate_rsp(rsp, True)
+
+    async def logout(self):
+        return await self._set("?&call=logout")
+
+    async def startbatch(self, name):
+        return await self._set("?&call=setStartBatch&val1=%s" % name.replace(" ", "+"))
+
+    async def endbatch(self):
+        rsp = await self.send_request("?&call=setendbatch")
+        xml = HelloXML(rsp.content)
+        if not xml.result:
+            if "no batch currently running" in xml.data.lower():
+                return True
+            return self._verify_xml(xml)
+        return True
+
+    async def getAlarms(self, mode='first', val1='100', val2='1'):
+        query = "?&call=getAlarms&mode=%s&val1=%s&val2=%s" % (mode, val1, val2)
+        return (await self._get_xml(query)).data['Alarms']
+
+    async def getAlarmList(self):
+        return (await self._get_xml("?&call=getAlarmList")).data['cluster']
+
+    async def getUnAckCount(self):
+        return int((await self._get_xml("?&call=getUnAckCount")).data)
+
+    async def runrecipe(self, name):
+        return await self._set("?&call=runRecipe&recipe=%s" % name.replace(" ", "_"))
+
+    async def getReport(self, mode, type, val1, val2='', timeout=120000):
+        url = "/webservice/getReport/?&mode=%s&type=%s&val1=%s&val2=%s&timeout=%s" % \
+                (mode, type, val1, val2, timeout)
+        rsp = await self._send_request_raw(url)
+        return _parse_report_reply(rsp.content)
+
+    async def getfile(self, fname):
+        url = "/webservice/getfile/?&getfile=" + fname
+        rsp = await self._send_request_raw(url)
+        if rsp.status_code != 200:
+            raise self._getfile_error(url, rsp)
+        return rsp.content
+
+    async def getBatches(self):
+        rsp = await self.send_request("?&call=getBatches&loader=Loading+batches...")
+        return self._verify_xml(BatchListXML(rsp.content))
+
+    async def getreport_byname(self, type, name):
+        return await self.getReport('byBatch', type, name)
+
+    async def getdatareport_bybatchid(self, val1):
+        fname = await self.getReport('byBatch', 'process_data', val1)
+        return await self.getfile(fname)
+
+    async def getreport_bydate(self, type, d1, d2):
+        fname = await self.getReport('byDate', type, int(d1.timestamp()), int(d2.timestamp()))
+        return await self.getfile(fname)
+
+    async def getdatareport_bybatchname(self, name):
+        xml = await self.getBatches()
+        try:
+            id = xml.getbatchid(name)
+        except KeyError:
+            raise HelloError("Bad batch name given- batch not found: " + name) from None
+        return await self.getdatareport_bybatchid(id)
+
+    async def set_mode(self, group, mode, val, val2=None):
+        query = "?&call=set&group=%s&mode=%s&val1=%s" % (group, mode, val)
+        if val2 is not None:
+            query += "&val2=%s" % val2
+        return await self._set(query)
+
+    async def setdo(self, mode, n2, o2=None):
+        return await self.set_mode('do', mode, n2, o2)
+
+    async def setph(self, mode, co2, base=None):
+        return await self.set_mode('ph', mode, co2, base)
+
+    async def setmg(self, mode, val):
+        return await self.set_mode('maingas', mode, val)
+
+    async def setag(self, mode, val):
+        return await self.set_mode('agitation', mode, val)
+
+    async def settemp(self, mode, val):
+        return await self.set_mode('temperature', mode, val)
+
+    async def getDORAValues(self):
+        # see hello3.HelloApp.getDORAValues
+        return (await self._get_xml("?&call=getDORAValues")).data[None]
+
+    async def batchrunning(self):
+        return (await self.getDORAValues())['Batch'] != '--'
+
+    async def reciperunning(self):
+        return (await self.getDORAValues())['Sequence'] != 'Idle'
+
+    async def reactorname(self):
+        return (await self.getDORAValues())['Machine Name']
+
+    async def getMainValues(self):
+        rsp = await self.send_request("?&call=getMainValues&json=true")
+        return json_loads(rsp.content.decode('utf-8'))
+
+    gmv = getMainValues
+    gpmv = getMainValues
+
+    async def setconfig(self, group, name, val):
+        name = sanitize_url(name)
+        return await self._set("?&call=setconfig&group=%s&name=%s&val=%s" % (group, name, str(val)))
+
+    async def getVersion(self):
+        return (await self._get_xml("?&call=getVersion")).data['Versions']
+
+    async def getmodelsize(self):
+        return int((await self.getVersion())['Model'][4:])
+
+    async def getConfig(self):
+        xml = await self._get_xml("?&call=getConfig")
+        # see hello3.HelloApp.getConfig
+        try:
+            return xml.data['System_Variables_Mag']
+        except KeyError:
+            return xml.data['System_Variables_Air']
+
+    async def getRecipes(self, loader="Loading+recipes"):
+        return (await self._get_xml("?&call=getRecipes&loader=" + loader)).data.split(",")
+
+    async def getTrendData(self, span, group):
+        query = "?&call=getTrendData&span=%s&group=%s&json=1" % (span, group)
+        rsp = await self.send_request(query)
+        return self._validate_rsp(rsp, True)
+
+    def __repr__(self):
+        h = self._connection.host or ""
+        p = self._connection.port or ""
+        c = ":" if p else ""
+        return "%s(\"%s%s%s\")" % (self.__class__.__name__, h, c, p)
+
+    __str__ = __repr__
@@ -0,0 +1,215 @@
+"""
+Per-reactor catalog of batches, optionally kept on disk.
+
+getBatches always returns every batch the reactor has ever run, and
+reactors collect thousands of them. BatchCatalog keeps the batches
+it has already seen, keyed by ID, and on refresh only parses batches
+newer than the highest ID it knows about (plus any batches that were
+still running last time, since their stop time changes).
+
+By default the catalog only lives as long as the app. Give it a file
+(or persist=True for one per reactor under `default_folder`) to keep
+it between sessions:
+
+    catalog = app.batch_catalog(persist=True)
+    catalog.getbatchid("pid #3")
+    catalog[12].start_time
+"""
+import json
+import logging
+import os
+import re
+import threading
+
+from hello.hello3 import BatchEntry
+
+__author__ = 'Nathan Starkweather'
+
+_logger = logging.getLogger(__name__)
+
+default_folder = os.path.join(os.path.expanduser("~"), ".hello", "batches")
+
+_FORMAT_VERSION = 1
+
+
+def _default_path(reactor):
+    return os.path.join(default_folder, re.sub(r"[^\w.-]", "_", str(reactor)) + ".json")
+
+
+class BatchCatalog():
+    """ Batches of one reactor by ID and by name, backed by a json file.
+
+    Has the same lookup interface as BatchListXML (get, getbatchid,
+    getbatchname, names_to_batches, ids_to_batches, iteration), so it
+    can stand in for a getBatches() result.
+
+    @param app: hello3.HelloApp for the reactor
+    @param path: catalog file, or None
+    @param persist: with no path, keep the catalog in a file per
+                    reactor address under `default_folder`. Otherwise
+                    it's only kept in memory. None of the catalog's
+                    functionality depends on the file being writable.
+    """
+    def __init__(self, app, path=None, persist=False):
+        self.app = app
+        if path is None and persist:
+            path = _default_path(app.ipv4)
+        self.path = path
+        self._lock = threading.RLock()
+        self._clear()
+        self.load()
+
+    def _clear(self):
+        self.ids_to_batches = {}
+        self.names_to_batches = {}
+        self._lower_names = {}
+        self.max_id = 0
+
+    def _add(self, b):
+        self.ids_to_batches[b.id] = b
+        # many batches can share a name; the newest (highest ID) wins
+        for names, key in ((self.names_to_batches, b.name), (self._lower_names, b.name.lower())):
+            old = names.get(key)
+            if old is None or old.id <= b.id:
+                names[key] = b
+        if b.id > self.max_id:
+            self.max_id = b.id
+
+    def _reindex(self):
+        batches = sorted(self.ids_to_batches.values(), key=lambda b: b.id)
+        self._clear()
+        for b in batches:
+            self._add(b)
+
+    # ----- persistence -----
+
+    def load(self):
+        """ Read the catalog file, if there is one. A missing or
+        unreadable file just means starting from scratch. """
+        if self.path is None:
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            _logger.warning("Ignoring unreadable batch catalog %s: %s", self.path, e)
+            return
+        if data.get('version') != _FORMAT_VERSION:
+            return
+        with self._lock:
+            self._clear()
+            for row in data['batches']:
+                self._add(BatchEntry(*row))
+
+    def save(self):
+        """ Write the catalog file (atomically, via a temp file), if
+        it has one. """
+        if self.path is None:
+            return
+        with self._lock:
+            data = {
+                'version': _FORMAT_VERSION,
+                'reactor': self.app.ipv4,
+                'batches': [self.ids_to_batches[id].astuple() for id in sorted(self.ids_to_batches)],
+            }
+        tmp = self.path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(data, f, separators=(',', ':'))
+            os.replace(tmp, self.path)
+        except OSError as e:
+            _logger.warning("Couldn't save batch catalog %s: %s", self.path, e)
+
+    # ----- refresh -----
+
+    def refresh(self):
+        """ Bring the catalog up to date with the reactor.
+
+        Only batches newer than max_id, batches that were still running,
+        and the newest known batch are parsed. The last one is a check
+        that this is still the same reactor with the same history: if it
+        changed (or vanished), the catalog is rebuilt from a full parse.
+
+        @return: number of batches added or updated
+        """
+        with self._lock:
+            if not self.ids_to_batches:
+                return self._rebuild()
+            check = self.ids_to_batches[self.max_id]
+            reparse = [b.id for b in self.ids_to_batches.values() if b.running]
+            reparse.append(check.id)
+            xml = self.app.getBatchesAfter(self.max_id, reparse)
+
+            fresh = xml.ids_to_batches
+            now = fresh.get(check.id)
+            if now is None or (now.name, now.start_str) != (check.name, check.start_str):
+                _logger.info("Batch list of %s changed underneath catalog, rebuilding", self.app.ipv4)
+                return self._rebuild()
+
+            changed = 0
+            for id, b in fresh.items():
+                old = self.ids_to_batches.get(id)
+                if old is None or old.astuple() != b.astuple():
+                    changed += 1
+                self.ids_to_batches[id] = b
+            # batches that were running and are now gone were deleted
+            for id in reparse:
+                if id not in fresh:
+                    del self.ids_to_batches[id]
+                    changed += 1
+            if changed:
+                self._reindex()
+                self.save()
+            return changed
+
+    def _rebuild(self):
+        xml = self.app.getBatchesAfter(None)
+        self._clear()
+        for id in sorted(xml.ids_to_batches):
+            self._add(xml.ids_to_batches[id])
+        self.save()
+        return len(self.ids_to_batches)
+
+    # ----- lookup, same as BatchListXML -----
+
+    def get(self, key):
+        """ Batch by name, or by ID """
+        try:
+            return self.names_to_batches[key]
+        except KeyError:
+            pass
+        try:
+            return self.ids_to_batches[key]
+        except KeyError:
+            pass
+        raise KeyError(key)
+
+    __getitem__ = get
+
+    def getbatchid(self, name):
+        try:
+            return self.names_to_batches[name].id
+        except KeyError:
+            return self._lower_names[name.lower()].id
+
+    def getbatchname(self, id):
+        return self.ids_to_batches[id].name
+
+    def getbatches(self):
+        return [self.ids_to_batches[id] for id in sorted(self.ids_to_batches)]
+
+    def __iter__(self):
+        return iter(self.getbatches())
+
+    def __len__(self):
+        return len(self.ids_to_batches)
+
+    def __contains__(self, key):
+        return key in self.names_to_batches or key in self.ids_to_batches
+
+    def __repr__(self):
+        return "<%s %s: %d batches, max id %s>" % (self.__class__.__name__, self.app.ipv4,
+                                                   len(self), self.max_id)
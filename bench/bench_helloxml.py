@@ -0,0 +1,84 @@
+"""
+Time HelloXML and BatchListXML on large synthetic getConfig and
+getBatches replies, split into building the ElementTree (C) and
+walking it into dicts (python).
+
+    python -m hello.bench.bench_helloxml [ngroups] [nbatches]
+
+Reports time per parse and peak memory allocated during one parse.
+"""
+import sys
+import tracemalloc
+from timeit import repeat
+
+from hello.hello3 import HelloXML, BatchListXML, parse_xml
+
+__author__ = 'Nathan Starkweather'
+
+_head = '<?xml version="1.0" encoding="windows-1252" standalone="no" ?>'
+
+
+def _scalar(typ, name, val):
+    return "<%s>\n<Name>%s</Name>\n<Val>%s</Val>\n</%s>\n" % (typ, name, val, typ)
+
+
+def make_config_xml(ngroups=40, nvars=60):
+    """ getConfig sized reply: ngroups clusters of nvars mixed scalars """
+    b = [_head, "<Reply><Result>True</Result><Message>",
+         "<Cluster>\n<Name>System_Variables_Mag</Name>\n<NumElts>%d</NumElts>\n" % ngroups]
+    for g in range(ngroups):
+        b.append("<Cluster>\n<Name>Group %d</Name>\n<NumElts>%d</NumElts>\n" % (g, nvars))
+        for v in range(nvars):
+            name = "Var %d (%%)" % v
+            if v % 3 == 0:
+                b.append(_scalar("DBL", name, "%.5f" % (v * 1.5)))
+            elif v % 3 == 1:
+                b.append(_scalar("U16", name, v))
+            else:
+                b.append(_scalar("String", name, "value %d" % v))
+        b.append("</Cluster>\n")
+    b.append("</Cluster>\n</Message></Reply>")
+    return "".join(b).encode('windows-1252')
+
+
+def make_batches_xml(nbatches=3000):
+    """ getBatches sized reply with nbatches batch clusters """
+    b = [_head, "<Reply><Result>True</Result><Message>",
+         "<Array>\n<Name>Batches (cluster)</Name>\n<Dimsize>%d</Dimsize>\n" % nbatches]
+    for i in range(1, nbatches + 1):
+        b.append("<Cluster>\n<Name>Batch</Name>\n<NumElts>8</NumElts>\n")
+        b.append(_scalar("I32", "ID", i))
+        b.append(_scalar("String", "Name", "batch%d" % i))
+        b.append(_scalar("String", "Serial Number", "SN%05d" % i))
+        b.append(_scalar("String", "User", "user1"))
+        b.append(_scalar("String", "Start Time", "10:00:00 AM\n 01/%02d/2016" % (i % 28 + 1)))
+        b.append(_scalar("String", "Stop Time", "11:00:00 AM\n 01/%02d/2016" % (i % 28 + 1)))
+        b.append(_scalar("String", "Product Number", "P%d" % i))
+        b.append(_scalar("String", "Rev", "A"))
+        b.append("</Cluster>\n")
+    b.append("</Array>\n</Message></Reply>")
+    return "".join(b).encode('windows-1252')
+
+
+def bench(name, cls, xml, number=5):
+    print("%s (%d kB)" % (name, len(xml) // 1024))
+    times = {}
+    for label, func in (("tree", parse_xml), ("total", cls)):
+        t = min(repeat(lambda: func(xml), number=number, repeat=3)) / number
+        times[label] = t
+
+        tracemalloc.start()
+        func(xml)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print("    %-6s %8.2f ms  %8.2f MB peak" % (label, t * 1000, peak / 1e6))
+    print("    walk   %8.2f ms" % ((times['total'] - times['tree']) * 1000))
+
+
+def main(ngroups=40, nbatches=3000):
+    bench("getConfig", HelloXML, make_config_xml(ngroups))
+    bench("getBatches", BatchListXML, make_batches_xml(nbatches))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,111 @@
+"""
+Import time of the hello modules, against per-module budgets.
+
+    python -m hello.bench.bench_import [runs]
+
+Each module is imported in a fresh interpreter with -X importtime,
+best of `runs` (default 5). Reports the module's cumulative import
+time (itself and everything it pulled in), the part of that beyond
+the stdlib modules any http client needs (`baseline`, measured the
+same way), and the time spent in hello's own modules.
+
+Budgets are for the time beyond the baseline, so that they mean about
+the same thing on a fast and a slow machine. They're generous on
+purpose: they're there to catch someone adding a module level
+`import requests`, not 10% regressions.
+
+Exits with status 1 if a module goes over its budget, or if importing
+it loads one of the optional heavy dependencies (requests, lxml,
+numpy, ...), which should only load when something actually uses them.
+"""
+import subprocess
+import sys
+
+__author__ = 'Nathan Starkweather'
+
+baseline = "http.client, ssl, json, logging, socket, threading, xml.etree.ElementTree"
+
+# module -> budget for import time beyond the baseline, ms
+budgets = {
+    'hello.transport': 20,
+    'hello.hello': 40,
+    'hello.hello3': 50,
+    'hello.async_hello': 100,
+    'hello.fleet': 80,
+    'hello.alarms': 80,
+    'hello.batch_catalog': 80,
+    'hello.report_export': 80,
+    'hello.hello_logger': 80,
+    'hello.lv_parse': 20,
+    'hello.pid.lvpid': 20,
+    'hello.pid.do_simulation.do_sim': 40,
+}
+
+# must not be imported by any of the above
+heavy = ('requests', 'urllib3', 'lxml', 'numpy', 'clipboard', 'pysrc', 'matplotlib',
+         'tkinter', 'peakutils')
+
+_probe = "import sys, %s; print(' '.join(m for m in %r if m in sys.modules))"
+
+
+def measure(modules):
+    """
+    @param modules: comma separated, as for an import statement
+    @return: (cumulative us, us spent in hello's own modules,
+              heavy modules that were loaded)
+    """
+    p = subprocess.run([sys.executable, '-X', 'importtime', '-c', _probe % (modules, heavy)],
+                       stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if p.returncode:
+        raise ImportError("importing %s failed:\n%s" % (modules, p.stderr.strip().splitlines()[-1]))
+    names = {m.strip() for m in modules.split(",")}
+    total = own = 0
+    for line in p.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_us, cumulative, name = line[len("import time:"):].split("|")
+        name = name.strip()
+        if not self_us.strip().isdigit():
+            continue  # header
+        if name in names:
+            # a top level import, one of the ones asked for
+            total += int(cumulative)
+        if name == 'hello' or name.startswith('hello.'):
+            own += int(self_us)
+    return total, own, p.stdout.split()
+
+
+def _best(modules, runs):
+    results = [measure(modules) for _ in range(runs)]
+    total = min(r[0] for r in results) / 1000
+    own = min(r[1] for r in results) / 1000
+    return total, own, results[0][2]
+
+
+def main(runs=5):
+    base = _best(baseline, runs)[0]
+    print("baseline (%s): %.1f ms\n" % (baseline, base))
+    print("%-34s %9s %9s %9s %9s" % ("module", "total ms", "extra ms", "hello ms", "budget"))
+    failed = []
+    for module, budget in budgets.items():
+        try:
+            total, own, loaded = _best(module, runs)
+        except ImportError as e:
+            print("%-34s %s" % (module, e))
+            failed.append(module)
+            continue
+        extra = max(total - base, 0)
+        flag = ""
+        if extra > budget:
+            flag = "  OVER BUDGET"
+            failed.append(module)
+        if loaded:
+            flag += "  loads " + ", ".join(loaded)
+            failed.append(module)
+        print("%-34s %9.1f %9.1f %9.1f %9d%s" % (module, total, extra, own, budget, flag))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
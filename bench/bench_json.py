@@ -0,0 +1,61 @@
+"""
+HelloJSONEncoder with and without its fast path, on getTrendData
+replies for each span and on getMainValues.
+
+    python -m hello.bench.bench_json [trend_interval] [max_span]
+
+Trend replies are made up to ReactorSim's layout (a time column of
+ints, floats for each series) at `trend_interval` seconds per point,
+for spans up to `max_span` seconds. Both modes must give the same
+text; the script checks that before timing anything. The stdlib's C
+encoder is timed too, for reference only: its output differs (repr
+floats, true/false).
+"""
+from json import dumps
+from timeit import repeat
+import random
+import sys
+
+from hello.mock.sim import ReactorSim, spans, trend_series
+from hello.mock.util import HelloJSONEncoder
+
+__author__ = 'Nathan Starkweather'
+
+
+def make_trend(group, seconds, trend_interval=5):
+    rng = random.Random(seconds)
+    n = seconds // trend_interval + 1
+    start = 1.5e9
+    out = {'time': [int((start + i * trend_interval) * 1000) for i in range(n)]}
+    for s in trend_series[group]:
+        if s == 'sp':
+            out[s] = [50.0] * n
+        else:
+            out[s] = [rng.uniform(0, 100) for _ in range(n)]
+    return out
+
+
+def bench(label, obj, number):
+    fast = HelloJSONEncoder(indent="\t", ensure_ascii=False)
+    slow = HelloJSONEncoder(indent="\t", ensure_ascii=False, fast=False)
+    text = slow.encode(obj)
+    assert fast.encode(obj) == text, "%s: output differs" % label
+    times = []
+    for func in (slow.encode, fast.encode, lambda o: dumps(o, indent="\t", ensure_ascii=False)):
+        times.append(min(repeat(lambda: func(obj), number=number, repeat=3)) / number)
+    print("    %-12s %9.1f kB %10.2f %10.2f %10.2f %8.1fx" % (
+        label, len(text) / 1024, times[0] * 1e3, times[1] * 1e3, times[2] * 1e3, times[0] / times[1]))
+
+
+def main(trend_interval=5, max_span=7 * 24 * 3600):
+    print("    %-12s %12s %10s %10s %10s %9s" % ("reply", "size", "slow ms", "fast ms", "C ms", "speedup"))
+    sim = ReactorSim()
+    bench("mainvalues", sim.main_values(), 200)
+    for name, seconds in sorted(spans.items(), key=lambda kv: kv[1]):
+        if seconds <= max_span:
+            obj = make_trend('do', seconds, trend_interval)
+            bench("trend " + name, obj, max(1, 200000 // len(obj['time'])))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
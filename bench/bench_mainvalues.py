@@ -0,0 +1,77 @@
+"""
+Compare keeping a history of getMainValues replies as the nested dicts
+getMainValues returns, and as mainvalues.MainValues snapshots.
+
+    python -m hello.bench.bench_mainvalues [nsamples]
+
+Replies are synthetic, shaped like a reactor's. Reports memory held
+per retained sample, decode time, and the time to pull the logger's
+whitelist (hello_logger._gmv_keys) out of every sample.
+"""
+from json import loads as json_loads, dumps as json_dumps
+from timeit import repeat
+import random
+import sys
+import tracemalloc
+
+from hello.mainvalues import MainValues
+
+__author__ = 'Nathan Starkweather'
+
+_groups = {
+    'temperature': ('output', 'man', 'interlocked', 'pv', 'sp', 'error', 'mode'),
+    'agitation': ('output', 'man', 'interlocked', 'pv', 'sp', 'error', 'mode'),
+    'ph': ('manUp', 'outputDown', 'error', 'pv', 'sp', 'manDown', 'outputUp', 'mode', 'interlocked'),
+    'do': ('manUp', 'outputDown', 'error', 'pv', 'sp', 'manDown', 'outputUp', 'mode', 'interlocked'),
+    'maingas': ('error', 'man', 'mode', 'pv', 'interlocked'),
+    'MFCs': ('air', 'n2', 'o2', 'co2'),
+    'condenser': ('output', 'man', 'pv', 'sp', 'error', 'mode'),
+    'pressure': ('error', 'pv'),
+    'level': ('error', 'pv'),
+    'secondaryheat': ('output', 'man', 'pv', 'sp', 'error', 'mode'),
+}
+
+# same list as hello_logger, which needs clipboard to import
+_keys = [g + "." + k for g in ('temperature', 'agitation', 'ph', 'do') for k in _groups[g]] + \
+        ['maingas.' + k for k in _groups['maingas']] + \
+        ['MFCs.' + k for k in _groups['MFCs']] + \
+        ['condenser.' + k for k in _groups['condenser']] + \
+        ['pressure.error', 'pressure.pv', 'level.error', 'level.pv']
+
+
+def make_reply():
+    d = {}
+    for group, names in _groups.items():
+        g = d[group] = {}
+        for name in names:
+            if name in ('mode', 'error', 'interlocked'):
+                g[name] = random.randint(0, 2)
+            else:
+                g[name] = round(random.uniform(0, 100), 2)
+    return json_dumps(d).encode()
+
+
+def dict_query(mv, keys):
+    return [mv[k1][k2] for k1, k2 in keys]
+
+
+def main(nsamples=10000):
+    replies = [make_reply() for _ in range(nsamples)]
+    split_keys = [k.split(".") for k in _keys]
+    print("%d samples, %d values each, %d logged" % (nsamples, sum(map(len, _groups.values())), len(_keys)))
+    for name, decode, query, keys in (
+            ("dicts", lambda r: json_loads(r.decode('utf-8')), dict_query, split_keys),
+            ("MainValues", MainValues.decode, MainValues.tolist, _keys)):
+        t = min(repeat(lambda: [decode(r) for r in replies], number=1, repeat=3))
+        tracemalloc.start()
+        held = [decode(r) for r in replies]
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        q = min(repeat(lambda: [query(mv, keys) for mv in held], number=1, repeat=3))
+        del held
+        print("    %-12s %6d B/sample  decode %6.1f us  query %6.1f us" %
+              (name, size / nsamples, t / nsamples * 1e6, q / nsamples * 1e6))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
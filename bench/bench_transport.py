@@ -0,0 +1,95 @@
+"""
+Requests/sec through hello.transport.Transport against a local
+stand-in server, compared with opening a new connection for every
+request.
+
+    python -m hello.bench.bench_transport [nrequests] [nthreads] [delay_ms]
+
+delay_ms is how long the stand-in server sleeps per request, to
+mimic a reactor that takes a while to answer (that's where more
+than one pooled connection pays off).
+"""
+from http.client import HTTPConnection
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, sleep
+import sys
+import threading
+
+from hello.transport import Transport
+
+__author__ = 'Nathan Starkweather'
+
+_body = (b'<?xml version="1.0" encoding="windows-1252" standalone="no" ?>'
+         b'<Reply><Result>True</Result><Message>True</Message></Reply>')
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in separate writes
+    disable_nagle_algorithm = True
+    delay = 0
+
+    def do_GET(self):
+        if self.delay:
+            sleep(self.delay)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml")
+        self.send_header("Content-Length", str(len(_body)))
+        self.end_headers()
+        self.wfile.write(_body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(delay=0):
+    handler = type("Handler", (_Handler,), {'delay': delay})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+_url = "/webservice/interface/?&call=getUnAckCount"
+
+
+def fresh_connection(port):
+    conn = HTTPConnection("127.0.0.1", port, timeout=5)
+    conn.request("GET", _url)
+    conn.getresponse().read()
+    conn.close()
+
+
+def run(name, fn, n, nthreads):
+    t = perf_counter()
+    if nthreads == 1:
+        for _ in range(n):
+            fn()
+    else:
+        with ThreadPoolExecutor(nthreads) as pool:
+            for f in [pool.submit(fn) for _ in range(n)]:
+                f.result()
+    t = perf_counter() - t
+    print("    %-36s %8.0f req/s" % (name, n / t))
+
+
+def main(n=2000, nthreads=4, delay_ms=0):
+    server = start_server(delay_ms / 1000)
+    port = server.server_address[1]
+    print("%d requests, server delay %d ms" % (n, delay_ms))
+
+    run("new connection per request", lambda: fresh_connection(port), n, 1)
+    t = Transport("127.0.0.1", port, use_ssl=False, pool_size=1)
+    run("Transport, 1 connection", lambda: t.do_request("GET", _url), n, 1)
+    print("        %s" % t.stats())
+
+    run("new connection per request, %d threads" % nthreads, lambda: fresh_connection(port), n, nthreads)
+    t = Transport("127.0.0.1", port, use_ssl=False, pool_size=nthreads)
+    run("Transport, pool of %d" % nthreads, lambda: t.do_request("GET", _url), n, nthreads)
+    print("        %s" % t.stats())
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
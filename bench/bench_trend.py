@@ -0,0 +1,62 @@
+"""
+Compare getTrendData decoding: json_loads to python lists (what
+getTrendData returns by default), and the same followed by
+hello.trend.trend_arrays (as_arrays=True).
+
+    python -m hello.bench.bench_trend [npoints]
+
+Payloads are synthetic "7day" replies for the four trend groups, a
+time column plus one array per series. Reports the time to decode
+all four, and peak memory while holding the results.
+"""
+from json import loads as json_loads, dumps as json_dumps
+from timeit import repeat
+import random
+import sys
+import tracemalloc
+
+from hello.trend import trend_arrays
+
+__author__ = 'Nathan Starkweather'
+
+_groups = {
+    'agitation': ('pv', 'sp', 'output'),
+    'ph': ('pv', 'sp', 'co2', 'base'),
+    'do': ('pv', 'sp', 'n2', 'o2'),
+    'temperature': ('pv', 'sp', 'output'),
+}
+
+
+def make_reply(group, npoints):
+    t0 = 1600000000000
+    d = {'time': [t0 + 5000 * i for i in range(npoints)]}
+    for name in _groups[group]:
+        d[name] = [round(random.uniform(0, 100), 3) for _ in range(npoints)]
+    return json_dumps(d).encode()
+
+
+def json_lists(raw):
+    return json_loads(raw.decode('utf-8'))
+
+
+def json_then_numpy(raw):
+    return trend_arrays(json_loads(raw.decode('utf-8')))
+
+
+def main(npoints=120960):
+    replies = [make_reply(g, npoints) for g in _groups]
+    size = sum(map(len, replies))
+    print("7day x %d groups, %d points/series (%.1f MB)" % (len(replies), npoints, size / 1e6))
+    for name, fn in (("json -> lists", json_lists),
+                     ("json -> lists -> numpy", json_then_numpy)):
+        t = min(repeat(lambda: [fn(r) for r in replies], number=1, repeat=3))
+        tracemalloc.start()
+        result = [fn(r) for r in replies]
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del result
+        print("    %-24s %8.1f ms  %8.1f MB peak" % (name, t * 1000, peak / 1e6))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,125 @@
+"""
+How the virtual fleet mock server (mock/vfleet.py) scales with the
+number of reactors.
+
+    python -m hello.bench.bench_vfleet [seconds] [max_n]
+
+First the simulation alone: cost of one simulated second of the whole
+fleet, FleetSim's vectorized step against stepping one ReactorSim per
+reactor.
+
+Then serving: a VirtualFleet of N reactors runs in a child process and
+is polled with HelloFleet getMainValues sweeps for `seconds`. Reports
+the client's requests/sec and cpu, and the server process's cpu, both
+as a fraction of one core.
+"""
+from subprocess import Popen, PIPE
+from time import perf_counter, process_time
+import functools
+import sys
+
+from hello import hello3
+from hello.fleet import HelloFleet
+from hello.mock.sim import ReactorSim
+from hello.mock.vfleet import FleetSim
+from hello.transport import Transport
+
+__author__ = 'Nathan Starkweather'
+
+sizes = (1, 10, 50, 100, 200, 500)
+
+
+class _Clock():
+    def __init__(self):
+        self.t = 0.0
+
+    def __call__(self):
+        return self.t
+
+
+def sim_cost(n, steps=600):
+    """ @return: (FleetSim, ReactorSims) us per simulated second """
+    clock = _Clock()
+    fleet = FleetSim(n, clock=clock)
+    clock.t = steps
+    start = perf_counter()
+    fleet.advance()
+    vec = (perf_counter() - start) / steps
+
+    # one ReactorSim is enough, they all cost the same
+    clock = _Clock()
+    sim = ReactorSim(clock=clock)
+    clock.t = steps
+    start = perf_counter()
+    sim.advance()
+    one = (perf_counter() - start) / steps
+    return vec * 1e6, one * n * 1e6
+
+
+class ServerProcess():
+    """ python -m hello.mock.vfleet --control, in a child process """
+    def __init__(self, n, speed=1):
+        self.p = Popen([sys.executable, '-m', 'hello.mock.vfleet', '-n', str(n), '--port', '0',
+                        '--speed', str(speed), '--control'],
+                       stdin=PIPE, stdout=PIPE, universal_newlines=True)
+        self.addresses = []
+        for line in self.p.stdout:
+            line = line.strip()
+            if not line:
+                break
+            self.addresses.append(line)
+        if len(self.addresses) != n:
+            self.close()
+            raise RuntimeError("server process didn't start")
+
+    def cpu(self):
+        self.p.stdin.write("cpu\n")
+        self.p.stdin.flush()
+        return float(self.p.stdout.readline())
+
+    def close(self):
+        self.p.stdin.close()
+        self.p.wait()
+
+
+def serve(n, seconds):
+    """ @return: (requests/sec, client cpu, server cpu, failed requests) """
+    server = ServerProcess(n)
+    try:
+        with HelloFleet(server.addresses, max_workers=32) as fleet:
+            fleet.run('getMainValues')  # connect
+            requests = failed = 0
+            server_cpu = server.cpu()
+            client_cpu = process_time()
+            start = perf_counter()
+            while perf_counter() - start < seconds:
+                for r in fleet.run('getMainValues').values():
+                    requests += 1
+                    failed += not r.ok
+            elapsed = perf_counter() - start
+            client_cpu = (process_time() - client_cpu) / elapsed
+            server_cpu = (server.cpu() - server_cpu) / elapsed
+    finally:
+        server.close()
+    return requests / elapsed, client_cpu, server_cpu, failed
+
+
+def main(seconds=5, max_n=500):
+    # the mock server speaks plain http
+    hello3.HelloApp.ConnectionFactory = functools.partial(Transport, use_ssl=False)
+    print("simulation, us per simulated second")
+    print("    %6s %12s %12s" % ("n", "FleetSim", "ReactorSims"))
+    for n in sizes:
+        if n <= max_n:
+            print("    %6d %12.1f %12.1f" % ((n,) + sim_cost(n)))
+
+    print("\nserving getMainValues, %ds per size" % seconds)
+    print("    %6s %10s %11s %11s %7s" % ("n", "req/s", "client cpu", "server cpu", "failed"))
+    for n in sizes:
+        if 1 < n <= max_n:
+            rate, client, server, failed = serve(n, seconds)
+            print("    %6d %10.0f %10.0f%% %10.0f%% %7d" % (n, rate, client * 100, server * 100, failed))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,65 @@
+"""
+HelloXMLGenerator's direct writer against building the element tree
+and dumping it, on the replies the mock server makes most of.
+
+    python -m hello.bench.bench_xmlgen [ngroups] [nvars]
+
+getConfig and getDORAValues are the simulated reactor's own; "large
+config" is a synthetic getConfig of ngroups clusters of nvars mixed
+scalars, like bench_helloxml's. Both paths must give the same bytes;
+the script checks that before timing anything.
+"""
+from timeit import repeat
+import sys
+
+from hello.mock.sim import ReactorSim
+from hello.mock.util import xml_generator, simple_xml_dump
+
+__author__ = 'Nathan Starkweather'
+
+
+def make_config(ngroups=40, nvars=60):
+    cfg = {}
+    for g in range(ngroups):
+        group = cfg["Group %d" % g] = {}
+        for v in range(nvars):
+            name = "Var %d (%%)" % v
+            if v % 3 == 0:
+                group[name] = v * 1.5
+            elif v % 3 == 1:
+                group[name] = v
+            else:
+                group[name] = "value %d" % v
+    return cfg
+
+
+def tree(msg, name):
+    return simple_xml_dump(xml_generator.hello_tree_from_msg(msg, name))
+
+
+def direct(msg, name):
+    return xml_generator.create_hello_xml(msg, name)
+
+
+def bench(label, msg, name, number=20):
+    xml = tree(msg, name)
+    assert direct(msg, name) == xml, "%s: output differs" % label
+    print("%s (%.1f kB)" % (label, len(xml) / 1024))
+    times = {}
+    for func in (tree, direct):
+        t = min(repeat(lambda: func(msg, name), number=number, repeat=5)) / number
+        times[func.__name__] = t
+        print("    %-6s %9.1f us  %7.1f MB/s" % (func.__name__, t * 1e6, len(xml) / t / 1e6))
+    print("    direct is %.1fx faster" % (times['tree'] / times['direct']))
+
+
+def main(ngroups=40, nvars=60):
+    sim = ReactorSim()
+    bench("getConfig", sim.config, 'System_Variables_Mag')
+    bench("getDORAValues", sim.dora_values(), None)
+    bench("mainvalues as xml", sim.main_values(), 'Main Values')
+    bench("large config", make_config(ngroups, nvars), 'System_Variables_Mag', 5)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
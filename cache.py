@@ -0,0 +1,204 @@
+"""
+Response caching for read-mostly HelloApp calls.
+
+See HelloApp.enable_cache().
+"""
+from collections import OrderedDict
+from hashlib import sha1
+from time import monotonic
+import threading
+
+__author__ = 'Nathan Starkweather'
+
+
+class ResponseCache():
+    """ TTL cache of HelloApp call results, plus a small table of
+    parsed replies keyed by a hash of the raw reply bytes.
+
+    The second table means that when a TTL runs out and the call
+    is made again, an unchanged reply skips the (expensive) XML
+    parse and hands back the previously parsed object.
+
+    Cached values are shared between callers: don't modify them.
+    """
+
+    default_ttls = {
+        'getConfig': 30,
+        'getVersion': 300,
+        'getRecipes': 60,
+        'getBatches': 30,
+        'getmodelsize': 300,
+        'reactorname': 300,
+    }
+
+    def __init__(self, ttls=None, max_parsed=16):
+        """
+        @param ttls: call name -> seconds, merged over default_ttls.
+                     A ttl of 0 disables caching the result, but
+                     identical replies still skip re-parsing.
+        @param max_parsed: how many parsed replies to remember
+        """
+        self.ttls = self.default_ttls.copy()
+        self.ttls.update(ttls or {})
+        self.max_parsed = max_parsed
+        self._entries = {}
+        self._parsed = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.parse_skips = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """
+        @param key: (call name, *args)
+        @return: (True, value) on a hit, (False, None) on a miss
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > monotonic():
+                self.hits += 1
+                return True, entry[1]
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value):
+        ttl = self.ttls.get(key[0], 0)
+        if ttl > 0:
+            with self._lock:
+                self._entries[key] = (monotonic() + ttl, value)
+
+    def invalidate(self, *calls):
+        """ Drop cached results for the given call names,
+        or everything if none are given. """
+        with self._lock:
+            self.invalidations += 1
+            if not calls:
+                self._entries.clear()
+                return
+            for key in [k for k in self._entries if k[0] in calls]:
+                del self._entries[key]
+
+    def parse(self, raw, cls):
+        """ cls(raw), unless we've already parsed identical bytes
+        with the same class. """
+        key = cls, sha1(raw).digest()
+        with self._lock:
+            obj = self._parsed.get(key)
+            if obj is not None:
+                self._parsed.move_to_end(key)
+                self.parse_skips += 1
+                return obj
+        obj = cls(raw)
+        with self._lock:
+            self._parsed[key] = obj
+            while len(self._parsed) > self.max_parsed:
+                self._parsed.popitem(False)
+        return obj
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'parse_skips': self.parse_skips,
+            'invalidations': self.invalidations,
+            'entries': len(self._entries),
+        }
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__,
+                            " ".join("%s=%s" % kv for kv in self.stats().items()))
+
+
+class _Flight():
+    __slots__ = ('done', 'value', 'error', 'generation')
+
+    def __init__(self, generation):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self.generation = generation
+
+
+class SharedSnapshot():
+    """ Coalesce calls to one (argument-less) server call.
+
+    Callers within `window` seconds of the last completed fetch
+    get its result without touching the server. Callers that
+    arrive while a fetch is in flight wait for that fetch and
+    share its result (or its exception) rather than sending a
+    request of their own.
+
+    invalidate() drops the recent result, and makes a fetch that
+    was in flight at the time hand its result to the callers that
+    were already waiting on it but not keep it for anyone after.
+
+    Like ResponseCache, the shared value must not be modified.
+    """
+    def __init__(self, window=0.5):
+        self.window = window
+        self._lock = threading.Lock()
+        self._flight = None
+        self._value = None
+        self._stamp = None
+        # bumped by invalidate(), so that a fetch that started before
+        # it doesn't store its (possibly stale) result after it
+        self._generation = 0
+
+        self.fetches = 0
+        self.reused = 0
+        self.joined = 0
+
+    def get(self, fetch, *args):
+        """
+        @param fetch: callable that does the actual server call
+        @return: fetch(*args), or a shared recent/in-flight result
+        """
+        with self._lock:
+            if self._stamp is not None and monotonic() - self._stamp < self.window:
+                self.reused += 1
+                return self._value
+            flight = self._flight
+            leader = flight is None
+            if leader:
+                flight = self._flight = _Flight(self._generation)
+                self.fetches += 1
+            else:
+                self.joined += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = fetch(*args)
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                if flight.error is None and flight.generation == self._generation:
+                    self._value = flight.value
+                    self._stamp = monotonic()
+                if self._flight is flight:
+                    self._flight = None
+            flight.done.set()
+        return flight.value
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._stamp = None
+            self._value = None
+            # callers from here on start a fetch of their own
+            self._flight = None
+
+    def stats(self):
+        return {
+            'fetches': self.fetches,
+            'reused': self.reused,
+            'joined': self.joined,
+        }
@@ -0,0 +1,146 @@
+"""
+Per-reactor circuit breakers.
+
+A reactor that has dropped off the network costs every caller a full
+connect timeout (times retries) per call. After `failures` calls in a
+row fail with connection errors, the reactor's breaker opens and calls
+fail immediately with CircuitOpenError for `cooldown` seconds. After
+that a single probe call is let through: if it works the breaker
+closes, if not it stays open for another cooldown.
+
+Apps don't have breakers unless given some. Give several apps the
+same CircuitBreakers and they all back off together from a reactor
+that's gone, eg the logger, pollers and exporters:
+
+    breakers = CircuitBreakers(failures=3, cooldown=10)
+    logger_app.breakers = export_app.breakers = breakers
+    breakers.get('192.168.1.6').state
+
+Server error replies (the reactor answered) don't count as failures.
+"""
+from time import monotonic
+import threading
+
+__author__ = 'Nathan Starkweather'
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(ConnectionError):
+    """ Call refused without trying, the reactor's breaker is open. """
+    def __init__(self, reactor, retry_in):
+        super().__init__("%s is not responding, not retrying for another %.1fs" % (reactor, retry_in))
+        self.reactor = reactor
+        self.retry_in = retry_in
+
+
+class CircuitBreaker():
+    """
+    @param reactor: name for messages
+    @param failures: consecutive failures before opening
+    @param cooldown: seconds to stay open before letting a probe through
+    """
+    def __init__(self, reactor, failures=5, cooldown=30):
+        self.reactor = reactor
+        self.failures = failures
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self._lock = threading.Lock()
+        self._fail_count = 0
+        self._opened = 0
+        self._probing = False
+
+        self.trips = 0
+        self.rejected = 0
+
+    def before(self):
+        """ Call before each request.
+        @raise CircuitOpenError: if the request shouldn't be made
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            wait = self._opened + self.cooldown - monotonic()
+            if self.state == OPEN and wait <= 0:
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN and not self._probing:
+                # this call is the probe
+                self._probing = True
+                return
+            self.rejected += 1
+        raise CircuitOpenError(self.reactor, max(wait, 0))
+
+    def success(self):
+        with self._lock:
+            self._fail_count = 0
+            self._probing = False
+            self.state = CLOSED
+
+    def failure(self):
+        with self._lock:
+            self._fail_count += 1
+            self._probing = False
+            if self.state == HALF_OPEN or self._fail_count >= self.failures:
+                if self.state != OPEN:
+                    self.trips += 1
+                self.state = OPEN
+                self._opened = monotonic()
+
+    def abort(self):
+        """ The request ended some other way (eg KeyboardInterrupt).
+        Don't count it, but free up the probe. """
+        with self._lock:
+            self._probing = False
+
+    def reset(self):
+        self.success()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self._fail_count,
+                'trips': self.trips,
+                'rejected': self.rejected,
+            }
+
+    def __repr__(self):
+        return "<%s %s %s>" % (self.__class__.__name__, self.reactor, self.state)
+
+
+class CircuitBreakers():
+    """ Thread safe CircuitBreaker per reactor, created on first use.
+    Arguments are passed on to each CircuitBreaker. """
+    def __init__(self, failures=5, cooldown=30):
+        self.failures = failures
+        self.cooldown = cooldown
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, reactor):
+        """
+        @rtype: CircuitBreaker
+        """
+        breaker = self._breakers.get(reactor)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.get(reactor)
+                if breaker is None:
+                    breaker = self._breakers[reactor] = CircuitBreaker(reactor, self.failures, self.cooldown)
+        return breaker
+
+    def reset(self):
+        with self._lock:
+            breakers = list(self._breakers.values())
+        for b in breakers:
+            b.reset()
+
+    def stats(self):
+        """
+        @return: {reactor: CircuitBreaker.stats()}
+        """
+        with self._lock:
+            breakers = list(self._breakers.items())
+        return {reactor: b.stats() for reactor, b in breakers}
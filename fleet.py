@@ -0,0 +1,182 @@
+"""
+Run the same HelloApp call against many reactors at once.
+
+    fleet = HelloFleet(['192.168.1.6', '192.168.1.7'], deadline=2)
+    for ip, r in fleet.run('getUnAckCount').items():
+        print(ip, r.value if r.ok else r.error, r.elapsed)
+
+Each reactor gets its own deadline, counted from the moment its
+call actually starts, so one unplugged reactor only costs its own
+deadline instead of stalling the rest of the sweep.
+"""
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from time import time
+import threading
+
+from hello.hello3 import open_hello, HelloError
+
+__author__ = 'Nathan Starkweather'
+
+
+class FleetTimeout(HelloError, TimeoutError):
+    """ Reactor didn't answer before its deadline. """
+
+
+class FleetResult():
+    """ Outcome of one call against one reactor. """
+    __slots__ = ('reactor', 'value', 'error', 'started', 'finished')
+
+    def __init__(self, reactor, value=None, error=None, started=None, finished=None):
+        self.reactor = reactor
+        self.value = value
+        self.error = error
+        self.started = started
+        self.finished = finished
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def elapsed(self):
+        if self.started is None or self.finished is None:
+            return None
+        return self.finished - self.started
+
+    def __repr__(self):
+        if self.ok:
+            what = "value=%r" % (self.value,)
+        else:
+            what = "error=%r" % (self.error,)
+        return "%s(%r, %s, elapsed=%s)" % (self.__class__.__name__, self.reactor, what, self.elapsed)
+
+
+class HelloFleet():
+    """ Fan a call out to many reactors on a bounded pool of worker
+    threads.
+
+    @param reactors: iterable of ipv4 strings or HelloApp instances
+    @param max_workers: maximum number of calls in flight at once
+    @param deadline: seconds each reactor has to answer
+    """
+    def __init__(self, reactors, max_workers=16, deadline=5):
+        self.deadline = deadline
+        self._apps = {}
+        self._owned = set()
+        self._busy = set()
+        self._lock = threading.Lock()
+        self._reactors = list(reactors)
+        self._pool = ThreadPoolExecutor(max_workers, thread_name_prefix="HelloFleet")
+
+    @property
+    def reactors(self):
+        return list(self._reactors)
+
+    def _getapp(self, reactor):
+        with self._lock:
+            app = self._apps.get(reactor)
+            if app is None:
+                app = open_hello(reactor)
+                if app is not reactor:
+                    # we own this app, so we're free to shorten its
+                    # timeout so that abandoned calls free their
+                    # worker thread in a reasonable amount of time.
+                    app.settimeout(self.deadline)
+                    self._owned.add(reactor)
+                self._apps[reactor] = app
+            return app
+
+    def app(self, reactor):
+        """ The app used for `reactor` (one of self.reactors) """
+        return self._getapp(reactor)
+
+    def _run_one(self, reactor, call, args, kw, result):
+        result.started = time()
+        value = error = None
+        try:
+            app = self._getapp(reactor)
+            if isinstance(call, str):
+                value = getattr(app, call)(*args, **kw)
+            else:
+                value = call(app, *args, **kw)
+        except Exception as e:
+            error = e
+        finally:
+            with self._lock:
+                self._busy.discard(reactor)
+                # result was already handed back as timed out
+                if result.finished is None:
+                    result.value = value
+                    result.error = error
+                    result.finished = time()
+
+    def run(self, call, *args, deadline=None, **kw):
+        """
+        @param call: name of a HelloApp method, or a callable
+                     that takes the app as its first argument
+        @param deadline: override self.deadline for this sweep
+        @return: dict of reactor -> FleetResult
+        @rtype: dict[str, FleetResult]
+        """
+        if deadline is None:
+            deadline = self.deadline
+
+        results = {}
+        pending = {}
+        for reactor in self._reactors:
+            result = results[reactor] = FleetResult(reactor)
+            with self._lock:
+                busy = reactor in self._busy
+                if not busy:
+                    self._busy.add(reactor)
+            if busy:
+                # an earlier sweep abandoned a call to this reactor
+                # and it still hasn't given up. Don't pile on.
+                result.error = FleetTimeout("Previous call to %s still running" % reactor)
+                continue
+            fut = self._pool.submit(self._run_one, reactor, call, args, kw, result)
+            pending[fut] = result
+
+        while pending:
+            # wake up in time for the earliest deadline among
+            # the calls that have actually started.
+            now = time()
+            started = [r.started for r in pending.values() if r.started is not None]
+            timeout = max(min(started) + deadline - now, 0) if started else deadline
+            done, _ = wait(pending, timeout, FIRST_COMPLETED)
+            for fut in done:
+                del pending[fut]
+
+            now = time()
+            with self._lock:
+                for fut, result in list(pending.items()):
+                    if result.finished is not None:
+                        del pending[fut]
+                    elif result.started is not None and now - result.started >= deadline:
+                        del pending[fut]
+                        result.error = FleetTimeout("%s didn't answer within %ss" % (result.reactor, deadline))
+                        result.finished = now
+        return results
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        def call(*args, **kw):
+            return self.run(name, *args, **kw)
+        call.__name__ = name
+        return call
+
+    def close(self):
+        self._pool.shutdown(wait=False)
+        with self._lock:
+            for reactor in self._owned:
+                self._apps[reactor].close()
+            self._apps.clear()
+            self._owned.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -27,6 +27,12 @@ def swap_wifi(nw):
     print("Changing Wifi to %r" % nw)
     wlan.ensure_wifi(nw)
 
+def _print_progress(nbytes, total, rate):
+    if total:
+        sys.stdout.write("\r%.1f / %.1f MB (%.0f kB/s)" % (nbytes / 1e6, total / 1e6, rate / 1e3))
+    else:
+        sys.stdout.write("\r%.1f MB (%.0f kB/s)" % (nbytes / 1e6, rate / 1e3))
+
 class BatchExporter():
     def __init__(self, ipv4, reactor_name, rsize, version=3, folder=None):
         self.ipv4 = ipv4
@@ -105,9 +111,17 @@ class BatchExporter():
             print("Stopping running batch...")
             self.app.endbatch()
         print("Downloading File...")
-        report = self.app.getdatareport_bybatchname(batch_name)
+        if isinstance(self.app, hello3.HelloApp):
+            # stream straight to disk rather than holding the
+            # whole report in memory
+            _, tmp = self._temp_unique_name(batch_name)
+            self.app.getdatareport_bybatchname(batch_name, dest=tmp, progress=_print_progress)
+            print()
+        else:
+            report = self.app.getdatareport_bybatchname(batch_name)
+            tmp = self._save_temp(batch_name, report)
         print("Analyzing File...")
-        self.analyze(batch_name, report)
+        self._do_xl_import(tmp)
         if wlan.get_current_wifi() != self.current_network:
             swap_wifi(self.current_network)
 
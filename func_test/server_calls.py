@@ -11,6 +11,7 @@ from unittest.case import SkipTest
 __author__ = 'Nathan Starkweather'
 
 from hello import HelloApp, HelloXML, BatchListXML, parse_xml, parse_rsp
+from hello.alarms import parse_alarms
 import unittest
 from os.path import dirname
 from json import loads as json_loads
@@ -323,10 +324,9 @@ class TestServerCalls(unittest.TestCase):
         self.do_get_call('getAlarms', args)
 
     def test_clearAlarm(self):
-        alarms = self.app.getAlarms()
-        ids = alarms['alarmIDs'].split(',')
+        alarms = parse_alarms(self.app.getAlarms())
         try:
-            alarm = ids[0]
+            alarm = alarms[0].id
         except IndexError:
             raise SkipTest("No alarms, can't test")
 
@@ -335,10 +335,9 @@ class TestServerCalls(unittest.TestCase):
 
     def test_clearAlarmsByType(self):
 
-        alarms = self.app.getAlarms()
-        types = alarms['type'].split(',')
+        alarms = parse_alarms(self.app.getAlarms())
         try:
-            typ = types[1]
+            typ = alarms[0].type
         except IndexError:
             raise SkipTest("No alarms, can't test")
 
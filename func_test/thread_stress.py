@@ -0,0 +1,98 @@
+"""
+Hammer a single hello3.HelloApp from many threads at once, the
+way HelloLogger and a PIDTest loop share one app. Runs against the
+mock server, so no reactor needed:
+
+    python -m unittest hello.func_test.thread_stress
+"""
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import threading
+import unittest
+
+from hello import hello3
+from hello.hello3 import HelloApp
+from hello.mock.server import MockHelloServer
+from hello.transport import Transport
+
+__author__ = 'Nathan Starkweather'
+
+
+class TestThreadStress(unittest.TestCase):
+    nthreads = 16
+    per_thread = 25
+    server = None
+    _factory = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = MockHelloServer().start()
+        cls._factory = hello3.HelloApp.ConnectionFactory
+        hello3.HelloApp.ConnectionFactory = functools.partial(Transport, use_ssl=False)
+
+    @classmethod
+    def tearDownClass(cls):
+        hello3.HelloApp.ConnectionFactory = cls._factory
+        cls.server.close()
+
+    def setUp(self):
+        self.app = HelloApp(self.server.address)
+        self.app.login()
+
+    def tearDown(self):
+        self.app.close()
+
+    def _hammer(self, fn):
+        """ Run fn(thread #, iteration #) nthreads * per_thread times,
+        all threads released at once. Re-raises the first failure. """
+        start = threading.Barrier(self.nthreads)
+
+        def worker(n):
+            start.wait()
+            return [fn(n, i) for i in range(self.per_thread)]
+
+        with ThreadPoolExecutor(self.nthreads) as pool:
+            futures = [pool.submit(worker, n) for n in range(self.nthreads)]
+            return [f.result() for f in futures]
+
+    def test_mixed_reads(self):
+        calls = (self.app.getMainValues, self.app.getDORAValues, self.app.getVersion,
+                 self.app.getConfig, self.app.getUnAckCount)
+
+        def call(n, i):
+            return calls[(n + i) % len(calls)]()
+
+        self._hammer(call)
+
+    def test_main_values_consistent(self):
+        # replies must never get crossed between threads
+        def call(n, i):
+            mv = self.app.getMainValues()
+            self.assertIn('agitation', mv)
+            return mv
+
+        results = self._hammer(call)
+        self.assertEqual(sum(map(len, results)), self.nthreads * self.per_thread)
+
+    def test_concurrent_login(self):
+        # everyone logs in at once, then everyone makes a call that
+        # needs a login. One session for all of them at the end.
+        def call(n, i):
+            if i == 0:
+                self.app.login()
+            return self.app.getConfig()
+
+        self._hammer(call)
+        cookie = self.app.cookie
+        self.app.getConfig()
+        self.assertEqual(cookie, self.app.cookie)
+
+    def test_headers_untouched(self):
+        headers = dict(self.app.headers)
+        self._hammer(lambda n, i: self.app.getMainValues())
+        self.assertEqual(headers, self.app.headers)
+        self.assertNotIn('Cookie', self.app.headers)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,6 @@
-from hello.hello import HelloApp
+from hello.hello3 import HelloApp, HelloError
+from http.client import HTTPException
+from time import sleep
 import sys
 import random
 
@@ -106,19 +108,21 @@ def spam_hello_setconfig_coro(app, output=output):
             app.setconfig(grp, name, val)
             yield
     finally:
-        while True:
+        # apply_config only sends what still differs, so each try
+        # picks up where the last one left off. No rollback: that
+        # would undo the part of the restore that did go through.
+        for _ in range(5):
             try:
                 app.login()
-                while combos:
-                    grp, name = combos[-1]
-                    val = settings[grp][name]
-                    output("Restoring config: %s:%s = %s\n" % (grp, name, val))
-                    app.setconfig(grp, name, val)
-                    del combos[-1]
-            except:
-                continue
-            else:
+                output("\nRestoring config...\n")
+                restored = app.apply_config(settings, rollback=False)
+                output("Restored %d config values\n" % len(restored))
                 break
+            except (HelloError, OSError, HTTPException) as e:
+                output("Restoring config failed: %s\n" % e)
+                sleep(1)
+        else:
+            output("Gave up restoring config, check the reactor's settings by hand\n")
                 
 def ensure(func):
     while True:
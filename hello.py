@@ -18,13 +18,16 @@ __author__ = 'Nathan Starkweather'
 from xml.etree.ElementTree import XMLParser, XML as parse_xml
 from json import loads as json_loads
 from re import compile as re_compile
-from time import time
+from time import time, perf_counter
 import types
 import logging
 import ipaddress
 import socket
 
 from hello import _hello
+from hello.transport import Transport
+from hello.metrics import default_registry, call_name
+from hello.circuit import CircuitOpenError
 
 
 class BadError(Exception):
@@ -108,7 +111,7 @@ def open_hello(app_or_ipv4):
 
 
 class LVWSHTTPConnection(HTTPConnection):
-    def do_request(self, meth, url, body=None, headers=None):
+    def do_request(self, meth, url, body=None, headers=None, timeout=None, idempotent=False):
         headers = headers or {}
         self.request(meth, url, body, headers)
         return self.getresponse()
@@ -116,6 +119,14 @@ class LVWSHTTPConnection(HTTPConnection):
 
 class BaseHelloApp(_hello._BaseHelloApp):
     _headers = {}
+    # MetricsRegistry to record calls into, or None
+    metrics = default_registry
+    # circuit.CircuitBreakers (possibly shared with other apps), or
+    # None for no breaker
+    breakers = None
+    # timeouts.TimeoutPolicy for per-call timeouts, or None to
+    # use the connection's timeout for everything
+    timeouts = None
     _url_template = "http://%s/webservice/interface/"
 
     def __init__(self, ipv4, headers=None, retry_count=3, timeout=socket.getdefaulttimeout()):
@@ -140,6 +151,9 @@ class BaseHelloApp(_hello._BaseHelloApp):
 
         self._parse_rsp = parse_rsp
 
+        self._init_logger(ipv4)
+
+    def _init_logger(self, ipv4):
         # setup logger and export some methods
         self._logger = logging.Logger(self._calc_logger_name(ipv4))
         self._log = self._logger.log
@@ -151,10 +165,10 @@ class BaseHelloApp(_hello._BaseHelloApp):
         return "%s: %s" % (self.__class__.__name__, ipv4)
 
     def settimeout(self, s):
-        self._connection.sock.settimeout(s)
+        self._connection.timeout = s
 
     def gettimeout(self):
-        return self._connection.sock.gettimeout()
+        return self._connection.timeout
 
     def _parse_ipv4(self, ipv4):
         """
@@ -183,7 +197,7 @@ class BaseHelloApp(_hello._BaseHelloApp):
         @rtype: HTTPConnection
         """
         host, port = self._parse_ipv4(ipv4)
-        return self._init_connection(host, port)
+        return self._init_connection(host, port, self.gettimeout())
 
     def _init_connection(self, host, port, timeout):
         """
@@ -191,9 +205,10 @@ class BaseHelloApp(_hello._BaseHelloApp):
         @type host: str
         @param port: port to connect on
         @type port: int
-        @return: HTTPConnection object
+        @return: Transport object
         """
-        return LVWSHTTPConnection(host, port, timeout=timeout)
+        return Transport(host, int(port), timeout, use_ssl=False,
+                         retries=self.retry_count or None)
 
     def close(self):
         if self._connection:
@@ -222,7 +237,7 @@ class BaseHelloApp(_hello._BaseHelloApp):
         self._urlbase = self._url_template % ipv4
         self._ipv4 = ipv4
         self._host, self._port = self._parse_ipv4(ipv4)
-        self._connection = self._init_connection(self._host, self._port)
+        self._connection = self._init_connection(self._host, self._port, self.gettimeout())
         self._logger.name = self._calc_logger_name(ipv4)
 
     @property
@@ -257,38 +272,48 @@ class BaseHelloApp(_hello._BaseHelloApp):
         query = "?&" + "&".join("=".join(a) for a in args)
         return self.send_request(query)
 
-    def _do_request(self, url):
-        nattempts = 1
-        err = None
-        while True:
-            try:
-                return self._connection.do_request('GET', url, None, self.headers)
-            except (ConnectionError, HTTPException, socket.timeout, TimeoutError) as e:
-                err = e
-            except Exception as e: 
-                # debug. eventually all connection quirks should be worked out
-                # and handled appropriately.
-                err = e
-                self._warn("=====================================")
-                self._warn("UNKNOWN ERROR OCCURRED DURING REQUEST")
-                self._warn("IPV4 ADDRESS: %s", self._ipv4)
-                self._warn("REQUESTED URL: <%s>", url)
-                self._warn(str(e))
-                self._warn("=====================================")
-
-            if self.retry_count and nattempts > self.retry_count:
-                raise err or Exception("Unknown Error")
-            else:
-                nattempts += 1
-
-            self.reconnect()
+    def _do_request(self, url, timeout=None):
+        # Transport takes care of reconnecting, and retries
+        # up to self.retry_count times with backoff. Calls that
+        # change something are only retried if they never got sent.
+        return self._connection.do_request('GET', url, None, self.headers, timeout,
+                                           self._idempotent(call_name(url)))
+
+    def _guarded_request(self, url, timeout=None):
+        """ _do_request, through this reactor's circuit breaker """
+        breakers = self.breakers
+        if breakers is None:
+            return self._do_request(url, timeout)
+        breaker = breakers.get(self._ipv4)
+        breaker.before()
+        try:
+            rsp = self._do_request(url, timeout)
+        except (OSError, HTTPException):
+            breaker.failure()
+            if self.metrics is not None:
+                self.metrics.track_breakers(breakers)
+            raise
+        except BaseException:
+            breaker.abort()
+            raise
+        breaker.success()
+        return rsp
 
     def _send_request_raw(self, url):
         """
         @return: http response object
         @rtype: http.client.HTTPResponse
         """
-        rsp = self._do_request(url)
+        started = self._request_started(url)
+        if started is None:
+            rsp = self._guarded_request(url)
+        else:
+            try:
+                rsp = self._guarded_request(url, started[1])
+            except Exception as e:
+                self._request_done(started, error=e)
+                raise
+            self._request_done(started, rsp)
         cookie = rsp.headers.get("Set-Cookie")
         if cookie:
             self.headers['Cookie'] = cookie.split(';', 1)[0]
@@ -307,11 +332,26 @@ class BaseHelloApp(_hello._BaseHelloApp):
         url = self._urlbase + query
         return self._send_request_raw(url)
 
+    def _timed_parse(self, rsp, parser, parse, arg):
+        metrics = self.metrics
+        if metrics is None:
+            return parse(arg)
+        start = perf_counter()
+        obj = parse(arg)
+        metrics.observe_parse(getattr(rsp, 'hello_call', None), self._ipv4, parser, perf_counter() - start)
+        return obj
+
+    def _parse_xml(self, rsp, cls=None):
+        return self._timed_parse(rsp, 'xml', cls or HelloXML, rsp)
+
+    def _parse_json(self, rsp):
+        return self._timed_parse(rsp, 'json', json_loads, rsp.read().decode('utf-8'))
+
     def _do_set_validate(self, rsp):
         """
         Quickly validate that a set call returned a successful response.
         """
-        root = self._parse_rsp(rsp)
+        root = self._timed_parse(rsp, 'xml', self._parse_rsp, rsp)
         result = root[0]
         if not result.text == "True":
             raise ServerCallError(root[1].text)
@@ -348,7 +388,7 @@ class HelloApp(BaseHelloApp):
         else:
             query = "?&call=getAlarms&mode=%s&val1=%s&val2=%s" % (mode, val1, val2)
         rsp = self.send_request(query)
-        xml = HelloXML(rsp)
+        xml = self._parse_xml(rsp)
         if not xml.result:
             raise ServerCallError(xml.msg)
         return xml.data['Alarms']
@@ -356,7 +396,7 @@ class HelloApp(BaseHelloApp):
     def getAlarmList(self):
         query = "?&call=getAlarmList"
         rsp = self.send_request(query)
-        xml = HelloXML(rsp)
+        xml = self._parse_xml(rsp)
         if not xml.result:
             raise ServerCallError(xml.msg)
 
@@ -366,7 +406,7 @@ class HelloApp(BaseHelloApp):
     def getUnAckCount(self):
         query = "?&call=getUnAckCount"
         rsp = self.send_request(query)
-        xml = HelloXML(rsp)
+        xml = self._parse_xml(rsp)
         if not xml.result:
             raise ServerCallError(xml.msg)
         return int(xml.data)
@@ -388,7 +428,7 @@ class HelloApp(BaseHelloApp):
         query = "?&call=getReport&mode=%s&type=%s&val1=%s&val2=%s&timeout=%s" % \
                 (mode, type, val1, val2, timeout)
         rsp = self.send_request(query)
-        xml = HelloXML(rsp)
+        xml = self._parse_xml(rsp)
         if not xml.result:
             raise ServerCallError(xml.data)
         return xml.data
@@ -396,7 +436,7 @@ class HelloApp(BaseHelloApp):
     def getBatches(self):
         query = "?&call=getBatches&loader=Loading+batches..."
         rsp = self.send_request(query)
-        xml = BatchListXML(rsp)
+        xml = self._parse_xml(rsp, BatchListXML)
         if not xml.result:
             raise ServerCallError(xml.data)
         return xml
@@ -429,7 +469,7 @@ class HelloApp(BaseHelloApp):
     def getdatareport_bybatchname(self, name):
         query = "?&call=getBatches&loader=Loading+batches..."
         rsp = self.send_request(query)
-        xml = BatchListXML(rsp)
+        xml = self._parse_xml(rsp, BatchListXML)
         try:
             id = xml.getbatchid(name)
         except KeyError:
@@ -483,7 +523,7 @@ class HelloApp(BaseHelloApp):
     def getDORAValues(self):
         query = "?&call=getDORAValues"
         rsp = self.send_request(query)
-        xml = HelloXML(rsp)
+        xml = self._parse_xml(rsp)
 
         # Get dora values ends up returning a blank element
         # for the name of the cluster, so the dict ends up
@@ -504,7 +544,7 @@ class HelloApp(BaseHelloApp):
     def getMainValues(self):
         query = "?&call=getMainValues&json=true"
         rsp = self.send_request(query)
-        mv = json_loads(rsp.read().decode('utf-8'))
+        mv = self._parse_json(rsp)
         return mv['message']
 
     # backward compatibility
@@ -514,7 +554,7 @@ class HelloApp(BaseHelloApp):
     def getAdvancedValues(self):
         query = "?&call=getAdvancedValues"
         rsp = self.send_request(query)
-        xml = HelloXML(rsp)
+        xml = self._parse_xml(rsp)
         if not xml.result:
             raise ServerCallError(xml.msg)
         return xml.data['Advanced Values']
@@ -566,7 +606,7 @@ class HelloApp(BaseHelloApp):
     def getRawValue(self, sensor):
         query = "?&call=getRawValue&sensor=" + sensor
         rsp = self.send_request(query)
-        xml = HelloXML(rsp)
+        xml = self._parse_xml(rsp)
         if not xml.result:
             raise ServerCallError(xml.data)
         return float(xml.data)
@@ -574,7 +614,7 @@ class HelloApp(BaseHelloApp):
     def getVersion(self):
         query = "?&call=getVersion"
         rsp = self.send_request(query)
-        xml = HelloXML(rsp)
+        xml = self._parse_xml(rsp)
         if not xml.result:
             raise ServerCallError(xml.data)
         return xml.data['Versions']
@@ -614,7 +654,7 @@ class HelloApp(BaseHelloApp):
     def getConfig(self):
         query = "?&call=getConfig"
         rsp = self.send_request(query)
-        xml = HelloXML(rsp)
+        xml = self._parse_xml(rsp)
         if not xml.result:
             raise ServerCallError(xml.msg)
 
@@ -631,7 +671,7 @@ class HelloApp(BaseHelloApp):
     def getRecipes(self, loader="Loading+recipes"):
         query = "?&call=getRecipes&loader=" + loader
         rsp = self.send_request(query)
-        xml = HelloXML(rsp)
+        xml = self._parse_xml(rsp)
         if not xml.result:
             raise ServerCallError(xml.msg)
         return xml.data.split(",")
@@ -639,7 +679,7 @@ class HelloApp(BaseHelloApp):
     def getTrendData(self, span, group):
         query = "?&call=getTrendData&spam=%s&group=%s&json=1" % (span, group)
         rsp = self.send_request(query)
-        return json_loads(rsp.read().decode('utf-8'))
+        return self._parse_json(rsp)
 
     # repl support
 
@@ -650,14 +690,22 @@ class HelloApp(BaseHelloApp):
     __str__ = __repr__
 
     def __getstate__(self):
+        # the session cookie rides along in self.headers. Loggers
+        # made with logging.Logger() don't pickle, so they get rebuilt.
         d = self.__dict__.copy()
-        del d['_connection']
+        for k in ('_connection', '_logger', '_log', '_debug', '_warn', '_info'):
+            d.pop(k, None)
+        d['_timeout'] = self.gettimeout()
         return d
 
     def __setstate__(self, state):
+        state = state.copy()
+        timeout = state.pop('_timeout', None)
         for k, v in state.items():
             setattr(self, k, v)
-        self._connection = self._init_connection(self._host, self._port)
+        self._init_logger(self._ipv4)
+        # no connect(), the transport connects on first request
+        self._connection = self._init_connection(self._host, self._port, timeout)
 
 
 class HelloXML():
@@ -15,21 +15,25 @@ from http.client import HTTPConnection, HTTPException, HTTPSConnection
 import ssl
 import datetime
 import io
+import os
+from functools import wraps
 
 __author__ = 'Nathan Starkweather'
 
 from xml.etree.ElementTree import XMLParser, XML as parse_xml
 from json import loads as json_loads
 import re
-from time import time
-import types
+from time import time, perf_counter, monotonic
 import logging
-import ipaddress
-import traceback
 import socket
-import itertools
+import math
+import threading
 
 from hello import _hello
+from hello.cache import ResponseCache, SharedSnapshot
+from hello.transport import Transport, PoolTimeout
+from hello.metrics import default_registry, call_name
+from hello.circuit import CircuitOpenError
 
 
 class BadError(Exception):
@@ -64,6 +68,18 @@ class XMLError(HelloError):
     pass
 
 
+class ConfigApplyError(HelloError):
+    """ HelloApp.apply_config couldn't apply every change.
+
+    @ivar failed: {(group, name): exception or value read back}
+    @ivar rolled_back: True if the original values were restored
+    """
+    def __init__(self, msg, failed=None, rolled_back=False):
+        super().__init__(msg)
+        self.failed = failed or {}
+        self.rolled_back = rolled_back
+
+
 _sanitize = re.compile(r"([\s:%/])").sub
 
 # todo: add all url substitution thingies.
@@ -110,7 +126,8 @@ def open_hello(app_or_ipv4):
 
 
 class DoRequestMixin():
-    def do_request(self, meth, url, body=None, headers=None):
+    def do_request(self, meth, url, body=None, headers=None, idempotent=False):
+        # single connection, no retries
         headers = headers or {}
         self.request(meth, url, body, headers)
         return self.getresponse()
@@ -128,9 +145,20 @@ class LVWSHTTPSConnection(DoRequestMixin, HTTPSConnection):
         self.ca_cert_dir = None
 
 
-import requests
-from requests.packages.urllib3.exceptions import InsecureRequestWarning
-requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+_requests = None
+
+
+def _get_requests():
+    # requests takes longer to import than the rest of the client put
+    # together, and only HTTPSSession uses it
+    global _requests
+    if _requests is None:
+        import requests
+        from requests.packages.urllib3.exceptions import InsecureRequestWarning
+        requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+        _requests = requests
+    return _requests
+
 
 class HTTPSSession():
     def __init__(self, host, port=None, timeout=5):
@@ -138,26 +166,44 @@ class HTTPSSession():
         self._base = "https://%s" % host
         if port:
             self._base += ":%d" % port
-        self.sess = requests.Session()
+        self.sess = _get_requests().Session()
         self.timeout = timeout
 
         # For public access (api compatibility)
         self.host = host
         self.port = port
 
-    def do_request(self, meth, url, body=None, headers=None):
+    def do_request(self, meth, url, body=None, headers=None, timeout=None, idempotent=False):
+        # requests doesn't retry (by default), so idempotent is moot
         url = self._base + url
-        rsp = self.sess.request(meth, url, body, None, timeout=self.timeout, verify=False)
+        timeout = self.timeout if timeout is None else timeout
+        rsp = self.sess.request(meth, url, body, None, timeout=timeout, verify=False)
         # XXX Sloppy. Refactor HelloApp to not use read()
         file = io.BytesIO(rsp.content)
         rsp.read = file.read
         return rsp
 
+    def do_stream_request(self, meth, url, headers=None, timeout=None, idempotent=False):
+        """ Like do_request, but the body is left unread so that the
+        caller can consume it with rsp.iter_content(). The caller
+        must close the response.
+        """
+        url = self._base + url
+        timeout = self.timeout if timeout is None else timeout
+        return self.sess.request(meth, url, headers=headers, timeout=timeout,
+                                 verify=False, stream=True)
+
     def connect(self):
-        self.sess = requests.Session()
+        self.sess = _get_requests().Session()
         
     def close(self):
-        self.sess = requests.Session()
+        self.sess = _get_requests().Session()
+
+    def clone(self):
+        """ New session to the same server, logged in as this one. """
+        other = self.__class__(self.host, self.port, self.timeout)
+        other.sess.cookies.update(self.sess.cookies)
+        return other
 
 
 # modes
@@ -166,27 +212,127 @@ MAN = 1
 OFF = 2
 
 
+class Session():
+    """ Login state of a HelloApp, shared by every thread using the
+    app, and by other apps via HelloApp.share_session.
+
+    The cookie is swapped whole under `lock`, so request threads
+    read it without locking and never see half an update. Logins
+    are serialized with `login_lock`.
+
+    The server drops a session that goes unused for a while. How
+    long isn't something it tells us, so `max_idle` is a guess (set
+    it per session or on the class). Once a session has been idle for
+    `refresh_at` of that, HelloApp logs in again before the next call
+    instead of finding out the hard way.
+    """
+    max_idle = 600
+    refresh_at = 0.9
+
+    def __init__(self, cookie=None):
+        self.cookie = cookie
+        self.lock = threading.Lock()
+        self.login_lock = threading.RLock()
+
+        # credentials and reply of the last successful login
+        self.user = None
+        self.password = None
+        self.login_reply = None
+        self.logged_in_at = None  # monotonic
+        self.last_used = None     # monotonic, last call that didn't bounce
+
+        self.logins = 0
+        self.replays = 0
+
+    def idle(self):
+        """ Seconds since the session was last used, or None """
+        if self.last_used is None:
+            return None
+        return monotonic() - self.last_used
+
+    def age(self):
+        """ Seconds since the last login, or None """
+        if self.logged_in_at is None:
+            return None
+        return monotonic() - self.logged_in_at
+
+    def touch(self):
+        self.last_used = monotonic()
+
+    def fresh(self, user=None, password=None):
+        """ Logged in (as `user`, if given) and not about to expire """
+        if self.cookie is None or self.user is None:
+            return False
+        if user is not None and (user, password) != (self.user, self.password):
+            return False
+        idle = self.idle()
+        return idle is not None and idle < self.max_idle * self.refresh_at
+
+    def expiring(self):
+        """ Logged in, but idle long enough that it may not be for long """
+        idle = self.idle()
+        return self.user is not None and idle is not None and idle >= self.max_idle * self.refresh_at
+
+    def logged_in(self, user, password, reply):
+        self.user = user
+        self.password = password
+        self.login_reply = reply
+        self.logged_in_at = self.last_used = monotonic()
+        self.logins += 1
+
+    def logged_out(self):
+        self.user = self.password = self.login_reply = None
+        self.logged_in_at = None
+
+    def stats(self):
+        return {
+            'user': self.user,
+            'logged_in': self.cookie is not None and self.user is not None,
+            'age': self.age(),
+            'idle': self.idle(),
+            'logins': self.logins,
+            'replays': self.replays,
+        }
+
+
 class BaseHelloApp(_hello._BaseHelloApp):
+    # Headers sent with every request. Never changed after __init__,
+    # the session cookie lives in self._session, so one app can be
+    # used from many threads at once.
     headers = {}
-    ConnectionFactory = HTTPSSession
-
-    def __init__(self, ipv4, headers=None, timeout=5, verbose_errors=False, logger=None):
+    # MetricsRegistry to record calls into, or None
+    metrics = default_registry
+    # circuit.CircuitBreakers (possibly shared with other apps), or
+    # None for no breaker
+    breakers = None
+    # timeouts.TimeoutPolicy for per-call timeouts, or None to
+    # use the connection's timeout for everything
+    timeouts = None
+    # HTTPSSession still works here, for anyone who needs
+    # requests' behavior.
+    ConnectionFactory = Transport
+
+    def __init__(self, ipv4, headers=None, timeout=5, verbose_errors=False, logger=None, connect=True):
         """
         @param ipv4: ipv4 address to connect to (string eg 192.168.1.1:80)
         @param headers: headers to pass on each http connection
         @param retry_count: how many times to retry a connection on failure
                             set to 0 to try forever.
+        @param connect: start connecting right away. Otherwise the first
+                        connection is made by the first request.
         """
         super().__init__()
         self.headers = self.headers.copy()
         self.headers.update(headers or {})
+        self._session = Session(self.headers.pop('Cookie', None))
         self._urlbase = "/webservice/interface/"
         self.verbose_errors = verbose_errors
 
         self._ipv4 = ipv4
         
         self._connection = self._init_connection(ipv4, None, timeout)
-        self._connection.connect()
+        if connect:
+            self._connection.connect()
 
         self._parse_rsp = parse_rsp
         self._logger = logger or logging.Logger("%s: %s" % (self.__class__.__name__, ipv4))
@@ -203,7 +349,7 @@ class BaseHelloApp(_hello._BaseHelloApp):
         self._connection.connect()
 
     def settimeout(self, timeout):
-        if not isinstance(timeout, int) or timeout < 0:
+        if not isinstance(timeout, (int, float)) or timeout < 0:
             raise ValueError(timeout)
         self._connection.timeout = timeout
 
@@ -211,24 +357,100 @@ class BaseHelloApp(_hello._BaseHelloApp):
     def ipv4(self):
         return self._ipv4
 
-    def _do_request(self, url):
-        # Requests package handles retries
-        return self._connection.do_request('GET', url, None, self.headers)
+    def _request_headers(self, extra=None):
+        """ Headers for one request: the app's headers plus the
+        current session cookie, plus `extra`. """
+        cookie = self._session.cookie
+        if cookie is None and not extra:
+            return self.headers
+        headers = self.headers.copy()
+        if cookie is not None:
+            headers['Cookie'] = cookie
+        if extra:
+            headers.update(extra)
+        return headers
+
+    def _do_request(self, url, timeout=None, headers=None, stream=False):
+        # The connection handles retries
+        headers = self._request_headers(headers)
+        idempotent = self._idempotent(call_name(url))
+        if stream:
+            return self._connection.do_stream_request('GET', url, headers, timeout, idempotent)
+        if timeout is None:
+            return self._connection.do_request('GET', url, None, headers, idempotent=idempotent)
+        return self._connection.do_request('GET', url, None, headers, timeout, idempotent=idempotent)
+
+    def _guarded_request(self, url, timeout=None, headers=None, stream=False):
+        """ _do_request, through this reactor's circuit breaker """
+        breakers = self.breakers
+        if breakers is None:
+            return self._do_request(url, timeout, headers, stream)
+        breaker = breakers.get(self._ipv4)
+        breaker.before()
+        try:
+            rsp = self._do_request(url, timeout, headers, stream)
+        except (OSError, HTTPException):
+            breaker.failure()
+            if self.metrics is not None:
+                self.metrics.track_breakers(breakers)
+            raise
+        except BaseException:
+            breaker.abort()
+            raise
+        breaker.success()
+        return rsp
 
-    def _send_request_raw(self, url):
+    def _send_request_raw(self, url, headers=None, stream=False):
         """
+        @param headers: extra headers for this request
+        @param stream: leave the body unread, see Transport.do_stream_request
         @return: http response object
         @rtype: http.client.HTTPResponse
         """
-        rsp = self._do_request(url)
+        started = self._request_started(url)
+        if started is None:
+            rsp = self._guarded_request(url, None, headers, stream)
+        else:
+            try:
+                rsp = self._guarded_request(url, started[1], headers, stream)
+            except Exception as e:
+                self._request_done(started, error=e)
+                raise
+            self._request_done(started, rsp, stream=stream)
+        self._update_cookie(rsp)
+        return rsp
+
+    def _update_cookie(self, rsp):
         cookie = rsp.headers.get("Set-Cookie")
         if cookie:
             c = cookie.split(';', 1)[0]  # works on empty strings too
-            if c:
-                self.headers['Cookie'] = c
-            else:
-                del self.headers['Cookie']
-        return rsp
+            with self._session.lock:
+                self._session.cookie = c or None
+
+    @property
+    def cookie(self):
+        """ Current session cookie ("name=value"), or None """
+        return self._session.cookie
+
+    def __getstate__(self):
+        """ Apps pickle down to the reactor address, settings and
+        session cookie, so that a copy sent to a worker process picks
+        up the same login. Connections, caches and metrics stay behind.
+        """
+        return {
+            'ipv4': self._ipv4,
+            'headers': self.headers,
+            'timeout': self._connection.timeout,
+            'verbose_errors': self.verbose_errors,
+            'cookie': self._session.cookie,
+        }
+
+    def __setstate__(self, state):
+        headers = dict(state['headers'])
+        if state['cookie'] is not None:
+            headers['Cookie'] = state['cookie']
+        # connect lazily, the unpickled copy may never be used
+        self.__init__(state['ipv4'], headers, state['timeout'], state['verbose_errors'], connect=False)
 
     def call(self, call, **kw):
         # ensure call is the first parameter argument
@@ -255,13 +477,34 @@ class BaseHelloApp(_hello._BaseHelloApp):
         url = self._urlbase + query
         return self._send_request_raw(url)
 
+    def _timed_parse(self, rsp, parser, parse, arg):
+        metrics = self.metrics
+        if metrics is None:
+            return parse(arg)
+        start = perf_counter()
+        obj = parse(arg)
+        metrics.observe_parse(getattr(rsp, 'hello_call', None), self._ipv4, parser, perf_counter() - start)
+        return obj
+
+    def _parse_xml(self, rsp, cls=None):
+        return self._timed_parse(rsp, 'xml', cls or HelloXML, rsp)
+
+    def _parse_json(self, rsp):
+        return self._timed_parse(rsp, 'json', json_loads, rsp.read().decode('utf-8'))
+
     def _validate_rsp(self, rsp, json):
-        if json:
-            data = json_loads(rsp.read().decode())
-            return self._verify_json(data)
-        else:
-            data = HelloXML(rsp)
-            return self._verify_xml(data)
+        try:
+            if json:
+                return self._verify_json(self._parse_json(rsp))
+            else:
+                return self._verify_xml(self._parse_xml(rsp))
+        except HelloError as e:
+            if self.metrics is not None:
+                self.metrics.observe_error(getattr(rsp, 'hello_call', None), self._ipv4, e)
+            raise
+
+    def _getfile_error(self, url, rsp):
+        return ServerCallError("Download of %s failed: %d %s" % (url, rsp.status_code, rsp.reason))
 
     def _verify_xml(self, xml):
         if not xml.result:
@@ -365,6 +608,77 @@ class BaseHelloApp(_hello._BaseHelloApp):
 #         return self.call_validate('setpumpsample', val1=mode, val2=val)
 
 
+def _parse_report_reply(body):
+    """ getReport uses a different webserver, and chen used
+    a different json message structure, so we have to check
+    for errors manually.
+
+    @param body: raw response body
+    @type body: bytes
+    @return: name of the generated report file
+    @rtype: str
+    """
+    data = json_loads(body.decode())
+    message = data['message']
+    if not message:
+        err = data['error']
+        if err.startswith("No user associated"):
+            raise NotLoggedInError(err)
+        raise ServerCallError(err)
+    return message
+
+
+def _not_logged_in(rsp):
+    """ Whether the reply is the server complaining about the session,
+    in any of the formats that can come in (xml, json, getReport json).
+    Error replies are short, so long replies aren't searched. """
+    content = getattr(rsp, 'content', None)
+    return content is not None and len(content) < 2048 and b"No user associated" in content
+
+
+def _iter_config_changes(changes):
+    """ Accept {group: {name: val}} or an iterable of (group, name, val) """
+    if isinstance(changes, dict):
+        for group, names in changes.items():
+            for name, val in names.items():
+                yield group, name, val
+    else:
+        yield from changes
+
+
+def _lookup_config(cfg, group, name):
+    """ Find (group, name) in a getConfig dict, forgiving
+    differences in case and url sanitizing.
+    @return: (group key, name key) as they appear in cfg
+    """
+    if group not in cfg:
+        for g in cfg:
+            if g.lower() == group.lower():
+                group = g
+                break
+        else:
+            raise KeyError(group)
+    names = cfg[group]
+    if name not in names:
+        want = name.lower(), sanitize_url(name).lower()
+        for n in names:
+            if sanitize_url(n).lower() in want:
+                name = n
+                break
+        else:
+            raise KeyError(name)
+    return group, name
+
+
+def _config_equal(current, val, tol=1e-4):
+    """ Server echoes numbers back rounded and typed however
+    it likes, so compare numerically when both sides allow it. """
+    try:
+        return math.isclose(float(current), float(val), rel_tol=1e-6, abs_tol=tol)
+    except (TypeError, ValueError):
+        return str(current) == str(val)
+
+
 def lowercase_methods(cls):
     from types import FunctionType
     lower = {}
@@ -376,34 +690,256 @@ def lowercase_methods(cls):
     return cls
 
 
+def _cached_call(call):
+    """ Serve the decorated method from self._cache when caching
+    is enabled (see HelloApp.enable_cache). `call` is the cache key
+    name, so that lowercase aliases share entries.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(self, *args, **kw):
+            cache = self._cache
+            if cache is None or kw:
+                return f(self, *args, **kw)
+            key = (call,) + args
+            hit, val = cache.get(key)
+            if hit:
+                return val
+            val = f(self, *args)
+            cache.put(key, val)
+            return val
+        return wrapper
+    return decorator
+
+
+def _invalidates(*calls):
+    """ Drop cached results and snapshots for `calls` after the
+    decorated method runs, whether or not it succeeded (if it
+    failed we can't know what state the server is in). """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(self, *args, **kw):
+            try:
+                return f(self, *args, **kw)
+            finally:
+                if self._cache is not None:
+                    self._cache.invalidate(*calls)
+                if self._snapshots is not None:
+                    # "call.variant" snapshots go with "call"
+                    for key, snapshot in self._snapshots.items():
+                        if key.split(".", 1)[0] in calls:
+                            snapshot.invalidate()
+        return wrapper
+    return decorator
+
+
+def _snapshot_call(call):
+    """ Route the decorated (argument-less) method through
+    self._snapshots[call] when snapshots are enabled (see
+    HelloApp.enable_snapshots).
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(self):
+            snapshots = self._snapshots
+            if snapshots is None:
+                return f(self)
+            return snapshots[call].get(f, self)
+        return wrapper
+    return decorator
+
+
 @lowercase_methods
 class HelloApp(BaseHelloApp):
 
-    def __init__(self, ipv4, headers=None, timeout=socket.getdefaulttimeout(), verbose_errors=False):
-        super().__init__(ipv4, headers, timeout, verbose_errors)
-        self._user = ""
-        self._password = ""
+    def __init__(self, ipv4, headers=None, timeout=socket.getdefaulttimeout(), verbose_errors=False, connect=True):
+        super().__init__(ipv4, headers, timeout, verbose_errors, connect=connect)
+        self._cache = None
+        self._snapshots = None
+        self._batch_catalog = None
+        self._catalog_lock = threading.Lock()
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        session = self._session
+        state['user'] = session.user
+        state['password'] = session.password
+        state['login_reply'] = session.login_reply
+        # monotonic clocks don't carry across processes, idle time does
+        state['idle'] = session.idle()
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        session = self._session
+        if state['user'] is not None:
+            session.logged_in(state['user'], state['password'], state['login_reply'])
+            session.logged_in_at = None
+            session.last_used = None if state['idle'] is None else monotonic() - state['idle']
 
-    def login(self, user='user1', pwd='12345'):
-        query = "?&call=login&val1=%s&val2=%s&json=1" % (user, pwd)
-        rsp = self.send_request(query)
-        return self._validate_rsp(rsp, True)
+    @property
+    def session(self):
+        """
+        @rtype: Session
+        """
+        return self._session
+
+    def share_session(self, other):
+        """ Use the login of `other` (another HelloApp for the same
+        reactor) from now on, so that both stay logged in together. """
+        self._session = other._session
+
+    def relogin(self):
+        """ Log in again with the credentials of the last login,
+        eg from a worker whose inherited session expired. """
+        user = self._session.user
+        if user is None:
+            raise NotLoggedInError("No previous login to repeat")
+        return self.login(user, self._session.password, force=True)
+
+    def _send_request_raw(self, url, headers=None, stream=False):
+        """ Calls go out as usual, except once there's been a login:
+
+        - a session that's about to expire is refreshed first
+        - a call that bounces because the session lapsed anyway is
+          sent again (once) after logging back in
+
+        Threads that hit a lapsed session together share one login.
+        A streamed reply is only checked for a lapsed session if it's
+        an error, so that a download's body is left alone.
+        """
+        session = self._session
+        if session.user is None or "call=login&" in url or "call=logout" in url:
+            return super()._send_request_raw(url, headers, stream)
+        logins = session.logins
+        if session.expiring():
+            self._refresh_login(logins)
+            logins = session.logins
+        rsp = super()._send_request_raw(url, headers, stream)
+        if stream and rsp.status_code < 300 or not _not_logged_in(rsp):
+            session.touch()
+            return rsp
+        self._refresh_login(logins)
+        with session.lock:
+            session.replays += 1
+        return super()._send_request_raw(url, headers, stream)
+
+    def _refresh_login(self, logins):
+        """ Log in again, unless someone else already did since
+        session.logins was `logins`. """
+        session = self._session
+        with session.login_lock:
+            if session.logins == logins and session.user is not None:
+                self.login(session.user, session.password, force=True)
+
+    def enable_snapshots(self, window=0.5):
+        """ Share getMainValues and getDORAValues results between
+        callers. A result less than `window` seconds old is handed
+        out again without a server call, and concurrent callers
+        share a single in-flight request. Every convenience accessor
+        built on gpmv/getDORAValues (getdopv, batchrunning, ...)
+        reads from the same snapshot.
+        """
+        self._snapshots = {
+            'getMainValues': SharedSnapshot(window),
+            'getMainValues.compact': SharedSnapshot(window),
+            'getDORAValues': SharedSnapshot(window),
+        }
+
+    def disable_snapshots(self):
+        self._snapshots = None
+
+    def snapshot_info(self):
+        if self._snapshots is None:
+            return None
+        return {k: v.stats() for k, v in self._snapshots.items()}
+
+    def enable_cache(self, ttls=None):
+        """ Cache results of read-mostly calls (getConfig, getVersion,
+        getRecipes, getBatches, getmodelsize, reactorname) for a
+        per-call time to live. Calls that change server state
+        (setconfig, startbatch, endbatch, runrecipe) invalidate
+        the affected entries.
+
+        @param ttls: call name -> seconds. See ResponseCache.default_ttls.
+        @return: the cache, for access to its hit/miss counters
+        @rtype: ResponseCache
+        """
+        self._cache = ResponseCache(ttls)
+        return self._cache
+
+    def disable_cache(self):
+        self._cache = None
+
+    def cache_info(self):
+        if self._cache is None:
+            return None
+        return self._cache.stats()
+
+    def _parse_shared(self, rsp, cls=None):
+        """ _parse_xml, but with the cache enabled an unchanged reply
+        hands back the object parsed last time. Only for calls whose
+        result is cached anyway. """
+        cls = cls or HelloXML
+        if self._cache is None:
+            return self._parse_xml(rsp, cls)
+        return self._timed_parse(rsp, 'xml', lambda raw: self._cache.parse(raw, cls), rsp.read())
+
+    def login(self, user='user1', pwd='12345', force=False):
+        """
+        @param force: log in even if already logged in as `user`. Without
+                      it, a session that isn't near expiry is kept and
+                      the reply of the login that started it returned.
+        """
+        # one login at a time per session, or threads logging in
+        # together can end up holding each other's cookies
+        session = self._session
+        with session.login_lock:
+            if not force and session.fresh(user, pwd):
+                return session.login_reply
+            query = "?&call=login&val1=%s&val2=%s&json=1" % (user, pwd)
+            rsp = self.send_request(query)
+            rv = self._validate_rsp(rsp, True)
+            session.logged_in(user, pwd, rv)
+            return rv
 
     def logout(self):
         query = "?&call=logout"
         rsp = self.send_request(query)
+        self._session.logged_out()
         return self._validate_rsp(rsp, False)
 
+    def getLoginStatus(self):
+        """ Ask the server whether this session is logged in. A session
+        the server has dropped is forgotten here too (the credentials
+        are kept for relogin).
+
+        @rtype: bool
+        """
+        # straight to the server, this is the one call that mustn't
+        # log back in by itself
+        query = "?&call=getLoginStatus&Loader=Verifying..."
+        rsp = super()._send_request_raw(self._urlbase + query)
+        try:
+            self._validate_rsp(rsp, False)
+        except NotLoggedInError:
+            self._session.last_used = None
+            return False
+        self._session.touch()
+        return True
+
+    @_invalidates('getBatches', 'getDORAValues')
     def startbatch(self, name):
         name = name.replace(" ", "+")
         query = "?&call=setStartBatch&val1=%s" % name
         rsp = self.send_request(query)
         return self._validate_rsp(rsp, False)
 
+    @_invalidates('getBatches', 'getDORAValues')
     def endbatch(self):
         query = "?&call=setendbatch"
         rsp = self.send_request(query)
-        xml = HelloXML(rsp.read())
+        xml = self._parse_xml(rsp)
         if not xml.result:
             if "no batch currently running" in xml.data.lower():
                 return True
@@ -414,7 +950,7 @@ class HelloApp(BaseHelloApp):
     def getAlarms(self, mode='first', val1='100', val2='1'):
         query = "?&call=getAlarms&mode=%s&val1=%s&val2=%s" % (mode, val1, val2)
         rsp = self.send_request(query)
-        xml = HelloXML(rsp)
+        xml = self._parse_xml(rsp)
         if not xml.result:
             raise ServerCallError(xml.msg)
         return xml.data['Alarms']
@@ -422,7 +958,7 @@ class HelloApp(BaseHelloApp):
     def getAlarmList(self):
         query = "?&call=getAlarmList"
         rsp = self.send_request(query)
-        xml = HelloXML(rsp)
+        xml = self._parse_xml(rsp)
         if not xml.result:
             raise ServerCallError(xml.msg)
         return xml.data['cluster']
@@ -430,11 +966,27 @@ class HelloApp(BaseHelloApp):
     def getUnAckCount(self):
         query = "?&call=getUnAckCount"
         rsp = self.send_request(query)
-        xml = HelloXML(rsp)
+        xml = self._parse_xml(rsp)
         if not xml.result:
             raise ServerCallError(xml.msg)
         return int(xml.data)
 
+    def clearAlarm(self, id):
+        query = "?&call=clearAlarm&val1=%s" % id
+        rsp = self.send_request(query)
+        return self._validate_rsp(rsp, False)
+
+    def clearAlarmsByType(self, type):
+        query = "?&call=clearAlarmsByType&val1=%s" % type
+        rsp = self.send_request(query)
+        return self._validate_rsp(rsp, False)
+
+    def clearAllAlarms(self):
+        query = "?&call=clearAllAlarms"
+        rsp = self.send_request(query)
+        return self._validate_rsp(rsp, False)
+
+    @_invalidates('getBatches', 'getDORAValues')
     def runrecipe(self, name):
         query = "?&call=runRecipe&recipe=%s" % name.replace(" ", "_")
         rsp = self.send_request(query)
@@ -452,59 +1004,189 @@ class HelloApp(BaseHelloApp):
         url = "/webservice/getReport/?&mode=%s&type=%s&val1=%s&val2=%s&timeout=%s" % \
                 (mode, type, val1, val2, timeout)
         rsp = self._send_request_raw(url)
+        return _parse_report_reply(rsp.read())
 
-        # getreport uses a different webserver
-        # and chen used a different json message structure
-        # ??? so we have to check for errors manually
-        data = json_loads(rsp.read().decode())
-        message = data['message']
-        if not message:
-            err = data['error']
-            if err.startswith("No user associated"):
-                raise NotLoggedInError(err)
-            raise ServerCallError(err)
-        return message
-
+    @_cached_call('getBatches')
     def getBatches(self):
         query = "?&call=getBatches&loader=Loading+batches..."
         rsp = self.send_request(query)
-        xml = BatchListXML(rsp)
+        xml = self._parse_shared(rsp, BatchListXML)
+        return self._verify_xml(xml)
+
+    def getBatchesAfter(self, min_id, reparse=()):
+        """ getBatches, but only batches with an ID above min_id (plus
+        any in `reparse`) are parsed. The whole list still comes over
+        the wire; the server has no way to ask for part of it.
+
+        @rtype: BatchListXML
+        """
+        query = "?&call=getBatches&loader=Loading+batches..."
+        rsp = self.send_request(query)
+        xml = self._parse_xml(rsp, lambda r: BatchListXML(r, min_id=min_id, reparse=reparse))
         return self._verify_xml(xml)
 
+    def batch_catalog(self, path=None, refresh=True, persist=False):
+        """ This reactor's BatchCatalog, created on first use. Unless
+        given a path or persist, it's only kept in memory.
+
+        @param path: catalog file. Only used when the catalog is first
+                     created.
+        @param persist: keep the catalog in the default file, see
+                        BatchCatalog. Also only used on first use.
+        @param refresh: bring the catalog up to date before returning it
+        @rtype: hello.batch_catalog.BatchCatalog
+        """
+        with self._catalog_lock:
+            if self._batch_catalog is None:
+                from hello.batch_catalog import BatchCatalog
+                self._batch_catalog = BatchCatalog(self, path, persist)
+        if refresh:
+            self._batch_catalog.refresh()
+        return self._batch_catalog
+
     def getreport_byname(self, type, name):
         return self.getReport('byBatch', type, name)
 
-    def getdatareport_bybatchid(self, val1):
+    def getdatareport_bybatchid(self, val1, dest=None, **kw):
         """
-        @return: report as a byte string
+        @param dest: see getfile
+        @return: report as a byte string, or whatever getfile
+                 returns for `dest`.
         @rtype: bytes
         """
         fname = self.getReport('byBatch', 'process_data', val1)
-        return self.getfile(fname)
+        return self.getfile(fname, dest, **kw)
 
-    def getreport_bydate(self, type, d1, d2):
+    def getreport_bydate(self, type, d1, d2, dest=None, **kw):
         s1 = int(d1.timestamp())
         s2 = int(d2.timestamp())
         fname = self.getReport('byDate', type, s1, s2)
-        return self.getfile(fname)
+        return self.getfile(fname, dest, **kw)
+
+    def export_batches(self, batch_ids, folder, type='process_data', force=False, **kw):
+        """ Export reports for many batches into `folder`, generating
+        the next report while the last one downloads. Reports already
+        exported there and unchanged since are skipped.
 
-    def getfile(self, fname):
+        @param kw: passed to ReportExporter
+        @return: list of ExportResult
+        """
+        from hello.report_export import ReportExporter
+        with ReportExporter(folder, **kw) as exporter:
+            return exporter.export_batches(self, batch_ids, type, force)
+
+    def getfile(self, fname, dest=None, chunk_size=65536, progress=None, retries=3):
+        """
+        @param fname: file name returned by getReport
+        @param dest: None to return the file contents as bytes. Otherwise
+                     a filename or a writable file-like object (anything
+                     with a write() method) to stream the file into.
+        @param chunk_size: bytes per read when streaming
+        @param progress: optional callback progress(nbytes, total, rate)
+                         called after every chunk. total is None if the
+                         server didn't say, rate is bytes/sec.
+        @param retries: how many times to resume an interrupted download
+        @return: bytes if dest is None, else number of bytes written to
+                 a file-like `dest`, or the filename if `dest` is a filename.
+        @raise ServerCallError: if the server doesn't have the file (or
+                                replies with any other error status).
+                                Nothing is written to `dest`.
+
+        When streaming to a filename, the download goes to `dest + ".part"`
+        and is renamed on completion. A leftover .part file from an earlier
+        interrupted call is resumed rather than started over.
+        """
         # chen fucked up the url on the new protocol so bad I had to
         # restructure helloapp to sensibly work with it
         # and then fucked it up again in 3.0
         # /getfile/?&getfile? really? really?
         url = "/webservice/getfile/?&getfile=" + fname
-        rsp = self._send_request_raw(url)
-        return rsp.read()
-
-    def getdatareport_bybatchname(self, name):
-        xml = self.getBatches()
+        if dest is None:
+            rsp = self._send_request_raw(url)
+            if rsp.status_code != 200:
+                raise self._getfile_error(url, rsp)
+            return rsp.read()
+        elif hasattr(dest, 'write'):
+            return self._stream_download(url, dest, 0, chunk_size, progress, retries)
+
+        part = dest + ".part"
+        try:
+            offset = os.path.getsize(part)
+        except OSError:
+            offset = 0
+        with open(part, 'ab') as f:
+            self._stream_download(url, f, offset, chunk_size, progress, retries)
+        os.replace(part, dest)
+        return dest
+
+    def _stream_download(self, url, sink, offset, chunk_size, progress, retries):
+        """ Stream `url` into sink.write(), picking up from `offset`
+        bytes in. Interrupted transfers are resumed with a Range
+        request. If the server ignores the Range header, the bytes
+        we already have are skipped instead of written twice.
+
+        @return: total bytes written (including `offset`)
+        """
+        start = time()
+        done = offset
+        total = None
+        attempt = 0
+        while True:
+            headers = {'Range': 'bytes=%d-' % done} if done else None
+            try:
+                rsp = self._send_request_raw(url, headers, stream=True)
+                try:
+                    status = rsp.status_code
+                    if status == 416 and done:
+                        # "range not satisfiable" - we already have all of it
+                        return done
+                    if status not in (200, 206):
+                        # error pages aren't the file, and aren't worth retrying
+                        raise self._getfile_error(url, rsp)
+                    skip = 0
+                    if status == 206:
+                        crange = rsp.headers.get('Content-Range', '')
+                        size = crange.rpartition('/')[2]
+                        if size.isdigit():
+                            total = int(size)
+                    else:
+                        skip = done
+                        clen = rsp.headers.get('Content-Length')
+                        if clen is not None:
+                            total = int(clen)
+                    for chunk in rsp.iter_content(chunk_size):
+                        if skip:
+                            if len(chunk) <= skip:
+                                skip -= len(chunk)
+                                continue
+                            chunk = chunk[skip:]
+                            skip = 0
+                        sink.write(chunk)
+                        done += len(chunk)
+                        if progress is not None:
+                            elapsed = time() - start
+                            progress(done, total, (done - offset) / elapsed if elapsed else 0.0)
+                finally:
+                    rsp.close()
+                if total is None or done >= total:
+                    return done
+                err = BadConnection("Download ended early: got %d of %d bytes" % (done, total))
+            except (OSError, HTTPException) as e:
+                err = e
+            attempt += 1
+            if attempt > retries:
+                raise err
+            self._logger.warning("Resuming download of %s at byte %d: %s", url, done, err)
+
+    def getdatareport_bybatchname(self, name, dest=None, **kw):
+        xml = self.batch_catalog()
         try:
             id = xml.getbatchid(name)
         except KeyError:
             raise HelloError("Bad batch name given- batch not found: " + name) from None
-        return self.getdatareport_bybatchid(id)
+        return self.getdatareport_bybatchid(id, dest, **kw)
 
+    @_invalidates('getMainValues')
     def setdo(self, mode, n2, o2=None):
         # Val1 = N2 sp (or auto sp)
         # Val2 = O2 sp (unused if auto mode)
@@ -516,6 +1198,7 @@ class HelloApp(BaseHelloApp):
         rsp = self.send_request(query)
         return self._validate_rsp(rsp, False)
 
+    @_invalidates('getMainValues')
     def setph(self, mode, co2, base=None):
         # Val1 = CO2 sp (or auto sp)
         # Val2 = base sp (unused if auto mode)
@@ -526,21 +1209,25 @@ class HelloApp(BaseHelloApp):
         rsp = self.send_request(query)
         return self._validate_rsp(rsp, False)
 
+    @_invalidates('getMainValues')
     def setmg(self, mode, val):
         query = "?&call=set&group=maingas&mode=%s&val1=%s" % (mode, val)
         rsp = self.send_request(query)
         return self._validate_rsp(rsp, False)
 
+    @_invalidates('getMainValues')
     def setag(self, mode, val):
         query = "?&call=set&group=agitation&mode=%s&val1=%s" % (mode, val)
         rsp = self.send_request(query)
         return self._validate_rsp(rsp, False)
 
+    @_invalidates('getMainValues')
     def settemp(self, mode, val):
         query = "?&call=set&group=temperature&mode=%s&val1=%s" % (mode, val)
         rsp = self.send_request(query)
         return self._validate_rsp(rsp, False)
 
+    @_invalidates('getMainValues')
     def set_mode(self, group, mode, val, val2=None):
         query = "?&call=set&group=%s&mode=%s&val1=%s" % (group, mode, val)
         if val2 is not None:
@@ -548,10 +1235,11 @@ class HelloApp(BaseHelloApp):
         rsp = self.send_request(query)
         return self._validate_rsp(rsp, False)
 
+    @_snapshot_call('getDORAValues')
     def getDORAValues(self):
         query = "?&call=getDORAValues"
         rsp = self.send_request(query)
-        xml = HelloXML(rsp)
+        xml = self._parse_xml(rsp)
 
         if not xml.result:
             raise ServerCallError(xml.msg)
@@ -567,15 +1255,33 @@ class HelloApp(BaseHelloApp):
     def reciperunning(self):
         return self.getDORAValues()['Sequence'] != 'Idle'
 
+    @_cached_call('reactorname')
     def reactorname(self):
         return self.getDORAValues()['Machine Name']
 
-    def getMainValues(self):
+    def getMainValues(self, compact=False):
+        """
+        @param compact: return a mainvalues.MainValues (a flat array
+                        plus shared key layout) instead of nested dicts
+        """
+        if compact:
+            return self._main_values_compact()
+        return self._main_values()
+
+    @_snapshot_call('getMainValues')
+    def _main_values(self):
         query = "?&call=getMainValues&json=true"
         rsp = self.send_request(query)
-        mv = json_loads(rsp.read().decode('utf-8'))
+        mv = self._parse_json(rsp)
         return mv
 
+    @_snapshot_call('getMainValues.compact')
+    def _main_values_compact(self):
+        from hello.mainvalues import MainValues
+        query = "?&call=getMainValues&json=true"
+        rsp = self.send_request(query)
+        return self._timed_parse(rsp, 'json', MainValues.decode, rsp.read())
+
     def loadbag(self, expirationDate='', part='', serial='', pham='', phab='', phat='', 
                 phbm='', phbb='', phbt='', doam='', doab='', dobm='', dobb=''):
         raise NotImplementedError
@@ -584,24 +1290,122 @@ class HelloApp(BaseHelloApp):
     gmv = getMainValues
     gpmv = getMainValues
 
+    @_invalidates('getConfig', 'reactorname')
     def setconfig(self, group, name, val):
         name = sanitize_url(name)
         query = "?&call=setconfig&group=%s&name=%s&val=%s" % (group, name, str(val))
         rsp = self.send_request(query)
         return self._validate_rsp(rsp, False)
 
+    def apply_config(self, changes, workers=4, rollback=True):
+        """ Apply many setconfig changes as one transaction.
+
+        Reads the config once, sends setconfig only for values that
+        actually differ, spread over `workers` connections sharing
+        this app's login, and reads the config once more to verify.
+        If anything failed to apply and `rollback` is set, every
+        changed value is put back the way it was.
+
+        @param changes: {group: {name: val}}, or iterable of (group, name, val)
+        @param workers: number of connections to send with
+        @param rollback: restore the original values on failure
+        @return: {(group, name): (old, new)} for each value changed
+        @raises ConfigApplyError: on unknown variables (before anything
+                                  is sent) or failure to apply
+        """
+        if self._cache is not None:
+            self._cache.invalidate('getConfig')
+        cfg = self.getConfig()
+
+        todo = OrderedDict()
+        for group, name, val in _iter_config_changes(changes):
+            try:
+                key = _lookup_config(cfg, group, name)
+            except KeyError:
+                raise ConfigApplyError("Unknown config variable: %s: %s" % (group, name)) from None
+            old = cfg[key[0]][key[1]]
+            if _config_equal(old, val):
+                todo.pop(key, None)
+            else:
+                todo[key] = (old, val)
+        if not todo:
+            return {}
+
+        failed = self._setconfig_many([(k, new) for k, (old, new) in todo.items()], workers)
+
+        if self._cache is not None:
+            self._cache.invalidate('getConfig')
+        try:
+            after = self.getConfig()
+        except HelloError as e:
+            after = None
+            verify_error = e
+        for key, (old, new) in todo.items():
+            if key in failed:
+                continue
+            if after is None:
+                failed[key] = verify_error
+            elif not _config_equal(after[key[0]][key[1]], new):
+                failed[key] = after[key[0]][key[1]]
+
+        if not failed:
+            return dict(todo)
+
+        rolled_back = False
+        if rollback:
+            undo = [(k, old) for k, (old, new) in todo.items()
+                    if after is None or not _config_equal(after[k[0]][k[1]], old)]
+            rolled_back = not self._setconfig_many(undo, workers)
+        raise ConfigApplyError("Failed to apply %d of %d config changes%s" %
+                               (len(failed), len(todo), " (rolled back)" if rolled_back else ""),
+                               failed, rolled_back)
+
+    def _setconfig_many(self, items, workers):
+        """
+        @param items: list of ((group, name), val)
+        @return: {(group, name): exception} for the calls that failed
+        """
+        failed = {}
+        if workers <= 1 or len(items) <= 1:
+            for key, val in items:
+                try:
+                    self.setconfig(key[0], key[1], val)
+                except (HelloError, OSError, PoolTimeout) as e:
+                    failed[key] = e
+            return failed
+
+        # the connection pool gives each worker its own connection,
+        # so calls actually go out in parallel
+        from concurrent.futures import ThreadPoolExecutor
+        nworkers = min(workers, len(items))
+        with ThreadPoolExecutor(nworkers) as pool:
+            futures = [(key, pool.submit(self.setconfig, key[0], key[1], val)) for key, val in items]
+            for key, fut in futures:
+                try:
+                    fut.result()
+                except (HelloError, OSError, PoolTimeout) as e:
+                    failed[key] = e
+
+        if self._cache is not None:
+            self._cache.invalidate('getConfig', 'reactorname')
+        return failed
+
+    @_invalidates('getMainValues')
     def setpumpa(self, mode=0, val=0):
         query = "?&call=setpumpa&val1=%d&val2=%d" % (mode, val)
         return self._validate_rsp(self.send_request(query), False)
 
+    @_invalidates('getMainValues')
     def setpumpb(self, mode=0, val=0):
         query = "?&call=setpumpb&val1=%d&val2=%d" % (mode, val)
         return self._validate_rsp(self.send_request(query), False)
 
+    @_invalidates('getMainValues')
     def setpumpc(self, mode=0, val=0):
         query = "?&call=setpumpc&val1=%d&val2=%d" % (mode, val)
         return self._validate_rsp(self.send_request(query), False)
 
+    @_invalidates('getMainValues')
     def setpumpsample(self, mode=0, val=0):
         query = "?&call=setpumpsample&val1=%d&val2=%d" % (mode, val)
         return self._validate_rsp(self.send_request(query), False)
@@ -664,20 +1468,22 @@ class HelloApp(BaseHelloApp):
                 raise ServerCallError(m)
 
 
-        xml = HelloXML(rsp)
+        xml = self._parse_xml(rsp)
         if not xml.result:
             raise ServerCallError(xml.data)
         return float(xml.data)
 
+    @_cached_call('getVersion')
     def getVersion(self):
         query = "?&call=getVersion"
         rsp = self.send_request(query)
-        xml = HelloXML(rsp)
+        xml = self._parse_shared(rsp)
         if not xml.result:
             raise ServerCallError(xml.data)
         return xml.data['Versions']
 
     # Convenience functions
+    @_cached_call('getmodelsize')
     def getmodelsize(self):
         return int(self.getVersion()['Model'][4:])
 
@@ -708,10 +1514,11 @@ class HelloApp(BaseHelloApp):
         temp = self.gpmv()['temperature']
         return temp['pv']['man']
 
+    @_cached_call('getConfig')
     def getConfig(self):
         query = "?&call=getConfig"
         rsp = self.send_request(query)
-        xml = HelloXML(rsp)
+        xml = self._parse_shared(rsp)
         self._verify_xml(xml)
         # James renamed the clusters to SV_Air
         # and SV_Mag to make it easier for him
@@ -725,18 +1532,30 @@ class HelloApp(BaseHelloApp):
         except KeyError:
             return xml.data['System_Variables_Air']
 
+    @_cached_call('getRecipes')
     def getRecipes(self, loader="Loading+recipes"):
         query = "?&call=getRecipes&loader=" + loader
         rsp = self.send_request(query)
-        xml = HelloXML(rsp)
+        xml = self._parse_shared(rsp)
         if not xml.result:
             raise ServerCallError(xml.msg)
         return xml.data.split(",")
         
-    def getTrendData(self, span, group):
+    def getTrendData(self, span, group, as_arrays=False):
+        """
+        @param span: "15min", "2hr", "12hr", "24hr", "72hr" or "7day"
+        @param group: "agitation", "ph", "do" or "temperature"
+        @param as_arrays: return {name: numpy array} for each array in
+                          the reply instead of the decoded json.
+                          See hello.trend for the details.
+        """
         query = "?&call=getTrendData&span=%s&group=%s&json=1" % (span, group)
         rsp = self.send_request(query)
-        return self._validate_rsp(rsp, True)
+        reply = self._validate_rsp(rsp, True)
+        if not as_arrays:
+            return reply
+        from hello.trend import trend_arrays
+        return trend_arrays(reply)
 
     def __repr__(self):
         h = self._connection.host or ""
@@ -775,10 +1594,11 @@ class HelloXML():
         }
 
     def _init(self, root):
+        self._init_data(self.begin_parse(root))
+
+    def _init_data(self, data):
         self._parsed = False
 
-        # begin
-        data = self.begin_parse(root)
         self.parse_dict = data['Reply']
         self.result = self.parse_dict['Result'] == 'True'
         self.data = self.msg = self.parse_dict['Message']
@@ -802,18 +1622,17 @@ class HelloXML():
 
     def parse(self, e, ns):
         name = e.tag
-        children = list(e)
-        if not children:
+        if not len(e):
             ns[name] = e.text
         else:
             val = {}
-            self.parse_children(children, val)
+            self.parse_children(e, val)
             ns[name] = val
 
     def parse_children(self, elems, ns):
         """
         @param elems: elements
-        @type elems: list[xml.etree.ElementTree.Element]
+        @type elems: collections.Iterable[xml.etree.ElementTree.Element]
         """
         get_parser = self._parse_types.get
         for c in elems:
@@ -867,7 +1686,14 @@ class BatchEntry():
     easier to create a batch object and then manipulate
     lists of batch objects, rather than trying to slopily
     move them around in any other form.
+
+    Start and stop times are kept as the server's strings
+    and only run through strptime when first accessed, since
+    most callers never look at them. A batch that's still
+    running has no stop time; its stop_time is "now".
     """
+    __slots__ = ('id', 'name', 'serial_number', 'user', 'start_str', 'stop_str',
+                 'product_number', 'rev', '_start_time', '_stop_time')
 
     def __init__(self, id, name='', serial_number=0, user='', start_time=0, stop_time=0,
                  product_number=0, rev=0):
@@ -876,19 +1702,39 @@ class BatchEntry():
         self.serial_number = serial_number
         self.user = user
 
-        self.start_time = _parse_date(start_time)
         if stop_time == 'None':
             stop_time = None
-        stop_time = _parse_date(stop_time) if stop_time else datetime.datetime.now()
-        self.stop_time = stop_time
-
-        assert self.stop_time >= self.start_time, (self.start_time, self.stop_time)  # server's fault not mine
-        # if self.stop_time < self.start_time:
-            # self.stop_time = self.start_time + datetime.timedelta(days=1)
+        self.start_str = start_time
+        self.stop_str = stop_time
+        self._start_time = self._stop_time = None
 
         self.product_number = product_number
         self.rev = rev
 
+    @property
+    def start_time(self):
+        if self._start_time is None:
+            t = self.start_str
+            self._start_time = t if isinstance(t, datetime.datetime) else _parse_date(t)
+        return self._start_time
+
+    @property
+    def stop_time(self):
+        if self._stop_time is not None:
+            return self._stop_time
+        t = self.stop_str
+        if not t:
+            return datetime.datetime.now()
+        t = t if isinstance(t, datetime.datetime) else _parse_date(t)
+        assert t >= self.start_time, (self.start_time, t)  # server's fault not mine
+        self._stop_time = t
+        return t
+
+    @property
+    def running(self):
+        """ True if the batch hadn't ended when the list was fetched """
+        return not self.stop_str
+
     def __getitem__(self, item):
         """
         Let class pretend to be a dict for some internal use.
@@ -899,10 +1745,13 @@ class BatchEntry():
         except AttributeError:
             raise KeyError(key)
 
+    def astuple(self):
+        """ Constructor arguments, with times as the server's strings """
+        return (self.id, self.name, self.serial_number, self.user, self.start_str,
+                self.stop_str, self.product_number, self.rev)
+
     def copy(self):
-        cls = self.__class__
-        return cls(self.id, self.name, self.serial_number, self.user, self.start_time,
-                   self.stop_time, self.product_number, self.rev)
+        return self.__class__(*self.astuple())
 
     def __repr__(self):
         return "%s: id: %s name: %s user: %s start time: %s stop time: %s" % \
@@ -915,6 +1764,51 @@ class BatchListXML(HelloXML):
     a different parsing scheme, and its own class.
     """
 
+    def __init__(self, xml, min_id=None, reparse=()):
+        """
+        @param min_id: if given, skip batches with an ID at or
+                       below this, except for...
+        @param reparse: ...these IDs, which are always kept
+        """
+        self.min_id = min_id
+        self.reparse = frozenset(reparse)
+        # highest ID in the reply, whether or not it was skipped
+        self.last_id = None
+        if min_id is not None:
+            xml = self._prefilter(xml)
+        super().__init__(xml)
+
+    _batch_cluster = re.compile(rb"<Cluster>\s*<Name>Batch</Name>.*?</Cluster>", re.S)
+    _batch_id = re.compile(rb"<Name>ID</Name>\s*<Val>\s*(-?\d+)\s*</Val>")
+
+    def _prefilter(self, xml):
+        """ Cut skipped batches out of the raw reply, so that they
+        never even get tokenized. Batch clusters don't nest, so a
+        non-greedy match finds each one.
+        """
+        if isinstance(xml, str):
+            xml = xml.encode()
+        elif not isinstance(xml, bytes):
+            xml = xml.read()
+        chunks = []
+        pos = 0
+        for m in self._batch_cluster.finditer(xml):
+            idm = self._batch_id.search(xml, m.start(), m.end())
+            if idm is None:
+                # not what we expected, let the real parser sort it out
+                return xml
+            if self._keep(int(idm.group(1))):
+                continue
+            chunks.append(xml[pos:m.start()])
+            pos = m.end()
+        chunks.append(xml[pos:])
+        return b"".join(chunks)
+
+    def _keep(self, id):
+        if self.last_id is None or id > self.last_id:
+            self.last_id = id
+        return self.min_id is None or id > self.min_id or id in self.reparse
+
     def _init(self, root):
 
         self._parsed = False
@@ -925,49 +1819,59 @@ class BatchListXML(HelloXML):
         # fuck labview.
         dsize = root.find("./Message/Array/Dimsize")
         if dsize is not None and dsize.text == '0':
-            self.names_to_batches = {}
-            self.ids_to_batches = {}
-            self.max_id = None
-            self.parse_dict = {}
-            self.result = True
-            self._parsed = True
-            self.data = {}
+            self._init_empty()
         else:
-            data = self.begin_parse(root)
-
-            # Bad things happen if this code tries to proceed
-            # with a TrueBug response, so raise an error here.
-            if data['Reply']['Message'] == 'True':
-                raise TrueError()
-
-            self.parse_dict = data
-            self.reply = data['Reply']
-            self.result = self.reply['Result'] == 'True'
-
-            if self.result:
-                ids_to_batches = self.reply['Message']['Batches (cluster)']
-
-                # map names <-> ids
-                # note that many batches may have the same name.
-                # Newer names override older names,
-                # where 'newer' means 'higher id'
-                names_to_batches = {}
-                for entry in ids_to_batches.values():
-                    name = entry["Name"]
-                    id = int(entry['ID'])
-                    if name in names_to_batches:
-                        if id > int(names_to_batches[name]['ID']):
-                            names_to_batches[name] = entry
-                    else:
+            self._init_data(self.begin_parse(root))
+
+    def _init_empty(self):
+        self.names_to_batches = {}
+        self.ids_to_batches = {}
+        self.max_id = None
+        self.parse_dict = {}
+        self.result = True
+        self._parsed = True
+        self.data = {}
+
+    def _init_data(self, data):
+        self._parsed = False
+
+        # Bad things happen if this code tries to proceed
+        # with a TrueBug response, so raise an error here.
+        if data['Reply']['Message'] == 'True':
+            raise TrueError()
+
+        self.parse_dict = data
+        self.reply = data['Reply']
+        self.result = self.reply['Result'] == 'True'
+
+        if self.result:
+            ids_to_batches = self.reply['Message']['Batches (cluster)']
+            if not ids_to_batches:
+                # min_id skipped every batch
+                self._init_empty()
+                return
+
+            # map names <-> ids
+            # note that many batches may have the same name.
+            # Newer names override older names,
+            # where 'newer' means 'higher id'
+            names_to_batches = {}
+            for entry in ids_to_batches.values():
+                name = entry["Name"]
+                id = int(entry['ID'])
+                if name in names_to_batches:
+                    if id > int(names_to_batches[name]['ID']):
                         names_to_batches[name] = entry
+                else:
+                    names_to_batches[name] = entry
 
-                self.names_to_batches = names_to_batches
-                self.ids_to_batches = self.data = OrderedDict(sorted(ids_to_batches.items()))
-                self.max_id = max(self.ids_to_batches.keys())
-                self._parsed = True
-            else:
-                self.names_to_batches = self.ids_to_batches = {}
-                self.data = self.reply['Message']
+            self.names_to_batches = names_to_batches
+            self.ids_to_batches = self.data = OrderedDict(sorted(ids_to_batches.items()))
+            self.max_id = max(self.ids_to_batches.keys())
+            self._parsed = True
+        else:
+            self.names_to_batches = self.ids_to_batches = {}
+            self.data = self.reply['Message']
 
     def getbatches(self):
         return list(self.ids_to_batches.values())
@@ -1005,6 +1909,9 @@ class BatchListXML(HelloXML):
     def parse_batch(self, e):
         val = {}
         self.parse_children(e[2:], val)
+        return self._make_batch(val)
+
+    def _make_batch(self, val):
         g = val.get  # brevity
         b = BatchEntry(g('ID'), g('Name'), g('Serial Number'),
                        g('User'), g('Start Time'), g('Stop Time'),
@@ -1015,6 +1922,8 @@ class BatchListXML(HelloXML):
         cname = e[0].text
         if cname == 'Batch':
             val = self.parse_batch(e)
+            if not self._keep(val.id):
+                return
         else:
             val = {}
             self.parse_children(e[2:], val)
@@ -1,6 +1,4 @@
-import clipboard
 from hello.hello3 import open_hello, NotLoggedInError, HelloError
-from pysrc.snippets import unique_name
 from time import sleep, time
 from datetime import datetime
 import threading
@@ -62,12 +60,19 @@ _gmv_keys = [
 def print_keys(copy=True, silent=True):
     s = "keys = " + "[" + "\n    " + ",\n    ".join(repr(k) for k in _gmv_keys) + "\n]"
     if copy:
+        import clipboard
         clipboard.copy(s)
     if not silent:
         print(s)
     return s
 
 
+def unique_name(fn):
+    # pysrc only when there's a file to name
+    from pysrc.snippets import unique_name
+    return unique_name(fn)
+
+
 def now(t):
     return datetime.fromtimestamp(t).strftime("%m/%d/%y %I:%M:%S %p")
 
@@ -140,11 +145,13 @@ class _HLProtocol():
             self._buf.clear()
         
     def _call(self, f, *args, **kw):
-        while True:
-            try:
-                return f(*args, **kw)
-            except NotLoggedInError:
-                self._h.login()
+        # Once logged in, the app keeps the session alive and replays
+        # calls that bounce by itself. This only covers the first login.
+        try:
+            return f(*args, **kw)
+        except NotLoggedInError:
+            self._h.login()
+            return f(*args, **kw)
                 
     def add_vars(self, *va):
         wl = self._list_wl_from_wl()
@@ -1,11 +1,21 @@
 import json
-try:
-    import lxml
-    import lxml.etree as libxml
-except ImportError:
-    import xml.etree.ElementTree as libxml
 from collections import OrderedDict
 
+_libxml = None
+
+
+def _get_libxml():
+    # lxml if there is one, but only once something gets parsed
+    global _libxml
+    if _libxml is None:
+        try:
+            import lxml.etree as libxml
+        except ImportError:
+            import xml.etree.ElementTree as libxml
+        _libxml = libxml
+    return _libxml
+
+
 class LVType():
     def __init__(self, typ="LVType", name="unnamed", val=0):
         self.type = typ
@@ -262,11 +272,11 @@ def flatten(lv, sep=".", usevar=True):
     return rv
 
 def lv_parse_string(s):
-    return lv_parse(libxml.fromstring(s))
+    return lv_parse(_get_libxml().fromstring(s))
 fromstring = lv_parse_string
 
 def lv_parse_file(f):
-    return lv_parse(libxml.parse(f).getroot())
+    return lv_parse(_get_libxml().parse(f).getroot())
 fromfile = lv_parse_file
 
 def fromfn(fn):
@@ -0,0 +1,346 @@
+"""
+Compact getMainValues snapshots.
+
+getMainValues replies are dicts of dicts ({"agitation": {"pv": 30, ...},
+...}), around a hundred numbers in a few KB of python objects. Anything
+that keeps a history of them (loggers, PID analysis) keeps all of that
+alive. MainValues flattens a reply once into a float64 array, with the
+layout (dotted key -> index) held by a MainValuesSchema that's shared
+by every snapshot with the same keys:
+
+    mv = app.getMainValues(compact=True)
+    mv.agitation.pv
+    mv['agitation.pv']
+    mv['agitation']['pv']           # same as the dict form
+    mv.pick(['do.pv', 'do.sp'])     # float array, one fancy index
+
+Values keep their python type on the way out: keys whose value was an
+int or bool in the reply come back as ints or bools when read one at a
+time (or with tolist), and strings (or anything else that isn't a
+number, like a list) are kept as they are, next to the array. A schema
+is shared by replies with the same keys *and* the same value types, so
+a key that goes from 30.0 to 30, or from a number to a string, gets a
+new schema rather than being read back as the old type. A null reads
+back as None whatever its key's type. The most recently used
+max_schemas schemas are kept around for sharing.
+
+numpy is only imported when this module is.
+"""
+from collections import OrderedDict
+from json import loads as json_loads
+import sys
+import threading
+
+import numpy as np
+
+__author__ = 'Nathan Starkweather'
+
+_FLOAT, _INT, _BOOL, _STR = 'f', 'i', 'b', 's'
+
+
+class _Kinds(dict):
+    # kind by exact type (json only gives exact types). None is read
+    # as a float (NaN), anything else (lists...) is kept like a string
+    def __missing__(self, tp):
+        return _FLOAT if tp is type(None) else _STR
+
+
+_kinds = _Kinds({float: _FLOAT, int: _INT, bool: _BOOL, str: _STR})
+
+
+def _flatten(obj, prefix, keys, vals):
+    for k, v in obj.items():
+        if isinstance(v, dict):
+            _flatten(v, prefix + k + ".", keys, vals)
+        else:
+            keys.append(prefix + k)
+            vals.append(v)
+
+
+class MainValuesSchema():
+    """ Layout of a flattened getMainValues reply. One instance per
+    distinct set of keys and value types, see schema_for. """
+
+    def __init__(self, keys, kinds):
+        self.keys = tuple(keys)
+        self.kinds = tuple(kinds)
+        self.index = {k: i for i, k in enumerate(self.keys)}
+        self.groups = {}
+        for i, k in enumerate(self.keys):
+            group, _, name = k.rpartition(".")
+            self.groups.setdefault(group, {})[name] = i
+        # positions whose value isn't just a float, and where each
+        # one's value is in a snapshot's strings tuple
+        self.strings = [i for i, kind in enumerate(self.kinds) if kind == _STR]
+        self.string_pos = {i: n for n, i in enumerate(self.strings)}
+        self._indexers = {}
+        self._lock = threading.Lock()
+
+    def indexer(self, keys):
+        """ Index array for a subset of keys, cached per subset.
+
+        @param keys: dotted keys, in the order wanted
+        @rtype: numpy.ndarray
+        @raise KeyError: if a key isn't in this layout
+        """
+        return self.plan(keys)[0]
+
+    def plan(self, keys):
+        """ (index array, ints, fixups) for a subset of keys, cached
+        per subset. ints are the positions in the subset of int keys,
+        fixups the (position in the subset, index, kind) of the bool
+        and string keys. """
+        keys = tuple(keys)
+        plan = self._indexers.get(keys)
+        if plan is None:
+            plan = self._plan([self.index[k] for k in keys])
+            with self._lock:
+                self._indexers[keys] = plan
+        return plan
+
+    def _plan(self, idx):
+        kinds = self.kinds
+        ints = [n for n, i in enumerate(idx) if kinds[i] == _INT]
+        fixups = tuple((n, i, kinds[i]) for n, i in enumerate(idx) if kinds[i] in (_BOOL, _STR))
+        return np.array(idx, dtype=np.intp), ints, fixups
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __repr__(self):
+        return "<%s: %d keys>" % (self.__class__.__name__, len(self.keys))
+
+
+# schemas kept for sharing, least recently used first. Snapshots hold
+# on to their own, so dropping one here only costs a rebuild.
+max_schemas = 32
+_schemas = OrderedDict()
+_schemas_lock = threading.Lock()
+
+
+def schema_for(keys, vals):
+    """ The shared schema for a flattened reply's keys and value types.
+    The types are checked on every reply, so that a key changing type
+    gets a schema of its own instead of being read back as the type it
+    had first. """
+    layout = (tuple(keys), tuple(map(_kinds.__getitem__, map(type, vals))))
+    with _schemas_lock:
+        schema = _schemas.get(layout)
+        if schema is None:
+            schema = _schemas[layout] = MainValuesSchema(*layout)
+            while len(_schemas) > max_schemas:
+                _schemas.popitem(False)
+        else:
+            _schemas.move_to_end(layout)
+    return schema
+
+
+def _intern(v):
+    return sys.intern(v) if isinstance(v, str) else v
+
+
+def _to_float(v):
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _convert(v, kind):
+    if v != v:  # nan, from a null or a non-number
+        return None
+    if kind == _INT:
+        return int(v) if v.is_integer() else v
+    if kind == _BOOL:
+        return bool(v)
+    return v
+
+
+class _Group():
+    """ One group ("agitation", ...) of a MainValues """
+    __slots__ = ('_mv', '_names')
+
+    def __init__(self, mv, names):
+        self._mv = mv
+        self._names = names
+
+    def __getitem__(self, name):
+        return self._mv._value(self._names[name])
+
+    def __getattr__(self, name):
+        try:
+            return self._mv._value(self._names[name])
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __contains__(self, name):
+        return name in self._names
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def keys(self):
+        return self._names.keys()
+
+    def items(self):
+        return [(k, self[k]) for k in self._names]
+
+    def get(self, name, default=None):
+        i = self._names.get(name)
+        return default if i is None else self._mv._value(i)
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+
+class MainValues():
+    """ One getMainValues reply, flattened.
+
+    @ivar schema: MainValuesSchema, shared between snapshots
+    @ivar values: float64 array, NaN for nulls and strings
+    """
+    __slots__ = ('schema', 'values', '_strings', '_nulls')
+
+    def __init__(self, schema, values, strings=None, nulls=True):
+        self.schema = schema
+        self.values = values
+        self._strings = strings
+        # False if there are no NaNs (other than strings) in values
+        self._nulls = nulls
+
+    @classmethod
+    def from_json(cls, obj):
+        """
+        @param obj: getMainValues reply, already decoded
+        @rtype: MainValues
+        """
+        keys = []
+        vals = []
+        _flatten(obj, "", keys, vals)
+        schema = schema_for(keys, vals)
+        nulls = None in vals
+        try:
+            values = np.array(vals, dtype=np.float64)
+        except (TypeError, ValueError):
+            floats = [_to_float(v) for v in vals]
+            kinds = schema.kinds
+            nulls = any(f != f and kinds[i] != _STR for i, f in enumerate(floats))
+            values = np.array(floats, dtype=np.float64)
+        strings = None
+        if schema.strings:
+            # mode names and such, the same few strings every time
+            strings = tuple(_intern(vals[i]) for i in schema.strings)
+            # numeric looking strings shouldn't pass as numbers
+            values[schema.strings] = np.nan
+        return cls(schema, values, strings, nulls)
+
+    @classmethod
+    def decode(cls, raw):
+        """
+        @param raw: getMainValues json reply body
+        @rtype: MainValues
+        """
+        if isinstance(raw, bytes):
+            raw = raw.decode('utf-8')
+        return cls.from_json(json_loads(raw))
+
+    def _value(self, i):
+        if self._strings is not None:
+            n = self.schema.string_pos.get(i)
+            if n is not None:
+                return self._strings[n]
+        return _convert(float(self.values[i]), self.schema.kinds[i])
+
+    def __getitem__(self, key):
+        """ Value by dotted key ("agitation.pv"), or a group by name
+        ("agitation") for mv[group][name] access like the dict form. """
+        i = self.schema.index.get(key)
+        if i is not None:
+            return self._value(i)
+        return _Group(self, self.schema.groups[key])
+
+    def __getattr__(self, group):
+        try:
+            return _Group(self, self.schema.groups[group])
+        except KeyError:
+            raise AttributeError(group) from None
+
+    def __contains__(self, key):
+        return key in self.schema.index or key in self.schema.groups
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        """ Dotted keys, in reply order """
+        return self.schema.keys
+
+    def pick(self, keys):
+        """ Values for a subset of keys as a float array (a copy).
+        @param keys: dotted keys, or an index array from schema.indexer
+        """
+        if not isinstance(keys, np.ndarray):
+            keys = self.schema.indexer(keys)
+        return self.values[keys]
+
+    def tolist(self, keys=None):
+        """ Like pick, but a list of python values, typed like the
+        reply (ints, bools, strings, None for nulls). """
+        schema = self.schema
+        if keys is None:
+            idx, ints, fixups = schema.plan(schema.keys)
+            picked = self.values
+        else:
+            if isinstance(keys, np.ndarray):
+                idx, ints, fixups = schema._plan(keys.tolist())
+            else:
+                idx, ints, fixups = schema.plan(keys)
+            picked = self.values[idx]
+        # plain python from here on: for ~50 values, numpy's per call
+        # overhead costs more than it saves
+        out = picked.tolist()
+        for n in ints:
+            v = out[n]
+            if v.is_integer():
+                out[n] = int(v)
+            elif v != v:
+                out[n] = None
+        strings = self._strings
+        for n, i, kind in fixups:
+            if kind == _STR:
+                out[n] = strings[schema.string_pos[i]] if strings is not None else None
+            else:
+                out[n] = _convert(out[n], kind)
+        if self._nulls:
+            out = [None if v != v else v for v in out]
+        return out
+
+    def to_dict(self):
+        """ Back to the nested dict form getMainValues returns """
+        out = {}
+        for k, v in zip(self.schema.keys, self.tolist()):
+            d = out
+            parts = k.split(".")
+            for p in parts[:-1]:
+                d = d.setdefault(p, {})
+            d[parts[-1]] = v
+        return out
+
+    def nbytes(self):
+        """ Memory held by this snapshot alone (not the shared schema) """
+        n = sys.getsizeof(self) + sys.getsizeof(self.values)
+        if self._strings is not None:
+            n += sys.getsizeof(self._strings)
+        return n
+
+    def __len__(self):
+        return len(self.schema.keys)
+
+    def __repr__(self):
+        return "<%s: %d values>" % (self.__class__.__name__, len(self))
@@ -0,0 +1,322 @@
+"""
+Per-call metrics for HelloApp server calls.
+
+Every HelloApp (hello and hello3) records into `default_registry`
+unless given a registry of its own, or None to turn recording off:
+
+    app = HelloApp('192.168.1.6')
+    app.metrics = MetricsRegistry()   # or None
+    ...
+    print(app.metrics.quantile('getMainValues', '192.168.1.6', 0.99))
+    print(app.metrics.to_prometheus())
+
+Recorded per (call name, reactor):
+    - request latency histogram (seconds, including retries)
+    - response bytes
+    - retries made by the transport
+    - calls refused by an open circuit breaker, which never got sent
+      and so count towards none of the above
+    - parse time histograms, separately for xml and json
+    - errors, counted by exception class name
+
+and per reactor, the state of its circuit breaker (see circuit.py)
+once it has seen a failure.
+"""
+from bisect import bisect_left
+from json import dumps as json_dumps
+import re
+import threading
+
+from hello.circuit import CircuitOpenError
+
+__author__ = 'Nathan Starkweather'
+
+_call_re = re.compile(r"[?&]call=([^&]*)")
+
+
+def call_name(url):
+    """ Name of the server call for a request url. Calls that go
+    through their own url instead of ?call= (getReport, getfile)
+    are named after their path. """
+    m = _call_re.search(url)
+    if m:
+        return m.group(1)
+    path = url.split("?", 1)[0].rstrip("/")
+    return path.rsplit("/", 1)[-1] or url
+
+
+class Histogram():
+    """ Fixed bucket histogram. Buckets are upper bounds; anything
+    over the last goes in an implicit +Inf bucket. """
+
+    default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets or self.default_buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, v):
+        self.counts[bisect_left(self.buckets, v)] += 1
+        self.count += 1
+        self.sum += v
+        if v > self.max:
+            self.max = v
+
+    def quantile(self, q):
+        """ Estimate the q'th quantile (0 <= q <= 1) by linear
+        interpolation within the bucket it falls in. Values in
+        the +Inf bucket are reported as the largest value seen.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        lo = 0.0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                if i == len(self.buckets):
+                    return self.max
+                hi = min(self.buckets[i], self.max)
+                return lo + (hi - lo) * (rank - seen) / n
+            seen += n
+            if i < len(self.buckets):
+                lo = self.buckets[i]
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'], self.counts)),
+        }
+
+
+class CallStats():
+    """ Everything recorded for one (call, reactor) pair. """
+    def __init__(self, buckets=None):
+        self.latency = Histogram(buckets)
+        self.parse = {}
+        self.bytes = 0
+        self.retries = 0
+        self.rejected = 0
+        self.errors = {}
+        self._buckets = buckets
+
+    def parse_hist(self, parser):
+        h = self.parse.get(parser)
+        if h is None:
+            h = self.parse[parser] = Histogram(self._buckets)
+        return h
+
+    def to_dict(self):
+        return {
+            'latency': self.latency.to_dict(),
+            'bytes': self.bytes,
+            'retries': self.retries,
+            'rejected': self.rejected,
+            'errors': dict(self.errors),
+            'parse': {k: v.to_dict() for k, v in self.parse.items()},
+        }
+
+
+def _label(v):
+    return str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _fmt(v):
+    if v == float('inf'):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+_circuit_states = {'closed': 0, 'half_open': 1, 'open': 2}
+
+
+class MetricsRegistry():
+    """ Thread safe store of CallStats keyed by (call, reactor).
+
+    @param buckets: histogram bucket upper bounds, in seconds
+    """
+    def __init__(self, buckets=None):
+        self.buckets = buckets
+        self._stats = {}
+        self._breakers = []
+        self._lock = threading.Lock()
+
+    def _get(self, call, reactor):
+        key = (call, reactor)
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats[key] = CallStats(self.buckets)
+        return stats
+
+    def observe_request(self, call, reactor, seconds, rsp=None, error=None, nbytes=None):
+        """ Record one request.
+
+        @param rsp: the response, if there was one. Its size is taken
+                    from .content, and retries from .retries if present.
+        @param error: the exception, if the request failed. A
+                    CircuitOpenError only counts as a rejection: the
+                    request was never sent, so there's no latency to
+                    record.
+        @param nbytes: reply size, if rsp.content shouldn't be
+                       touched (a streamed reply)
+        """
+        if isinstance(error, CircuitOpenError):
+            with self._lock:
+                self._get(call, reactor).rejected += 1
+            return
+        src = rsp if error is None else error
+        retries = getattr(src, 'retries', 0) or 0
+        if nbytes is None:
+            nbytes = len(getattr(rsp, 'content', b'') or b'') if rsp is not None else 0
+        with self._lock:
+            stats = self._get(call, reactor)
+            stats.latency.observe(seconds)
+            stats.bytes += nbytes
+            stats.retries += retries
+            if error is not None:
+                name = error.__class__.__name__
+                stats.errors[name] = stats.errors.get(name, 0) + 1
+
+    def observe_parse(self, call, reactor, parser, seconds):
+        """
+        @param parser: 'xml' or 'json'
+        """
+        with self._lock:
+            self._get(call, reactor).parse_hist(parser).observe(seconds)
+
+    def observe_error(self, call, reactor, error):
+        """ Record an error that didn't come from the request itself,
+        eg the server replying with a failure message. """
+        name = error.__class__.__name__
+        with self._lock:
+            stats = self._get(call, reactor)
+            stats.errors[name] = stats.errors.get(name, 0) + 1
+
+    def track_breakers(self, breakers):
+        """ Include a circuit.CircuitBreakers in circuits() and the
+        prometheus output. Tracking the same one again is a no-op. """
+        with self._lock:
+            if not any(b is breakers for b in self._breakers):
+                self._breakers.append(breakers)
+
+    def circuits(self):
+        """
+        @return: {reactor: CircuitBreaker.stats()} for tracked breakers
+        """
+        with self._lock:
+            tracked = list(self._breakers)
+        out = {}
+        for breakers in tracked:
+            out.update(breakers.stats())
+        return out
+
+    def get(self, call, reactor):
+        """
+        @return: CallStats for (call, reactor), or None
+        @rtype: CallStats
+        """
+        return self._stats.get((call, reactor))
+
+    def quantile(self, call, reactor, q):
+        """ Latency quantile for (call, reactor), in seconds """
+        stats = self.get(call, reactor)
+        if stats is None:
+            return None
+        with self._lock:
+            return stats.latency.quantile(q)
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self._breakers.clear()
+
+    def snapshot(self):
+        """
+        @return: list of dicts, one per (call, reactor)
+        """
+        with self._lock:
+            out = []
+            for (call, reactor), stats in sorted(self._stats.items(), key=lambda kv: tuple(map(str, kv[0]))):
+                d = stats.to_dict()
+                d['call'] = call
+                d['reactor'] = reactor
+                out.append(d)
+            return out
+
+    def to_json(self, **kw):
+        return json_dumps(self.snapshot(), **kw)
+
+    def to_prometheus(self, prefix="hello"):
+        """ Prometheus text exposition format """
+        lines = []
+        circuits = sorted(self.circuits().items())
+
+        def hist(name, h, labels):
+            cum = 0
+            for le, n in zip(h.buckets + (float('inf'),), h.counts):
+                cum += n
+                lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, _fmt(le), cum))
+            lines.append('%s_sum{%s} %s' % (name, labels, _fmt(h.sum)))
+            lines.append('%s_count{%s} %d' % (name, labels, h.count))
+
+        with self._lock:
+            items = sorted(self._stats.items(), key=lambda kv: tuple(map(str, kv[0])))
+
+            name = prefix + "_request_seconds"
+            lines.append("# HELP %s Hello server call latency, including retries." % name)
+            lines.append("# TYPE %s histogram" % name)
+            for (call, reactor), stats in items:
+                hist(name, stats.latency, 'call="%s",reactor="%s"' % (_label(call), _label(reactor)))
+
+            name = prefix + "_parse_seconds"
+            lines.append("# HELP %s Time spent parsing replies." % name)
+            lines.append("# TYPE %s histogram" % name)
+            for (call, reactor), stats in items:
+                for parser, h in sorted(stats.parse.items()):
+                    hist(name, h, 'call="%s",reactor="%s",parser="%s"' %
+                         (_label(call), _label(reactor), _label(parser)))
+
+            for metric, attr, help in (("response_bytes_total", "bytes", "Reply bytes received."),
+                                       ("retries_total", "retries", "Requests retried by the transport."),
+                                       ("rejected_total", "rejected", "Calls refused by an open circuit breaker.")):
+                name = prefix + "_" + metric
+                lines.append("# HELP %s %s" % (name, help))
+                lines.append("# TYPE %s counter" % name)
+                for (call, reactor), stats in items:
+                    lines.append('%s{call="%s",reactor="%s"} %d' %
+                                 (name, _label(call), _label(reactor), getattr(stats, attr)))
+
+            name = prefix + "_errors_total"
+            lines.append("# HELP %s Failed calls by exception class." % name)
+            lines.append("# TYPE %s counter" % name)
+            for (call, reactor), stats in items:
+                for err, n in sorted(stats.errors.items()):
+                    lines.append('%s{call="%s",reactor="%s",error="%s"} %d' %
+                                 (name, _label(call), _label(reactor), _label(err), n))
+
+        name = prefix + "_circuit_state"
+        lines.append("# HELP %s Circuit breaker state, 0 closed, 1 half open, 2 open." % name)
+        lines.append("# TYPE %s gauge" % name)
+        for reactor, c in circuits:
+            lines.append('%s{reactor="%s"} %d' % (name, _label(reactor), _circuit_states[c['state']]))
+        for metric, key, help in (("circuit_trips_total", "trips", "Times the circuit breaker opened."),
+                                  ("circuit_rejected_total", "rejected", "Calls refused by an open breaker.")):
+            name = prefix + "_" + metric
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s counter" % name)
+            for reactor, c in circuits:
+                lines.append('%s{reactor="%s"} %d' % (name, _label(reactor), c[key]))
+        lines.append("")
+        return "\n".join(lines)
+
+
+default_registry = MetricsRegistry()
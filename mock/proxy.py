@@ -0,0 +1,467 @@
+"""
+Fault injecting HTTP proxy, to put between a HelloApp and a real or
+mock Hello server.
+
+    python -m hello.mock.proxy 192.168.1.6:80 --port 8081 --profile lossy
+
+Retries, backoff, timeouts and relogins only get exercised when the
+plant network or the server misbehaves. FaultProxy misbehaves on
+demand. Faults are drawn per request from the current Profile:
+
+    latency     fixed delay before the request is forwarded
+    jitter      plus a heavy tailed (pareto) extra delay
+    bandwidth   cap on the response rate, bytes/sec
+    reset       connection reset instead of an answer
+    drop        headers and part of the body, then a reset
+    truncate    a complete http reply whose body is cut short
+                (malformed xml/json)
+    true_body   the "TrueBug": a reply of just "True"
+    expire      the session expires. Calls that need a login get "No
+                user associated with session" until the client logs in
+                again. login_ttl expires sessions that many seconds
+                after each login instead.
+
+From a test, swap the profile, apply one temporarily, or queue exact
+faults for the next matching requests:
+
+    with MockHelloServer() as server, FaultProxy(server.address) as proxy:
+        app = HelloApp(proxy.address)
+        proxy.profile = Profile(latency=0.05, jitter=0.02, reset=0.01)
+        with proxy.faults(true_body=1, calls={'getBatches'}):
+            ...
+        proxy.inject('reset', 2, call='getMainValues')
+
+The proxy speaks http to the client, or https if given a cert and key,
+and http or https (unverified, like Transport) to the server.
+"""
+from collections import Counter, deque
+from contextlib import contextmanager
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic, sleep
+from urllib.parse import urlsplit, parse_qsl
+import argparse
+import logging
+import random
+import socket
+import ssl
+import struct
+import threading
+
+from hello.mock.server import HelloService, NOT_LOGGED_IN, fail_reply, json_reply, _wants_json
+
+__author__ = 'Nathan Starkweather'
+
+_logger = logging.getLogger(__name__)
+
+TRUE_XML = b'<?xml version="1.0" encoding="windows-1252" standalone="no" ?>' \
+           b'<Reply><Result>True</Result><Message>True</Message></Reply>'
+
+TRUE_JSON = b'{"message": "True"}'
+
+# faults that replace the reply, in the order they're rolled for
+_reply_faults = ('reset', 'drop', 'truncate', 'true_body', 'expire')
+
+# request and response headers that only apply to one hop
+_hop_headers = {'connection', 'keep-alive', 'proxy-connection', 'transfer-encoding',
+                'te', 'trailer', 'upgrade', 'content-length'}
+
+
+class Profile():
+    """ How badly the proxy behaves. Probabilities are per request.
+
+    @param latency: seconds added before forwarding each request
+    @param jitter: scale of the heavy tailed extra latency,
+                   jitter * (paretovariate(tail) - 1)
+    @param tail: pareto shape. Below 2 the variance is infinite,
+                 which is about what a congested wifi network does.
+    @param max_latency: cap on latency + jitter
+    @param bandwidth: response bytes/sec, None for no cap
+    @param reset: probability of resetting the connection
+    @param drop: probability of resetting partway through the body
+    @param truncate: probability of cutting the body short
+    @param true_body: probability of answering "True"
+    @param expire: probability of the session expiring
+    @param login_ttl: seconds a login lasts, None for forever
+    @param calls: only requests for these calls get faults (latency
+                  and bandwidth caps included). None for all.
+    """
+    def __init__(self, latency=0.0, jitter=0.0, tail=1.5, max_latency=30.0, bandwidth=None,
+                 reset=0.0, drop=0.0, truncate=0.0, true_body=0.0, expire=0.0, login_ttl=None,
+                 calls=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.tail = tail
+        self.max_latency = max_latency
+        self.bandwidth = bandwidth
+        self.reset = reset
+        self.drop = drop
+        self.truncate = truncate
+        self.true_body = true_body
+        self.expire = expire
+        self.login_ttl = login_ttl
+        self.calls = set(calls) if calls is not None else None
+
+    def copy(self, **changes):
+        kw = dict(vars(self))
+        kw.update(changes)
+        return self.__class__(**kw)
+
+    def applies(self, call):
+        return self.calls is None or call in self.calls
+
+    def delay(self, rng):
+        d = self.latency
+        if self.jitter:
+            d += self.jitter * (rng.paretovariate(self.tail) - 1)
+        return min(d, self.max_latency)
+
+    def __repr__(self):
+        changed = {k: v for k, v in vars(self).items() if v != getattr(_clean, k, None)}
+        return "%s(%s)" % (self.__class__.__name__, ", ".join("%s=%r" % kv for kv in sorted(changed.items())))
+
+
+_clean = Profile()
+
+profiles = {
+    'clean': _clean,
+    'lan': Profile(latency=0.002, jitter=0.001),
+    'wifi': Profile(latency=0.02, jitter=0.02, bandwidth=250000, drop=0.002),
+    'congested': Profile(latency=0.1, jitter=0.2, tail=1.2, bandwidth=50000, reset=0.01, drop=0.01),
+    'lossy': Profile(latency=0.01, jitter=0.01, reset=0.05, drop=0.05),
+    'flaky_server': Profile(truncate=0.02, true_body=0.02),
+    'truebug': Profile(true_body=0.2),
+    'expiring': Profile(expire=0.05),
+}
+
+
+def call_of(path):
+    """ Call name of a request path, as the client's metrics file it
+    ("getReport" and "getfile" for those two urls) """
+    url = urlsplit(path)
+    route = url.path.rstrip("/")
+    if route.endswith("/getfile"):
+        return 'getfile'
+    if route.endswith("/getReport"):
+        return 'getReport'
+    return dict(parse_qsl(url.query)).get('call')
+
+
+class _ProxyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    upstream = None
+
+    def do_GET(self):
+        proxy = self.server.proxy
+        call = call_of(self.path)
+        profile, fault = proxy._choose(call, self.headers.get('Cookie'))
+        proxy._count(call, fault)
+
+        if profile is not None:
+            delay = profile.delay(proxy._rng)
+            if delay > 0:
+                sleep(delay)
+
+        if fault == 'reset':
+            return self._reset()
+        query = dict(parse_qsl(urlsplit(self.path).query))
+        if fault == 'expire':
+            if call == 'getReport':
+                reply = json_reply({"message": "", "error": NOT_LOGGED_IN})
+            else:
+                reply = fail_reply(NOT_LOGGED_IN, _wants_json(query))
+            return self._respond(200, "OK", list(reply.headers.items()), reply.body, profile)
+
+        try:
+            status, reason, headers, body = self._forward()
+        except (OSError, HTTPException) as e:
+            _logger.debug("upstream failed for %s: %s", self.path, e)
+            return self._reset()
+
+        if call == 'login' and status == 200:
+            proxy._logged_in(self.headers.get('Cookie'), headers)
+        if fault == 'true_body':
+            body = TRUE_JSON if _wants_json(query) else TRUE_XML
+        elif fault == 'truncate' and len(body) > 1:
+            body = body[:proxy._rng.randint(1, len(body) - 1)]
+        self._respond(status, reason, headers, body, profile, fault == 'drop')
+
+    def _forward(self):
+        conn = self.upstream
+        if conn is None:
+            conn = self.upstream = self.server.proxy._connect()
+        headers = {k: v for k, v in self.headers.items() if k.lower() not in _hop_headers}
+        headers['Host'] = self.server.proxy.upstream
+        try:
+            conn.request('GET', self.path, None, headers)
+            rsp = conn.getresponse()
+            body = rsp.read()
+        except (OSError, HTTPException):
+            # the server may have dropped an idle connection, once more
+            # on a new one
+            conn.close()
+            conn.request('GET', self.path, None, headers)
+            rsp = conn.getresponse()
+            body = rsp.read()
+        headers = [(k, v) for k, v in rsp.getheaders() if k.lower() not in _hop_headers]
+        return rsp.status, rsp.reason, headers, body
+
+    def _respond(self, status, reason, headers, body, profile, drop=False):
+        self.send_response(status, reason)
+        for k, v in headers:
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            if drop:
+                cut = self.server.proxy._rng.randint(0, max(len(body) - 1, 0))
+                self._write(body[:cut], profile)
+                return self._reset()
+            self._write(body, profile)
+        except OSError:
+            # client gave up (timed out) while we were dawdling
+            self.close_connection = True
+
+    def _write(self, body, profile):
+        rate = profile.bandwidth if profile is not None else None
+        if not rate:
+            self.wfile.write(body)
+            return
+        # 20 writes a second, or so. Wait before each one, so
+        # that the last byte arrives when it should.
+        chunk = max(int(rate / 20), 1)
+        for i in range(0, len(body), chunk):
+            part = body[i:i + chunk]
+            sleep(len(part) / rate)
+            self.wfile.write(part)
+
+    def _reset(self):
+        """ Close with a RST rather than a FIN, so that the client sees
+        a reset, not a clean close. """
+        self.close_connection = True
+        try:
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            self.connection.close()
+        except OSError:
+            pass
+
+    def finish(self):
+        try:
+            super().finish()
+        except OSError:
+            pass
+        if self.upstream is not None:
+            self.upstream.close()
+
+    def log_message(self, format, *args):
+        _logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class FaultProxy():
+    """
+    @param upstream: "host:port" of the server
+    @param profile: Profile, or the name of one of `profiles`
+    @param host: interface to listen on
+    @param port: port to listen on, 0 for any
+    @param upstream_ssl: talk https to the server
+    @param certfile: serve https with this cert...
+    @param keyfile: ...and key
+    @param timeout: for the upstream connections
+    @param seed: for the fault rolls
+    @param clock: monotonic clock, for login_ttl
+    """
+    def __init__(self, upstream, profile=None, host='127.0.0.1', port=0, upstream_ssl=False,
+                 certfile=None, keyfile=None, timeout=30, seed=None, clock=monotonic):
+        self.upstream = upstream
+        if profile is None:
+            profile = _clean
+        elif isinstance(profile, str):
+            profile = profiles[profile]
+        self.profile = profile
+        self.upstream_ssl = upstream_ssl
+        self.timeout = timeout
+        self._clock = clock
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._injected = deque()   # (fault, call), next requests first
+        self._expired = set()      # cookies
+        self._logins = {}          # cookie -> login time
+        self.stats = Counter()     # fault -> count, 'requests' -> count
+        self.log = deque(maxlen=1000)  # (call, fault or None)
+
+        self.httpd = ThreadingHTTPServer((host, port), _ProxyHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.proxy = self
+        if certfile is not None:
+            ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            ctx.load_cert_chain(certfile, keyfile)
+            self.httpd.socket = ctx.wrap_socket(self.httpd.socket, server_side=True)
+        self._thread = None
+
+    @property
+    def address(self):
+        """ "host:port", as HelloApp takes it """
+        host, port = self.httpd.server_address[:2]
+        return "%s:%d" % (host, port)
+
+    # ----- scripting -----
+
+    @contextmanager
+    def faults(self, profile=None, **kw):
+        """ Use `profile` (or the current one with `kw` changed) for
+        the duration of a with block """
+        old = self.profile
+        if profile is None:
+            profile = old.copy(**kw)
+        elif isinstance(profile, str):
+            profile = profiles[profile]
+        self.profile = profile
+        try:
+            yield profile
+        finally:
+            self.profile = old
+
+    def inject(self, fault, count=1, call=None):
+        """ Make the next `count` requests (for `call`, if given) fail
+        with `fault`, whatever the profile says. Faults that need a
+        session (expire) apply to the next call that needs a login.
+
+        @param fault: one of 'reset', 'drop', 'truncate', 'true_body', 'expire'
+        """
+        if fault not in _reply_faults:
+            raise ValueError(fault)
+        with self._lock:
+            self._injected.extend([(fault, call)] * count)
+
+    def clear(self):
+        """ Forget queued faults and expired sessions """
+        with self._lock:
+            self._injected.clear()
+            self._expired.clear()
+            self._logins.clear()
+
+    # ----- per request -----
+
+    def _choose(self, call, cookie):
+        """ @return: (profile if it applies to this call else None, fault or None) """
+        profile = self.profile
+        applies = profile.applies(call)
+        needs_login = call in HelloService.login_required or call == 'getReport'
+        with self._lock:
+            if needs_login and cookie in self._expired:
+                return profile if applies else None, 'expire'
+            for n, (fault, fcall) in enumerate(self._injected):
+                if fcall is not None and fcall != call:
+                    continue
+                if fault == 'expire' and not (needs_login and cookie):
+                    continue
+                del self._injected[n]
+                if fault == 'expire':
+                    self._expired.add(cookie)
+                return profile if applies else None, fault
+            if needs_login and cookie and profile.login_ttl is not None:
+                t = self._logins.get(cookie)
+                if t is not None and self._clock() - t > profile.login_ttl:
+                    self._expired.add(cookie)
+                    return profile if applies else None, 'expire'
+        if not applies:
+            return None, None
+        rng = self._rng
+        for fault in _reply_faults:
+            p = getattr(profile, fault)
+            if p and rng.random() < p:
+                if fault == 'expire':
+                    if not (needs_login and cookie):
+                        continue
+                    with self._lock:
+                        self._expired.add(cookie)
+                return profile, fault
+        return profile, None
+
+    def _logged_in(self, cookie, headers):
+        # the server may hand out a new cookie with the login
+        for k, v in headers:
+            if k.lower() == 'set-cookie':
+                cookie = v.split(';', 1)[0]
+        with self._lock:
+            self._expired.discard(cookie)
+            self._logins[cookie] = self._clock()
+
+    def _count(self, call, fault):
+        with self._lock:
+            self.stats['requests'] += 1
+            if fault is not None:
+                self.stats[fault] += 1
+            self.log.append((call, fault))
+
+    def _connect(self):
+        host, _, port = self.upstream.partition(":")
+        port = int(port) if port else None
+        if self.upstream_ssl:
+            ctx = ssl.create_default_context()
+            ctx.check_hostname = False
+            ctx.verify_mode = ssl.CERT_NONE
+            return HTTPSConnection(host, port, timeout=self.timeout, context=ctx)
+        return HTTPConnection(host, port, timeout=self.timeout)
+
+    # ----- running -----
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True,
+                                            name="FaultProxy %s" % self.address)
+            self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def close(self):
+        if self._thread is not None:
+            self.httpd.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Fault injecting proxy for a Hello server")
+    p.add_argument('upstream', help="server host:port")
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--port', type=int, default=8081)
+    p.add_argument('--profile', default='clean', choices=sorted(profiles))
+    p.add_argument('--upstream-ssl', action='store_true', help="talk https to the server")
+    p.add_argument('--tls', nargs=2, metavar=('CERT', 'KEY'), help="serve https")
+    p.add_argument('--seed', type=int)
+    # any Profile setting can be changed from the chosen profile
+    for name, default in sorted(vars(_clean).items()):
+        if name != 'calls':
+            p.add_argument('--' + name.replace('_', '-'), type=float, dest=name)
+    p.add_argument('--calls', nargs='+', help="only these calls get faults")
+    args = p.parse_args(argv)
+    changes = {k: getattr(args, k) for k in vars(_clean) if getattr(args, k, None) is not None}
+    profile = profiles[args.profile].copy(**changes)
+    certfile, keyfile = args.tls or (None, None)
+    logging.basicConfig(level=logging.INFO)
+    proxy = FaultProxy(args.upstream, profile, args.host, args.port, args.upstream_ssl,
+                       certfile, keyfile, seed=args.seed)
+    print("Proxying %s -> %s with %r" % (proxy.address, args.upstream, profile))
+    try:
+        proxy.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        proxy.httpd.server_close()
+        print(dict(proxy.stats))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,534 @@
+"""
+Mock Hello webserver, backed by a simulated reactor (mock/sim.py).
+
+    python -m hello.mock.server [--port 8080] [--speed 1] [--tls cert.pem key.pem]
+
+Speaks enough of the real server's protocol for HelloApp, HelloLogger
+and PIDTest to run against it unchanged:
+
+    /webservice/interface/?&call=...    xml replies, or json with json=1
+    /webservice/getReport/?&mode=...    json {"message": fname, "error": ""}
+    /webservice/getfile/?&getfile=...   report download, with Range support
+
+Replies are built with mock.util's HelloXMLGenerator and
+HelloJSONEncoder, so they come out in the same shapes (and with the same
+quirks) as the real server's. Sessions work like the real ones too:
+every new client gets a cookie, set calls need a login, and a session
+left idle for `session_timeout` seconds is logged out.
+
+From a script or test:
+
+    with MockHelloServer(speed=60) as server:
+        app = HelloApp(server.address)
+        ...
+
+HelloApp speaks https by default, so either pass a cert and key to get
+a TLS server, or give the app a plain http connection
+(HelloApp.ConnectionFactory = functools.partial(Transport, use_ssl=False)).
+"""
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic
+from urllib.parse import urlsplit, parse_qsl
+from xml.etree.ElementTree import Element, SubElement
+import argparse
+import datetime
+import logging
+import ssl
+import threading
+
+from hello.mock.sim import ReactorSim
+from hello.mock.util import xml_generator, json_dumps
+
+__author__ = 'Nathan Starkweather'
+
+_logger = logging.getLogger(__name__)
+
+NOT_LOGGED_IN = "No user associated with session"
+
+XML_TYPE = "text/xml; charset=windows-1252"
+JSON_TYPE = "application/json"
+FILE_TYPE = "application/octet-stream"
+
+
+class Reply():
+    """ What HelloService.handle hands back to the http layer """
+    __slots__ = ('status', 'headers', 'body')
+
+    def __init__(self, body, content_type=XML_TYPE, status=200, headers=None):
+        self.status = status
+        self.headers = headers or {}
+        self.headers.setdefault('Content-Type', content_type)
+        self.body = body
+
+    def __repr__(self):
+        return "<%s %d %d bytes>" % (self.__class__.__name__, self.status, len(self.body))
+
+
+def xml_reply(msg, name=None, result=True):
+    return Reply(xml_generator.create_hello_xml(msg, name, str(bool(result))))
+
+
+def json_reply(obj):
+    return Reply(json_dumps(obj).encode('utf-8'), JSON_TYPE)
+
+
+def fail_reply(message, json=False):
+    if json:
+        return json_reply({"Result": False, "Message": message})
+    return xml_reply(message, result=False)
+
+
+class _Session():
+    __slots__ = ('id', 'user', 'last_used')
+
+    def __init__(self, id, now):
+        self.id = id
+        self.user = None
+        self.last_used = now
+
+
+class HelloService():
+    """ The protocol, minus the http. One service is one reactor.
+
+    Calls are looked up in self.calls (call name -> method), the same
+    way HelloXMLGenerator looks up its type handlers, so tests can
+    register extra calls or replace existing ones. Each method gets
+    the query dict and the session and returns a Reply.
+
+    @param sim: ReactorSim, or None for a new one made with sim_kw
+    @param users: {user: password}
+    @param session_timeout: idle seconds before a session is logged out
+    @param max_files: most generated reports kept for getfile
+    """
+
+    # calls that fail with NOT_LOGGED_IN without a login
+    login_required = {
+        'set', 'setconfig', 'setStartBatch', 'setendbatch', 'runRecipe', 'recipeSkip',
+        'clearAlarm', 'clearAlarmsByType', 'clearAllAlarms', 'getRawValue', 'tryCal',
+        'trycal', 'savetrialcal', 'revertTrialCal', 'setpumpa', 'setpumpb', 'setpumpc',
+        'setpumpsample', 'loadbag', 'setSensorState', 'setTopLight', 'setUnlockDoor',
+    }
+
+    def __init__(self, sim=None, users=None, session_timeout=1800, max_files=20,
+                 clock=monotonic, **sim_kw):
+        if sim is None:
+            sim = ReactorSim(**sim_kw)
+        self.sim = sim
+        self.users = users or {'user1': '12345'}
+        self.session_timeout = session_timeout
+        self.max_files = max_files
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._next_session = 1
+        self._files = OrderedDict()
+        self._next_file = 1
+
+        self.calls = {
+            'login': self.login,
+            'logout': self.logout,
+            'getLoginStatus': self.getLoginStatus,
+            'getVersion': self.getVersion,
+            'getMainValues': self.getMainValues,
+            'getDORAValues': self.getDORAValues,
+            'getConfig': self.getConfig,
+            'setconfig': self.setconfig,
+            'set': self.set,
+            'getBatches': self.getBatches,
+            'setStartBatch': self.setStartBatch,
+            'setendbatch': self.setendbatch,
+            'getRecipes': self.getRecipes,
+            'runRecipe': self.runRecipe,
+            'getAlarms': self.getAlarms,
+            'getAlarmList': self.getAlarmList,
+            'getUnAckCount': self.getUnAckCount,
+            'clearAlarm': self.clearAlarm,
+            'clearAlarmsByType': self.clearAlarmsByType,
+            'clearAllAlarms': self.clearAllAlarms,
+            'getTrendData': self.getTrendData,
+            'getRawValue': self.getRawValue,
+        }
+        # set calls the sim doesn't model. They succeed and do nothing.
+        for call in ('tryCal', 'trycal', 'savetrialcal', 'revertTrialCal', 'setpumpa',
+                     'setpumpb', 'setpumpc', 'setpumpsample', 'loadbag', 'recipeSkip',
+                     'setSensorState', 'setTopLight', 'setUnlockDoor'):
+            self.calls[call] = self._set_ok
+
+    def register(self, call, func):
+        self.calls[call] = func
+
+    # ----- sessions -----
+
+    def session(self, cookie):
+        """ Session for a Cookie header, or a new one if there's no
+        (live) session for it.
+        @return: (session, True if the session is new)
+        """
+        now = self._clock()
+        sid = None
+        if cookie:
+            for part in cookie.split(";"):
+                k, _, v = part.strip().partition("=")
+                if k == 'session':
+                    sid = v
+        with self._lock:
+            s = self._sessions.get(sid)
+            if s is None:
+                sid = "%08x%04x" % (self._next_session, id(self) & 0xffff)
+                self._next_session += 1
+                s = self._sessions[sid] = _Session(sid, now)
+                self._expire(now)
+                return s, True
+            if s.user is not None and now - s.last_used > self.session_timeout:
+                s.user = None
+            s.last_used = now
+            return s, False
+
+    def _expire(self, now):
+        # forget sessions nobody has used in a long time, so that clients
+        # that never send the cookie back don't grow this without end
+        dead = [sid for sid, s in self._sessions.items()
+                if now - s.last_used > max(self.session_timeout, 60) * 4]
+        for sid in dead:
+            del self._sessions[sid]
+
+    # ----- http entry point -----
+
+    def handle(self, path, cookie=None, headers=None):
+        """
+        @param path: request path including the query string
+        @param cookie: Cookie request header
+        @param headers: all request headers (for Range)
+        @rtype: Reply
+        """
+        url = urlsplit(path)
+        query = dict(parse_qsl(url.query, keep_blank_values=True))
+        session, new = self.session(cookie)
+        route = url.path.rstrip("/")
+        try:
+            if route.endswith("/getfile"):
+                reply = self.getfile(query, headers or {})
+            elif route.endswith("/getReport"):
+                reply = self.getReport(query, session)
+            else:
+                reply = self.call(query, session)
+        except Exception as e:
+            _logger.exception("Error handling %s", path)
+            reply = fail_reply("%s: %s" % (e.__class__.__name__, e), _wants_json(query))
+        if new:
+            reply.headers['Set-Cookie'] = "session=%s; path=/" % session.id
+        return reply
+
+    def call(self, query, session):
+        name = query.get('call')
+        func = self.calls.get(name)
+        if func is None:
+            return fail_reply("Unknown call: %s" % name, _wants_json(query))
+        if name in self.login_required and session.user is None:
+            return fail_reply(NOT_LOGGED_IN, _wants_json(query))
+        return func(query, session)
+
+    # ----- calls -----
+
+    def login(self, query, session):
+        user = query.get('val1', '')
+        json = _wants_json(query)
+        if self.users.get(user) != query.get('val2'):
+            return fail_reply("Invalid username or password", json)
+        session.user = user
+        if json:
+            return json_reply({"Result": True, "Message": "Logged in as %s" % user})
+        return xml_reply("True")
+
+    def logout(self, query, session):
+        session.user = None
+        return xml_reply("True")
+
+    def getLoginStatus(self, query, session):
+        if session.user is None:
+            return fail_reply(NOT_LOGGED_IN)
+        return xml_reply(session.user)
+
+    def getVersion(self, query, session):
+        return xml_reply({
+            'RIO': '2.0.0',
+            'Server': '3.0.0 (mock)',
+            'Model': "PBS %d" % self.sim.model,
+            'Database': '3.0',
+            'Serial Number': 'MOCK%04d' % self.sim.model,
+            'Magnetic Wheel': True,
+        }, 'Versions')
+
+    def getMainValues(self, query, session):
+        return json_reply(self.sim.main_values())
+
+    def getDORAValues(self, query, session):
+        return xml_reply(self.sim.dora_values())
+
+    def getConfig(self, query, session):
+        return xml_reply(self.sim.config, 'System_Variables_Mag')
+
+    def setconfig(self, query, session):
+        try:
+            self.sim.setconfig(query['group'], query['name'], query['val'])
+        except KeyError as e:
+            return fail_reply("Unknown variable: %s" % e.args[0])
+        except ValueError:
+            return fail_reply("Bad value: %s" % query['val'])
+        return xml_reply("True")
+
+    def set(self, query, session):
+        try:
+            mode = int(query['mode'])
+            val1 = float(query['val1'])
+            val2 = float(query['val2']) if query.get('val2') else None
+        except (KeyError, ValueError):
+            return fail_reply("Bad arguments")
+        try:
+            self.sim.set(query.get('group'), mode, val1, val2)
+        except KeyError as e:
+            return fail_reply("Unknown group: %s" % e.args[0])
+        return xml_reply("True")
+
+    def getBatches(self, query, session):
+        batches = self.sim.batch_list()
+        arr = Element("Array")
+        arr.text = "\n"
+        arr.tail = ""
+        name = SubElement(arr, "Name")
+        name.text = "Batches (cluster)"
+        size = SubElement(arr, "Dimsize")
+        size.text = str(len(batches))
+        name.tail = size.tail = "\n"
+        for b in batches:
+            xml_generator.dict_toxml(b, 'Batch', arr)
+        return xml_reply(arr)
+
+    def setStartBatch(self, query, session):
+        name = query.get('val1', '')
+        if not name:
+            return fail_reply("No batch name given")
+        if not self.sim.start_batch(name, session.user):
+            return fail_reply("Batch already running")
+        return xml_reply("True")
+
+    def setendbatch(self, query, session):
+        if not self.sim.end_batch():
+            return fail_reply("No batch currently running")
+        return xml_reply("True")
+
+    def getRecipes(self, query, session):
+        return xml_reply(",".join(self.sim.recipes))
+
+    def runRecipe(self, query, session):
+        # the client sends spaces as underscores
+        name = query.get('recipe', '')
+        for r in self.sim.recipes:
+            if r.replace(" ", "_") == name or r == name:
+                self.sim.run_recipe(r)
+                return xml_reply("True")
+        return fail_reply("Unknown recipe: %s" % name)
+
+    def getAlarms(self, query, session):
+        try:
+            n = int(query.get('val1') or 100)
+            start = int(query.get('val2') or 1)
+        except ValueError:
+            return fail_reply("Bad arguments")
+        alarms = self.sim.get_alarms(start, n)
+        return xml_reply({
+            'alarmIDs': ",".join(str(a[0]) for a in alarms),
+            'type': ",".join(a[1] for a in alarms),
+            'time': ",".join(a[2] for a in alarms),
+            'message': ",".join(a[3].replace(",", ";") for a in alarms),
+        }, 'Alarms')
+
+    def getAlarmList(self, query, session):
+        types = sorted({a[1] for a in self.sim.alarms})
+        return xml_reply({'types': ",".join(types), 'count': len(self.sim.alarms)}, 'cluster')
+
+    def getUnAckCount(self, query, session):
+        return xml_reply(str(self.sim.unack_count()))
+
+    def clearAlarm(self, query, session):
+        try:
+            self.sim.clear_alarms(id=int(query.get('val1')))
+        except (TypeError, ValueError):
+            return fail_reply("Bad alarm ID")
+        return xml_reply("True")
+
+    def clearAlarmsByType(self, query, session):
+        self.sim.clear_alarms(type=query.get('val1'))
+        return xml_reply("True")
+
+    def clearAllAlarms(self, query, session):
+        self.sim.clear_alarms()
+        return xml_reply("True")
+
+    def getTrendData(self, query, session):
+        try:
+            data = self.sim.trend_data(query.get('group'), query.get('span'))
+        except KeyError as e:
+            return fail_reply("Bad argument: %s" % e.args[0], _wants_json(query))
+        if _wants_json(query):
+            return json_reply(data)
+        return xml_reply(data, 'trend')
+
+    def getRawValue(self, query, session):
+        # json=True replies with just the number on success, see
+        # HelloApp.getRawValue
+        val = self.sim.raw_value(query.get('sensor', ''))
+        if _wants_json(query):
+            return Reply(("%.5f" % val).encode('ascii'), JSON_TYPE)
+        return xml_reply("%.5f" % val)
+
+    def _set_ok(self, query, session):
+        return xml_reply("True")
+
+    # ----- reports -----
+
+    def getReport(self, query, session):
+        if session.user is None:
+            return json_reply({"message": "", "error": NOT_LOGGED_IN})
+        mode = query.get('mode')
+        try:
+            if mode == 'byBatch':
+                data = self.sim.batch_report(int(query['val1']))
+            elif mode == 'byDate':
+                data = self.sim.report(float(query['val1']), float(query['val2']))
+            else:
+                return json_reply({"message": "", "error": "Unknown mode: %s" % mode})
+        except (KeyError, ValueError) as e:
+            return json_reply({"message": "", "error": "Bad argument: %s" % e.args[0]})
+        with self._lock:
+            stamp = datetime.datetime.fromtimestamp(self.sim.now()).strftime("%Y%m%d%H%M%S")
+            fname = "%s_%s_%d.csv" % (query.get('type', 'report'), stamp, self._next_file)
+            self._next_file += 1
+            self._files[fname] = data
+            while len(self._files) > self.max_files:
+                self._files.popitem(last=False)
+        return json_reply({"message": fname, "error": ""})
+
+    def getfile(self, query, headers):
+        data = self._files.get(query.get('getfile'))
+        if data is None:
+            return Reply(b"File not found", FILE_TYPE, 404)
+        total = len(data)
+        rng = headers.get('Range', '')
+        if not rng.startswith("bytes="):
+            return Reply(data, FILE_TYPE)
+        first, _, last = rng[6:].partition("-")
+        try:
+            first = int(first)
+            last = int(last) if last else total - 1
+        except ValueError:
+            return Reply(data, FILE_TYPE)
+        if first >= total:
+            return Reply(b"", FILE_TYPE, 416, {'Content-Range': "bytes */%d" % total})
+        last = min(last, total - 1)
+        return Reply(data[first:last + 1], FILE_TYPE, 206,
+                     {'Content-Range': "bytes %d-%d/%d" % (first, last, total)})
+
+
+def _wants_json(query):
+    return query.get('json', '').lower() in ('1', 'true')
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        reply = self.server.service.handle(self.path, self.headers.get('Cookie'), self.headers)
+        self.send_response(reply.status)
+        for k, v in reply.headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(reply.body)))
+        self.end_headers()
+        self.wfile.write(reply.body)
+
+    def log_message(self, format, *args):
+        _logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class MockHelloServer():
+    """ A HelloService on a threaded http server.
+
+    @param service: HelloService, or None for a new one made with kw
+    @param host: interface to listen on
+    @param port: 0 for any free port
+    @param certfile: serve https with this cert...
+    @param keyfile: ...and key
+    """
+    def __init__(self, service=None, host='127.0.0.1', port=0, certfile=None, keyfile=None, **kw):
+        if service is None:
+            service = HelloService(**kw)
+        self.service = service
+        self.httpd = ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.service = service
+        if certfile is not None:
+            ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            ctx.load_cert_chain(certfile, keyfile)
+            self.httpd.socket = ctx.wrap_socket(self.httpd.socket, server_side=True)
+        self._thread = None
+
+    @property
+    def sim(self):
+        return self.service.sim
+
+    @property
+    def address(self):
+        """ "host:port", as HelloApp takes it """
+        host, port = self.httpd.server_address[:2]
+        return "%s:%d" % (host, port)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True,
+                                            name="MockHelloServer %s" % self.address)
+            self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def close(self):
+        if self._thread is not None:
+            self.httpd.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Mock Hello webserver backed by a simulated reactor")
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--port', type=int, default=8080)
+    p.add_argument('--speed', type=float, default=1.0, help="simulated seconds per second")
+    p.add_argument('--name', default="Mock PBS 80", help="machine name")
+    p.add_argument('--model', type=int, default=80, choices=(3, 15, 80))
+    p.add_argument('--tls', nargs=2, metavar=('CERT', 'KEY'), help="serve https")
+    args = p.parse_args(argv)
+    certfile, keyfile = args.tls or (None, None)
+    logging.basicConfig(level=logging.INFO)
+    server = MockHelloServer(host=args.host, port=args.port, certfile=certfile, keyfile=keyfile,
+                             name=args.name, model=args.model, speed=args.speed)
+    print("Serving %s (%s) on %s" % (args.name, "https" if certfile else "http", server.address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,615 @@
+"""
+Simulated reactor for the mock Hello server (see mock/server.py).
+
+ReactorSim steps a model of one reactor in one second increments, in
+real time or `speed` times faster. DO is the pid package's DOProcess
+fed through a GasController by n2 and o2 PIDControllers, the same loop
+as do_simulation.do_sim. Temperature and agitation are PIDControllers
+driving first order processes. pH, main gas and the rest are simpler
+still, since nothing tests their dynamics yet.
+
+Nothing runs in the background: every read first catches the model up
+to the clock (advance), so an idle sim costs nothing.
+
+Besides process values, the sim keeps what the server calls read:
+config, batches, alarms, recipes and a trend history to draw reports
+and getTrendData from.
+"""
+from collections import deque
+from time import monotonic, time
+import datetime
+import random
+import threading
+
+from hello.pid.lvpid import PIDController
+from hello.pid.gas_process import GasController
+from hello.pid.do_simulation.doprocess import DOProcess, AIR_CNO
+
+__author__ = 'Nathan Starkweather'
+
+AUTO = 0
+MAN = 1
+OFF = 2
+
+# getTrendData spans, in seconds
+spans = {
+    '15min': 15 * 60,
+    '2hr': 2 * 3600,
+    '12hr': 12 * 3600,
+    '24hr': 24 * 3600,
+    '72hr': 72 * 3600,
+    '7day': 7 * 24 * 3600,
+}
+
+# groups with a trend, and the series in each
+trend_series = {
+    'agitation': ('pv', 'sp', 'output'),
+    'temperature': ('pv', 'sp', 'output'),
+    'do': ('pv', 'sp', 'n2', 'o2'),
+    'ph': ('pv', 'sp', 'co2', 'base'),
+}
+
+date_format = "%I:%M:%S %p\n %m/%d/%Y"
+
+
+def _pid(p, i, d=0, amax=100, amin=0):
+    return PIDController(pgain=p, itime=i, dtime=d, auto_max=amax, auto_min=amin)
+
+
+class Loop():
+    """ PIDController on a first order process:
+    dpv/dt = (ambient + gain * output - pv) / tau
+    """
+    def __init__(self, pv, sp, gain, tau, ambient, pid, noise=0.0, mode=AUTO):
+        self.pv = pv
+        self.sp = sp
+        self.gain = gain
+        self.tau = tau
+        self.ambient = ambient
+        self.pid = pid
+        self.noise = noise
+        self.man = 0
+        self.output = 0
+        self.mode = OFF
+        self.set(mode, sp)
+
+    def set(self, mode, val):
+        if mode == AUTO:
+            self.sp = val
+        elif mode == MAN:
+            self.man = val
+        self.pid.set_mode(mode, self.pv, val)
+        # set_mode only takes the man value on a change of mode
+        self.pid.man_request = self.man
+        self.mode = mode
+
+    def step(self, rand):
+        self.output = out = self.pid.step(self.pv, self.sp)
+        self.pv += (self.ambient + self.gain * out - self.pv) / self.tau
+        if self.noise:
+            self.pv += rand() * self.noise
+
+    def values(self, error=0):
+        return {
+            'output': float(self.output),
+            'man': float(self.man),
+            'interlocked': 0,
+            'pv': float(self.pv),
+            'sp': float(self.sp),
+            'error': error,
+            'mode': self.mode,
+        }
+
+
+class DOLoop():
+    """ do_sim's loop: n2 and o2 PIDs around a DOProcess. n2 works
+    at sp + deadband, o2 at sp - deadband. n2 is reverse acting, so
+    its PID is fed -pv and -sp. The cells eat `uptake` %DO/hr. """
+    def __init__(self, pv=90, sp=40, db=1, main_gas=0.5, reactor_size=80, volume=55, uptake=10):
+        self.pv = pv
+        self.sp = sp
+        self.db = db
+        self.mode = AUTO
+        self.man_n2 = self.man_o2 = 0
+        self.main_gas = main_gas
+        self.proc = DOProcess(main_gas, AIR_CNO, reactor_size, volume)
+        self.proc.set_values(k_mult=1.1, c=uptake)
+        self.ctrl = GasController(1, 10, 10, 10)
+        self.n2_pid = _pid(5, 5, amax=90)
+        self.o2_pid = _pid(2, 10)
+        self.n2_pid.off_to_auto(-pv, -(sp + db))
+        self.o2_pid.off_to_auto(pv, sp - db)
+        self.co2 = 0
+        self.n2 = self.o2 = 0
+        self.air = 1
+
+    def set(self, mode, n2, o2=None):
+        if mode == AUTO:
+            self.sp = n2
+        elif mode == MAN:
+            self.man_n2 = n2
+            self.man_o2 = o2 or 0
+        self.n2_pid.set_mode(mode, -self.pv, -(self.sp + self.db))
+        self.o2_pid.set_mode(mode, self.pv, self.sp - self.db)
+        self.n2_pid.man_request = self.man_n2
+        self.o2_pid.man_request = self.man_o2
+        self.mode = mode
+
+    def step(self, co2_req):
+        o2 = self.o2_pid.step(self.pv, self.sp - self.db) / 100
+        n2 = self.n2_pid.step(-self.pv, -(self.sp + self.db)) / 100
+        mg = max(self.main_gas, 0.01)
+        self.co2, self.n2, self.o2, self.air = self.ctrl.request(mg, co2_req, n2, o2)
+        self.proc.main_gas = mg
+        self.pv = self.proc.step(self.pv, self.co2, self.n2, self.o2, self.air)
+
+    def values(self, error=0):
+        return {
+            'manUp': float(self.man_o2),
+            'outputDown': self.n2 * 100.0,
+            'error': error,
+            'pv': float(self.pv),
+            'sp': float(self.sp),
+            'manDown': float(self.man_n2),
+            'outputUp': self.o2 * 100.0,
+            'mode': self.mode,
+            'interlocked': 0,
+        }
+
+
+class PHLoop():
+    """ Not much of a model: co2 pulls pH down, base pushes it up,
+    and it drifts toward 7.2 otherwise. """
+    def __init__(self, pv=7.1, sp=7.0, db=0.05):
+        self.pv = pv
+        self.sp = sp
+        self.db = db
+        self.mode = AUTO
+        self.man_co2 = self.man_base = 0
+        self.co2_pid = _pid(20, 10)
+        self.base_pid = _pid(20, 10)
+        self.co2_pid.off_to_auto(-pv, -(sp + db))
+        self.base_pid.off_to_auto(pv, sp - db)
+        self.co2 = self.base = 0
+
+    def set(self, mode, co2, base=None):
+        if mode == AUTO:
+            self.sp = co2
+        elif mode == MAN:
+            self.man_co2 = co2
+            self.man_base = base or 0
+        self.co2_pid.set_mode(mode, -self.pv, -(self.sp + self.db))
+        self.base_pid.set_mode(mode, self.pv, self.sp - self.db)
+        self.co2_pid.man_request = self.man_co2
+        self.base_pid.man_request = self.man_base
+        self.mode = mode
+
+    def step(self, rand):
+        # co2 pid works on -pv so that "too high" is a positive error
+        self.co2 = self.co2_pid.step(-self.pv, -(self.sp + self.db))
+        self.base = self.base_pid.step(self.pv, self.sp - self.db)
+        self.pv += (7.2 - self.pv) / 20000 - self.co2 * 2e-5 + self.base * 2e-5 + rand() * 0.0005
+
+    def values(self, error=0):
+        return {
+            'manUp': float(self.man_base),
+            'outputDown': float(self.co2),
+            'error': error,
+            'pv': float(self.pv),
+            'sp': float(self.sp),
+            'manDown': float(self.man_co2),
+            'outputUp': float(self.base),
+            'mode': self.mode,
+            'interlocked': 0,
+        }
+
+
+class ReactorSim():
+    """
+    @param name: machine name (getDORAValues)
+    @param model: reactor size, 3, 15 or 80
+    @param speed: simulated seconds per real second
+    @param trend_interval: simulated seconds between trend samples
+    @param trend_points: trend samples kept (the default covers "7day"
+                         at the default interval)
+    @param max_catchup: most steps simulated in one advance(). A sim
+                        that falls further behind than this (a paused
+                        process, a huge speed) skips the difference.
+    @param seed: for the process noise
+    @param clock: monotonic clock, for tests
+    """
+    def __init__(self, name="Mock PBS 80", model=80, speed=1.0, trend_interval=5,
+                 trend_points=120960, max_catchup=3600, seed=None, clock=monotonic):
+        self.name = name
+        self.model = model
+        self._init_model(speed, trend_interval, trend_points, max_catchup, seed, clock)
+
+        self.config = self._default_config()
+        self.recipes = ['Default', 'CIP', 'Media Fill', 'Cell Expansion']
+        self.sequence = 'Idle'
+        self._sequence_end = 0
+
+        self.batches = []
+        self.batch = None
+        self.alarms = []          # [id, type, time string, message, acked]
+        self._next_alarm = 1
+
+    def _init_model(self, speed, trend_interval, trend_points, max_catchup, seed, clock):
+        """ Clock, process and trend history. Everything else (config,
+        batches, alarms) is kept the same way whatever does the
+        simulating, see mock.vfleet for the other way. """
+        self.speed = speed
+        self.trend_interval = trend_interval
+        self.max_catchup = max_catchup
+        self._clock = clock
+        self._lock = threading.RLock()
+        self._rng = random.Random(seed)
+        rng = self._rng
+        self._rand = lambda: rng.uniform(-1, 1)
+
+        # simulated seconds since start, and the wall clock time they
+        # start from (batch and alarm times are in simulated time)
+        self.t = 0
+        self._t0 = clock()
+        self.epoch = time()
+
+        model = self.model
+        self.temperature = Loop(25, 37, gain=0.3, tau=1800, ambient=25, pid=_pid(10, 20), noise=0.002)
+        self.agitation = Loop(0, 30, gain=1.5, tau=5, ambient=0, pid=_pid(1, 0.5), noise=0.05)
+        self.do = DOLoop(reactor_size=model, volume=model * 0.7)
+        self.ph = PHLoop()
+        self.maingas_mode = AUTO
+        self.maingas_man = 0.5
+        self.maingas = 0.5
+        self.level = model * 0.7
+        self.pressure = 0.0
+        self._deviating = {}      # group -> seconds out of band
+
+        self.trend_time = deque(maxlen=trend_points)
+        self.trend = {g: {s: deque(maxlen=trend_points) for s in series}
+                      for g, series in trend_series.items()}
+
+    # ----- clock -----
+
+    def now(self):
+        """ Current simulated wall clock time, unix seconds """
+        return self.epoch + self.t
+
+    def advance(self):
+        """ Step the model up to the clock.
+        @return: number of steps taken
+        """
+        with self._lock:
+            target = int((self._clock() - self._t0) * self.speed)
+            n = target - self.t
+            if n <= 0:
+                return 0
+            if n > self.max_catchup:
+                self.t += n - self.max_catchup
+                n = self.max_catchup
+            for _ in range(n):
+                self._step()
+            return n
+
+    def _step(self):
+        self.t += 1
+        rand = self._rand
+        self.temperature.step(rand)
+        self.agitation.step(rand)
+        self.ph.step(rand)
+        if self.maingas_mode == MAN:
+            self.maingas = self.maingas_man
+        self.do.main_gas = self.maingas if self.maingas_mode != OFF else 0
+        self.do.step(self.ph.co2 / 100)
+        self.pressure = 0.02 + rand() * 0.005
+        if self.t % self.trend_interval == 0:
+            self._sample()
+        if self.t % 10 == 0:
+            self._check_alarms(10)
+
+    def _sample(self):
+        self.trend_time.append(self.now())
+        tr = self.trend
+        for name, loop in (('agitation', self.agitation), ('temperature', self.temperature)):
+            g = tr[name]
+            g['pv'].append(loop.pv)
+            g['sp'].append(loop.sp)
+            g['output'].append(loop.output)
+        g = tr['do']
+        g['pv'].append(self.do.pv)
+        g['sp'].append(self.do.sp)
+        g['n2'].append(self.do.n2 * 100)
+        g['o2'].append(self.do.o2 * 100)
+        g = tr['ph']
+        g['pv'].append(self.ph.pv)
+        g['sp'].append(self.ph.sp)
+        g['co2'].append(self.ph.co2)
+        g['base'].append(self.ph.base)
+
+    # ----- alarms -----
+
+    # group -> (band, seconds out of band before alarming)
+    alarm_bands = {
+        'temperature': (2, 600),
+        'agitation': (10, 60),
+        'do': (20, 600),
+        'ph': (0.3, 600),
+    }
+
+    def _check_alarms(self, dt):
+        for group, (band, hold) in self.alarm_bands.items():
+            loop = getattr(self, group)
+            if loop.mode != AUTO or abs(loop.pv - loop.sp) <= band:
+                self._deviating[group] = 0
+                continue
+            was = self._deviating.get(group, 0)
+            self._deviating[group] = was + dt
+            if was < hold <= was + dt:
+                self.add_alarm(group.capitalize(), "%s PV %.2f is more than %g from SP %.2f" %
+                               (group, loop.pv, band, loop.sp))
+
+    def add_alarm(self, type, message):
+        with self._lock:
+            t = datetime.datetime.fromtimestamp(self.now()).strftime(date_format)
+            self.alarms.append([self._next_alarm, type, t, message, False])
+            self._next_alarm += 1
+
+    def get_alarms(self, start_id, n):
+        """ Up to n uncleared alarms with ID >= start_id """
+        self.advance()
+        with self._lock:
+            return [a for a in self.alarms if a[0] >= start_id][:n]
+
+    def unack_count(self):
+        self.advance()
+        return sum(1 for a in self.alarms if not a[4])
+
+    def clear_alarms(self, id=None, type=None):
+        """ Clear one alarm, all of a type, or all. Cleared alarms are
+        acknowledged and drop off the list. """
+        with self._lock:
+            self.alarms = [a for a in self.alarms
+                           if not (id is None and type is None
+                                   or id is not None and a[0] == id
+                                   or type is not None and a[1] == type)]
+
+    # ----- main values -----
+
+    def main_values(self):
+        self.advance()
+        with self._lock:
+            do = self.do
+            return {
+                'temperature': self.temperature.values(),
+                'agitation': self.agitation.values(),
+                'ph': self.ph.values(),
+                'do': do.values(),
+                'maingas': {
+                    'error': 0,
+                    'man': float(self.maingas_man),
+                    'mode': self.maingas_mode,
+                    'pv': float(self.do.main_gas),
+                    'interlocked': 0,
+                },
+                'MFCs': {
+                    'air': do.air * do.main_gas,
+                    'n2': do.n2 * do.main_gas,
+                    'o2': do.o2 * do.main_gas,
+                    'co2': do.co2 * do.main_gas,
+                },
+                'condenser': {
+                    'output': 0.0,
+                    'man': 0.0,
+                    'pv': 8.0,
+                    'sp': 8.0,
+                    'error': 0,
+                    'mode': AUTO,
+                },
+                'pressure': {'error': 0, 'pv': float(self.pressure)},
+                'level': {'error': 0, 'pv': float(self.level)},
+            }
+
+    def dora_values(self):
+        self.advance()
+        with self._lock:
+            if self.sequence != 'Idle' and self.t >= self._sequence_end:
+                self.sequence = 'Idle'
+            batch = self.batch
+            return {
+                'Machine Name': self.name,
+                'Batch': batch['Name'] if batch is not None else '--',
+                'Sequence': self.sequence,
+                'Batch Time': '%.1f' % ((self.now() - batch['_start']) / 3600) if batch is not None else '--',
+                'Temperature': '%.2f' % self.temperature.pv,
+                'DO': '%.2f' % self.do.pv,
+                'pH': '%.2f' % self.ph.pv,
+            }
+
+    def raw_value(self, sensor):
+        self.advance()
+        pv = {'pha': self.ph.pv, 'phb': self.ph.pv, 'doa': self.do.pv, 'dob': self.do.pv,
+              'level': self.level, 'pressure': self.pressure}.get(sensor.lower(), 0.0)
+        return pv * 100 + 1000
+
+    # ----- set calls -----
+
+    def set(self, group, mode, val1, val2=None):
+        """ call=set. Raises KeyError for an unknown group. """
+        self.advance()
+        with self._lock:
+            if group == 'maingas':
+                self.maingas_mode = mode
+                if mode == MAN:
+                    self.maingas_man = val1
+                elif mode == AUTO:
+                    self.maingas = val1
+            elif group == 'do':
+                self.do.set(mode, val1, val2)
+            elif group == 'ph':
+                self.ph.set(mode, val1, val2)
+            elif group in ('temperature', 'agitation'):
+                getattr(self, group).set(mode, val1)
+            else:
+                raise KeyError(group)
+
+    def _default_config(self):
+        ag, temp, do = self.agitation.pid, self.temperature.pid, self.do
+        return {
+            'Agitation': {
+                'P_Gain_(%/RPM)': float(ag.pgain),
+                'I_Time_(min)': ag.itime / 60,
+                'D_Time_(min)': ag.dtime / 60,
+                'Beta': float(ag.b),
+                'Auto_Max_Startup_(%)': 100.0,
+                'Minimum_(RPM)': 3.0,
+            },
+            'Temperature': {
+                'P_Gain_(%/C)': float(temp.pgain),
+                'I_Time_(min)': temp.itime / 60,
+                'D_Time_(min)': temp.dtime / 60,
+                'Beta': float(temp.b),
+            },
+            'DO': {
+                'N2_P_Gain_(%/%DO)': float(do.n2_pid.pgain),
+                'N2_I_Time_(min)': do.n2_pid.itime / 60,
+                'O2_P_Gain_(%/%DO)': float(do.o2_pid.pgain),
+                'O2_I_Time_(min)': do.o2_pid.itime / 60,
+                'Deadband_(%DO)': float(do.db),
+            },
+            'pH': {
+                'CO2_P_Gain_(%/pH)': float(self.ph.co2_pid.pgain),
+                'Base_P_Gain_(%/pH)': float(self.ph.base_pid.pgain),
+                'Deadband_(pH)': float(self.ph.db),
+            },
+            'System': {
+                'Model': float(self.model),
+                'Working_Volume_(L)': float(self.level),
+            },
+        }
+
+    def setconfig(self, group, name, val):
+        """ Raises KeyError for an unknown setting. """
+        with self._lock:
+            settings = self.config[group]
+            if name not in settings:
+                raise KeyError(name)
+            val = float(val)
+            settings[name] = val
+            pid = None
+            if group in ('Agitation', 'Temperature'):
+                pid = getattr(self, group.lower()).pid
+            elif group == 'DO' and name[:3] in ('N2_', 'O2_'):
+                pid = self.do.n2_pid if name.startswith('N2') else self.do.o2_pid
+                name = name[3:]
+            elif group == 'DO' and name.startswith('Deadband'):
+                self.do.db = val
+            if pid is not None:
+                if name.startswith('P_Gain'):
+                    pid.pgain = val
+                elif name.startswith('I_Time'):
+                    pid.itime = val * 60
+                elif name.startswith('D_Time'):
+                    pid.dtime = val * 60
+                elif name == 'Beta':
+                    pid.b = val
+
+    # ----- batches and recipes -----
+
+    def start_batch(self, name, user='user1'):
+        """ @return: False if a batch is already running """
+        self.advance()
+        with self._lock:
+            if self.batch is not None:
+                return False
+            now = self.now()
+            self.batch = {
+                'ID': len(self.batches) + 1,
+                'Name': name,
+                'Serial Number': 1000 + len(self.batches),
+                'User': user,
+                'Start Time': datetime.datetime.fromtimestamp(now).strftime(date_format),
+                'Stop Time': '',
+                'Product Number': "PBS %d" % self.model,
+                'Rev': 'A',
+                '_start': now,
+                '_stop': None,
+            }
+            self.batches.append(self.batch)
+            return True
+
+    def end_batch(self):
+        """ @return: False if there was no batch running """
+        self.advance()
+        with self._lock:
+            batch = self.batch
+            if batch is None:
+                return False
+            now = self.now()
+            batch['Stop Time'] = datetime.datetime.fromtimestamp(now).strftime(date_format)
+            batch['_stop'] = now
+            self.batch = None
+            return True
+
+    def batch_list(self):
+        """ Batches as getBatches sends them, oldest first """
+        with self._lock:
+            return [{k: v for k, v in b.items() if not k.startswith('_')} for b in self.batches]
+
+    def run_recipe(self, name, duration=600):
+        with self._lock:
+            if name not in self.recipes:
+                raise KeyError(name)
+            self.sequence = name
+            self._sequence_end = self.t + duration
+
+    # ----- trends and reports -----
+
+    def _trend_snapshot(self, group=None):
+        """
+        @param group: just this group's series, instead of all of them
+        @return: (sample times, {group: {series: values}}), as lists
+        """
+        with self._lock:
+            groups = self.trend if group is None else {group: self.trend[group]}
+            return list(self.trend_time), {g: {s: list(v) for s, v in series.items()}
+                                           for g, series in groups.items()}
+
+    def trend_data(self, group, span):
+        """ getTrendData reply: shared time axis, times in ms.
+        Raises KeyError for an unknown group or span. """
+        seconds = spans[span]
+        self.advance()
+        times, trend = self._trend_snapshot(group)
+        cutoff = self.now() - seconds
+        # samples are evenly spaced, no need to search
+        start = len(times) - min(len(times), seconds // self.trend_interval + 1)
+        while start < len(times) and times[start] < cutoff:
+            start += 1
+        out = {'time': [int(t * 1000) for t in times[start:]]}
+        for name, values in trend[group].items():
+            out[name] = values[start:]
+        return out
+
+    def report(self, start, stop):
+        """ Process data between two unix times, as csv bytes """
+        times, trend = self._trend_snapshot()
+        columns = [(g, s, v) for g, series in trend.items() for s, v in series.items()]
+        lines = ["Time," + ",".join("%s.%s" % (g, s) for g, s, _ in columns)]
+        for i, t in enumerate(times):
+            if t < start or stop is not None and t > stop:
+                continue
+            stamp = datetime.datetime.fromtimestamp(t).strftime("%m/%d/%Y %I:%M:%S %p")
+            lines.append(stamp + "," + ",".join("%.4f" % v[i] for _, _, v in columns))
+        lines.append("")
+        return "\r\n".join(lines).encode('utf-8')
+
+    def batch_report(self, batch_id):
+        """ Raises KeyError for an unknown batch """
+        with self._lock:
+            for b in self.batches:
+                if b['ID'] == batch_id:
+                    return self.report(b['_start'], b['_stop'])
+        raise KeyError(batch_id)
+
+    def __repr__(self):
+        return "<%s %r t=%d>" % (self.__class__.__name__, self.name, self.t)
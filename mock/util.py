@@ -115,7 +115,8 @@ def simple_xml_dump(root, encoding="windows-1252"):
     return b.getvalue().encode(encoding)
 
 
-from collections import Iterable, OrderedDict
+from collections import OrderedDict
+from collections.abc import Iterable
 
 
 def _iter_toxml(root, name, lst):
@@ -197,8 +198,29 @@ class HelloXMLGenerator():
     It is intended that a single instance is reused over and over,
     for efficiency.
 
+    create_hello_xml and hello_xml_from_obj skip the tree and write
+    straight to a list of strings, with the *_write functions in
+    write_types. Output is byte for byte what building the tree and
+    dumping it with simple_xml_dump gives (hello_tree_from_msg and
+    tree_to_xml still do that). Types with a tree function but no
+    write function are written by building a tree for just that
+    object.
+
     """
     def __init__(self):
+        self.write_types = {
+            str: self.str_write,
+            bytes: self.bytes_write,
+            int: self.int_write,
+            list: self.list_write,
+            tuple: self.list_write,
+            dict: self.dict_write,
+            float: self.float_write,
+            bool: self.bool_write,
+            OrderedDict: self.dict_write,
+            Element: self.ele_write,
+            type(_ for _ in ""): self.iter_write  # generator
+        }
         self.parse_types = {
             str: self.str_toxml,
             bytes: self.bytes_toxml,
@@ -213,8 +235,18 @@ class HelloXMLGenerator():
             type(_ for _ in ""): self.iter_toxml  # generator
         }
 
-    def register(self, typ, parsefunc):
+    def register(self, typ, parsefunc, writefunc=None):
+        """
+        @param parsefunc: func(obj, name, root), adds elements to root
+        @param writefunc: func(obj, name, out, tail="\n"), appends the
+                          same thing as text to list `out`. Without one,
+                          parsefunc's tree is dumped instead.
+        """
         self.parse_types[typ] = parsefunc
+        if writefunc is None:
+            self.write_types.pop(typ, None)
+        else:
+            self.write_types[typ] = writefunc
 
     def parse(self, obj, name, root):
         try:
@@ -246,7 +278,7 @@ class HelloXMLGenerator():
         self.list_toxml(obj, name, root)
 
     def int_toxml(self, obj, name, root):
-        int_ = SubElement(root, 'U32')
+        int_ = SubElement(root, 'I32')
         name_ele = SubElement(int_, "Name")
         name_ele.text = name
         val = SubElement(int_, "Val")
@@ -308,6 +340,102 @@ class HelloXMLGenerator():
         float_.tail = name_ele.tail = val.tail = "\n"
         float_.text = "\n"
 
+    # ----- direct to text -----
+
+    def write(self, obj, name, out):
+        try:
+            writefunc = self.write_types[type(obj)]
+        except KeyError:
+            return self.tree_write(obj, name, out)
+        return writefunc(obj, name, out)
+
+    def tree_write(self, obj, name, out):
+        """ For types without a write function: parse into a
+        throwaway root and dump whatever ended up in it. """
+        root = Element("Reply")
+        self.parse(obj, name, root)
+        b = StringIO()
+        for e in root:
+            _simple_xml_dump_inner_unicode(b, e)
+        out.append(b.getvalue())
+
+    def ele_write(self, obj, name, out, tail=None):
+        # elements keep their own tail unless told otherwise
+        b = StringIO()
+        _simple_xml_dump_inner_unicode(b, obj)
+        text = b.getvalue()
+        if tail is not None and obj.tail:
+            text = text[:-len(obj.tail)]
+        out.append(text)
+        if tail:
+            out.append(tail)
+
+    def bytes_write(self, obj, name, out, tail="\n"):
+        self.str_write(obj.decode('utf-8'), name, out, tail)
+
+    def str_write(self, obj, name, out, tail="\n"):
+        out.append(_scalar_text("String", name, obj, tail))
+
+    def iter_write(self, obj, name, out, tail="\n"):
+        self.list_write(tuple(obj), name, out, tail)
+
+    def int_write(self, obj, name, out, tail="\n"):
+        out.append(_scalar_text("I32", name, str(obj), tail))
+
+    def bool_write(self, obj, name, out, tail="\n"):
+        # 0 or 1, see bool_toxml
+        out.append(_scalar_text("Boolean", name, str(int(obj)), tail))
+
+    def float_write(self, obj, name, out, tail="\n"):
+        out.append(_scalar_text("SGL", name, str(obj), tail))
+
+    def list_write(self, obj, name, out, tail="\n"):
+        out.append(_cluster_head(name, len(obj)))
+        self._write_items(obj, out)
+        out.append("</Cluster>" + tail)
+
+    def dict_write(self, obj, name, out, tail="\n"):
+        out.append(_cluster_head(name, len(obj)))
+        self._write_items(obj.items(), out)
+        out.append("</Cluster>" + tail)
+
+    def _write_items(self, items, out):
+        # self.write, inlined. This loop is where all the time goes.
+        write_types = self.write_types
+        for name, item in items:
+            writefunc = write_types.get(type(item))
+            if writefunc is None:
+                self.tree_write(item, name, out)
+            else:
+                writefunc(item, name, out)
+
+    def write_hello_msg(self, msg, name=None, result="True"):
+        """ Text of the <Reply> element that hello_tree_from_msg
+        would build, or None if msg's type has no write function and
+        needs the tree path.
+        """
+        if isinstance(msg, bytes):
+            msg = msg.decode('utf-8', 'strict')
+        try:
+            iter(msg)
+        except TypeError:
+            msg = str(msg)
+
+        result = str(result)
+        out = ["<Reply>", "<Result>" + result + "</Result>" if result else "<Result/>"]
+        if isinstance(msg, str):
+            out.append("<Message>" + msg + "</Message>" if msg else "<Message/>")
+        else:
+            try:
+                writefunc = self.write_types[type(msg)]
+            except KeyError:
+                return None
+            out.append("<Message>")
+            writefunc(msg, name, out, "")
+            out.append("</Message>")
+        out.append("</Reply>")
+        return "".join(out)
+
     def _create_hello_tree_msg(self, msg, name, reply):
         if isinstance(msg, bytes):
             msg = msg.decode('utf-8', 'strict')
@@ -348,9 +476,12 @@ class HelloXMLGenerator():
 
         return reply
 
-    def hello_xml_from_obj(self, obj, name):
-        root = self.obj_to_xml(obj, name)
-        return simple_xml_dump(root)
+    def hello_xml_from_obj(self, obj, name, encoding="windows-1252"):
+        out = []
+        self.write(obj, name, out)
+        text = "".join(out)
+        text = "<Reply>" + text + "</Reply>" if text else "<Reply/>"
+        return ('<?xml version="1.0" encoding="%s" standalone="no" ?>' % encoding + text).encode(encoding)
 
     def obj_to_xml(self, obj, name, root=None):
         if root is None:
@@ -359,13 +490,34 @@ class HelloXMLGenerator():
         return root
 
     def create_hello_xml(self, msg, name=None, result="True", encoding='windows-1252'):
-        reply = self.hello_tree_from_msg(msg, name, result)
-        return simple_xml_dump(reply, encoding)
+        text = self.write_hello_msg(msg, name, result)
+        if text is None:
+            reply = self.hello_tree_from_msg(msg, name, result)
+            return simple_xml_dump(reply, encoding)
+        return ('<?xml version="1.0" encoding="%s" standalone="no" ?>' % encoding + text).encode(encoding)
 
     def tree_to_xml(self, tree, encoding):
         return simple_xml_dump(tree, encoding)
 
 
+# Empty Name and Val come out short, as in _simple_xml_dump_inner_unicode.
+# Concatenating (rather than %s) keeps the TypeError the tree path
+# gives for a name that isn't a str.
+
+def _scalar_text(typ, name, val, tail):
+    """ Text of the element tree *_toxml make for one scalar """
+    return "".join(("<", typ, ">\n",
+                    "<Name>" + name + "</Name>\n" if name else "<Name/>\n",
+                    "<Val>" + val + "</Val>\n" if val else "<Val/>\n",
+                    "</", typ, ">", tail))
+
+
+def _cluster_head(name, n):
+    return "".join(("<Cluster>\n",
+                    "<Name>" + name + "</Name>\n" if name else "<Name/>\n",
+                    "<NumElts>%d</NumElts>\n" % n))
+
+
 xml_generator = HelloXMLGenerator()
 create_hello_xml = xml_generator.create_hello_xml
 hello_tree_from_msg = xml_generator.hello_tree_from_msg
@@ -374,11 +526,14 @@ hello_xml_from_obj = xml_generator.hello_xml_from_obj
 
 from json import JSONEncoder
 from json.encoder import encode_basestring_ascii, encode_basestring, INFINITY
+from math import isfinite
 FLOAT_REPR = float.__repr__
+INT_REPR = int.__repr__
 
 
 def _make_iterencode(markers, _default, _encoder, _indent, _floatstr,
                      _key_separator, _item_separator, _sort_keys, _skipkeys, _one_shot,
+                     _float_format=None,
                      # # HACK: hand-optimized bytecode; turn globals into locals
                      ValueError=ValueError,
                      dict=dict,
@@ -389,16 +544,86 @@ def _make_iterencode(markers, _default, _encoder, _indent, _floatstr,
                      list=list,
                      str=str,
                      tuple=tuple,
+                     all=all,
+                     isfinite=isfinite,
+                     len=len,
+                     map=map,
+                     set=set,
+                     type=type,
+                     INT_REPR=INT_REPR,
 ):
-
+    """
+    @param _float_format: %-format that _floatstr uses for finite
+                          floats. If given, lists that are all floats,
+                          all ints or all strs are encoded with a
+                          single join over map(), which runs at C speed,
+                          and dicts of plain scalars with one join,
+                          instead of a chunk at a time.
+    """
 
     if _indent is not None and not isinstance(_indent, str):
         _indent = ' ' * _indent
 
+    def _join_scalars(lst, separator):
+        """ @return: encoded items of lst joined with separator, or
+        None if lst isn't one of the simple cases """
+        types = set(map(type, lst))
+        if len(types) != 1:
+            return None
+        typ = types.pop()
+        if typ is float:
+            # NaN and infinities go the long way, for their
+            # spelling and for allow_nan
+            if not all(map(isfinite, lst)):
+                return None
+            return separator.join(map(_float_format.__mod__, lst))
+        elif typ is int:
+            return separator.join(map(INT_REPR, lst))
+        elif typ is str:
+            return separator.join(map(_encoder, lst))
+        return None
+
+    if _float_format is not None:
+        _value_formats = {
+            float: _float_format.__mod__,
+            int: INT_REPR,
+            str: _encoder,
+            bool: {True: '1', False: '0'}.__getitem__,
+            type(None): lambda _: 'null',
+        }
+
+    def _join_items(dct, separator):
+        """ @return: encoded items of dct joined with separator, or
+        None if any key isn't a str or any value isn't a scalar """
+        if _sort_keys:
+            items = sorted(dct.items(), key=lambda kv: kv[0])
+        else:
+            items = dct.items()
+        parts = []
+        for key, value in items:
+            typ = type(value)
+            fmt = _value_formats.get(typ)
+            if fmt is None or type(key) is not str or typ is float and not isfinite(value):
+                return None
+            parts.append(_encoder(key) + _key_separator + fmt(value))
+        return separator.join(parts)
+
     def _iterencode_list(lst, _current_indent_level):
         if not lst:
             yield '[]'
             return
+        if _float_format is not None:
+            if _indent is not None:
+                newline_indent = '\n' + _indent * (_current_indent_level + 1)
+                items = _join_scalars(lst, _item_separator + newline_indent)
+                if items is not None:
+                    yield ''.join(('[', newline_indent, items, '\n', _indent * _current_indent_level, ']'))
+                    return
+            else:
+                items = _join_scalars(lst, _item_separator)
+                if items is not None:
+                    yield '[' + items + ']'
+                    return
         if markers is not None:
             markerid = id(lst)
             if markerid in markers:
@@ -455,6 +680,18 @@ def _make_iterencode(markers, _default, _encoder, _indent, _floatstr,
         if not dct:
             yield '{}'
             return
+        if _float_format is not None:
+            if _indent is not None:
+                newline_indent = '\n' + _indent * (_current_indent_level + 1)
+                items = _join_items(dct, _item_separator + newline_indent)
+                if items is not None:
+                    yield ''.join(('{', newline_indent, items, '\n', _indent * _current_indent_level, '}'))
+                    return
+            else:
+                items = _join_items(dct, _item_separator)
+                if items is not None:
+                    yield '{' + items + '}'
+                    return
         if markers is not None:
             markerid = id(dct)
             if markerid in markers:
@@ -567,7 +804,18 @@ class HelloJSONEncoder(JSONEncoder):
     there is no built-in (public), accessible way to control
     the json representation of floats. So, this subclass
     fixes that.
+
+    The C encoder can't be used: it always uses repr() for floats,
+    true/false for bools, and (before 3.13) doesn't indent. Instead,
+    with fast=True (the default), lists of plain floats, ints or strs
+    (trend data, mostly) are encoded in one go. Output is the same
+    either way.
     """
+    float_format = "%.5f"
+
+    def __init__(self, *, fast=True, **kw):
+        super().__init__(**kw)
+        self.fast = fast
     def iterencode(self, o, _one_shot=False):
         """Encode the given object and yield each string
         representation as available.
@@ -587,7 +835,7 @@ class HelloJSONEncoder(JSONEncoder):
         else:
             _encoder = encode_basestring
 
-        def floatstr(o, allow_nan=self.allow_nan,
+        def floatstr(o, allow_nan=self.allow_nan, float_format=self.float_format,
                      _repr=FLOAT_REPR, _inf=INFINITY, _neginf=-INFINITY):
             # Check for specials.  Note that this type of test is processor
             # and/or platform-specific, so do tests which don't depend on the
@@ -600,7 +848,7 @@ class HelloJSONEncoder(JSONEncoder):
             elif o == _neginf:
                 text = '-Infinity'
             else:
-                return "%.5f" % o
+                return float_format % o
 
             if not allow_nan:
                 raise ValueError(
@@ -612,7 +860,7 @@ class HelloJSONEncoder(JSONEncoder):
         _iterencode = _make_iterencode(
             markers, self.default, _encoder, self.indent, floatstr,
             self.key_separator, self.item_separator, self.sort_keys,
-                self.skipkeys, _one_shot)
+                self.skipkeys, _one_shot, self.float_format if self.fast else None)
         return _iterencode(o, 0)
 
 
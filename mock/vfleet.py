@@ -0,0 +1,580 @@
+"""
+Many simulated reactors in one mock server process, for testing fleet
+scale polling.
+
+    python -m hello.mock.vfleet -n 200 [--port 9000] [--speed 1]
+
+FleetSim simulates N reactors with the same models as mock.sim's
+ReactorSim, but with every reactor's state in numpy arrays, so that a
+step of the whole fleet is one vectorized update: 500 reactors cost
+about what a handful do. Each reactor is a VirtualReactor, which is a
+ReactorSim whose process values are views into the fleet's arrays, so
+it keeps its own config, batches, alarms and recipes and works with an
+unmodified HelloService.
+
+VirtualFleet serves every reactor on its own port (consecutive ports
+from `port`, or any free ones), all from one accept loop:
+
+    with VirtualFleet(200, speed=60) as vf:
+        fleet = HelloFleet(vf.addresses)
+        ...
+
+Windows' select() handles at most 512 sockets, which caps a fleet
+there at about 500 reactors.
+"""
+from time import monotonic, time
+import argparse
+import selectors
+import sys
+import threading
+
+import numpy as np
+
+from hello.mock.server import HelloService, MockHelloServer
+from hello.mock.sim import ReactorSim, Loop, DOLoop, PHLoop, AUTO, MAN, OFF, trend_series
+from hello.pid.do_simulation.doprocess import DOProcess, TOTAL_RVOLUME, AIR_CNO
+
+__author__ = 'Nathan Starkweather'
+
+
+class VecPID():
+    """ pid.lvpid.PIDController for an array of loops at once. Only what
+    the sims use is covered: linearity 1, gamma 0, no alpha filter.
+    Every attribute is an array of `shape`. Times are given in minutes
+    and kept in seconds, as in PIDController.
+    """
+    def __init__(self, shape, pgain=1, itime=1, dtime=0, auto_max=100, auto_min=0, beta=1):
+        def full(v):
+            return np.array(np.broadcast_to(v, shape), dtype=np.float64)
+        self.pgain = full(pgain)
+        self.itime = full(itime) * 60
+        self.oneoveritime = np.divide(1, self.itime, out=np.zeros(shape), where=self.itime != 0)
+        self.dtime = full(dtime) * 60
+        self.auto_max = full(auto_max)
+        self.auto_min = full(auto_min)
+        self.b = full(beta)
+        self.man_request = np.zeros(shape)
+        self.mode = np.full(shape, AUTO, dtype=np.int8)
+        self.Ui = np.zeros(shape)
+        self.last_err = np.zeros(shape)
+        self.last_gerr = np.zeros(shape)
+
+    def set_itime(self, idx, v):
+        """ itime in seconds, like PIDController.itime """
+        self.itime[idx] = v
+        self.oneoveritime[idx] = 1 / v if v else 0
+
+    def set_mode(self, idx, m, pv, sp):
+        if m not in (AUTO, MAN, OFF):
+            raise ValueError(m)
+        mode = self.mode[idx]
+        if m == mode:
+            return
+        elif mode == OFF and m == AUTO:
+            self.man_to_auto(idx, pv, sp, 0)
+        elif mode == MAN and m == AUTO:
+            self.man_to_auto(idx, pv, sp, self.man_request[idx])
+        elif m == MAN:
+            self.man_request[idx] = sp
+        self.mode[idx] = m
+
+    def man_to_auto(self, idx, pv, sp, op):
+        self.Ui[idx] = op - self.pgain[idx] * (self.b[idx] * sp - pv)
+        self.last_err[idx] = sp - pv
+        self.last_gerr[idx] = -pv
+
+    def off_to_auto(self, idx, pv, sp):
+        self.man_to_auto(idx, pv, sp, 0)
+
+    def step(self, pv, sp):
+        err = sp - pv
+        gerr = -pv
+        up = self.pgain * (self.b * sp - pv)
+        ui = self.Ui + (err + self.last_err) * 0.5 * self.pgain * self.oneoveritime
+        ud = (gerr - self.last_gerr) * self.pgain * self.dtime
+        uk = up + ui + ud
+        # coercion and back calculation
+        clipped = (uk > self.auto_max) | (uk < self.auto_min)
+        np.minimum(uk, self.auto_max, out=uk)
+        np.maximum(uk, self.auto_min, out=uk)
+        ui = np.where(clipped, uk - up, ui)
+        # loops that aren't in auto keep their state, as in PIDController
+        auto = self.mode == AUTO
+        self.Ui = np.where(auto, ui, self.Ui)
+        self.last_err = np.where(auto, err, self.last_err)
+        self.last_gerr = np.where(auto, gerr, self.last_gerr)
+        return np.where(auto, uk, np.where(self.mode == MAN, self.man_request, 0.0))
+
+
+# rows of FleetSim.pid. co2 and n2 are reverse acting and get -pv, -sp.
+TEMP, AG, CO2, BASE, N2, O2 = range(6)
+_pid_sign = np.array([1, 1, -1, 1, -1, 1], dtype=np.float64)[:, None]
+
+
+def _cell(array):
+    """ Property for this view's element of the fleet's `array`. """
+    def get(self):
+        return getattr(self.fleet, array)[self.idx].item()
+
+    def set(self, v):
+        getattr(self.fleet, array)[self.idx] = v
+    return property(get, set)
+
+
+class _PIDView():
+    """ One row/reactor of a VecPID, looking like a PIDController """
+    def __init__(self, pid, idx):
+        self.pid = pid
+        self.idx = idx
+
+    def _get(name):
+        def get(self):
+            return getattr(self.pid, name)[self.idx].item()
+
+        def set(self, v):
+            getattr(self.pid, name)[self.idx] = v
+        return property(get, set)
+
+    pgain = _get('pgain')
+    dtime = _get('dtime')
+    b = _get('b')
+    man_request = _get('man_request')
+    auto_max = _get('auto_max')
+    auto_min = _get('auto_min')
+    mode = property(lambda self: self.pid.mode[self.idx].item())
+    del _get
+
+    @property
+    def itime(self):
+        return self.pid.itime[self.idx].item()
+
+    @itime.setter
+    def itime(self, v):
+        self.pid.set_itime(self.idx, v)
+
+    def set_mode(self, m, pv, sp):
+        self.pid.set_mode(self.idx, m, pv, sp)
+
+    def off_to_auto(self, pv, sp):
+        self.pid.off_to_auto(self.idx, pv, sp)
+
+
+class _LoopView(Loop):
+    def __init__(self, fleet, row, i):
+        self.fleet = fleet
+        self.idx = row, i
+        self.pid = _PIDView(fleet.pid, (row, i))
+
+    pv = _cell('lpv')
+    sp = _cell('lsp')
+    man = _cell('lman')
+    output = _cell('lout')
+    mode = _cell('lmode')
+    gain = _cell('lgain')
+    tau = _cell('ltau')
+
+
+class _DOView(DOLoop):
+    def __init__(self, fleet, i):
+        self.fleet = fleet
+        self.idx = i
+        self.n2_pid = _PIDView(fleet.pid, (N2, i))
+        self.o2_pid = _PIDView(fleet.pid, (O2, i))
+
+    pv = _cell('do_pv')
+    sp = _cell('do_sp')
+    db = _cell('do_db')
+    mode = _cell('do_mode')
+    man_n2 = _cell('do_man_n2')
+    man_o2 = _cell('do_man_o2')
+    main_gas = _cell('do_main_gas')
+    co2 = _cell('do_co2')
+    n2 = _cell('do_n2')
+    o2 = _cell('do_o2')
+    air = _cell('do_air')
+
+
+class _PHView(PHLoop):
+    def __init__(self, fleet, i):
+        self.fleet = fleet
+        self.idx = i
+        self.co2_pid = _PIDView(fleet.pid, (CO2, i))
+        self.base_pid = _PIDView(fleet.pid, (BASE, i))
+
+    pv = _cell('ph_pv')
+    sp = _cell('ph_sp')
+    db = _cell('ph_db')
+    mode = _cell('ph_mode')
+    man_co2 = _cell('ph_man_co2')
+    man_base = _cell('ph_man_base')
+    co2 = _cell('ph_co2')
+    base = _cell('ph_base')
+
+
+class VirtualReactor(ReactorSim):
+    """ One reactor of a FleetSim. Config, batches, alarms and recipes
+    are its own; the clock, process and trend history are the fleet's.
+    """
+    def __init__(self, fleet, index, name, model=80):
+        self.fleet = fleet
+        self.idx = index
+        super().__init__(name, model)
+
+    def _init_model(self, *args):
+        f, i = self.fleet, self.idx
+        self._lock = f._lock
+        self.temperature = _LoopView(f, 0, i)
+        self.agitation = _LoopView(f, 1, i)
+        self.ph = _PHView(f, i)
+        self.do = _DOView(f, i)
+
+    maingas_mode = _cell('maingas_mode')
+    maingas_man = _cell('maingas_man')
+    maingas = _cell('maingas')
+    level = _cell('level')
+    pressure = _cell('pressure')
+
+    t = property(lambda self: self.fleet.t)
+    epoch = property(lambda self: self.fleet.epoch)
+    trend_interval = property(lambda self: self.fleet.trend_interval)
+
+    def advance(self):
+        return self.fleet.advance()
+
+    def _trend_snapshot(self, group=None):
+        return self.fleet.trend_snapshot(self.idx, group)
+
+
+class FleetSim():
+    """
+    @param n: number of reactors
+    @param models: reactor size for all of them, or one per reactor
+    @param names: machine names, default "Virtual 1", "Virtual 2"...
+    @param speed, max_catchup, seed, clock: as for ReactorSim
+    @param trend_interval: simulated seconds between trend samples
+    @param trend_points: trend samples kept per reactor. History is
+                         n * 14 series * trend_points float32s, so the
+                         default is much shorter than ReactorSim's.
+    """
+    def __init__(self, n, models=80, names=None, speed=1.0, trend_interval=30, trend_points=720,
+                 max_catchup=3600, seed=None, clock=monotonic):
+        self.n = n
+        self.speed = speed
+        self.trend_interval = trend_interval
+        self.max_catchup = max_catchup
+        self._clock = clock
+        self._lock = threading.RLock()
+        self._rng = np.random.default_rng(seed)
+        self.t = 0
+        self._t0 = clock()
+        self.epoch = time()
+
+        models = np.array(np.broadcast_to(models, n), dtype=np.int64)
+        volume = models * 0.7
+
+        def full(v, dtype=np.float64, rows=None):
+            return np.full(n if rows is None else (rows, n), v, dtype=dtype)
+
+        # temperature and agitation (rows 0 and 1), as in ReactorSim._init_model
+        col = np.array
+        self.lpv = col([full(25.0), full(0.0)])
+        self.lsp = col([full(37.0), full(30.0)])
+        self.lman = full(0.0, rows=2)
+        self.lout = full(0.0, rows=2)
+        self.lmode = full(AUTO, np.int8, 2)
+        self.lgain = col([full(0.3), full(1.5)])
+        self.ltau = col([full(1800.0), full(5.0)])
+        self.lambient = col([full(25.0), full(0.0)])
+        self.lnoise = col([[0.002], [0.05]])
+
+        self.pid = VecPID((6, n),
+                          pgain=[[10], [1], [20], [20], [5], [2]],
+                          itime=[[20], [0.5], [10], [10], [5], [10]],
+                          auto_max=[[100], [100], [100], [100], [90], [100]])
+
+        self.ph_pv = full(7.1)
+        self.ph_sp = full(7.0)
+        self.ph_db = full(0.05)
+        self.ph_mode = full(AUTO, np.int8)
+        self.ph_man_co2 = full(0.0)
+        self.ph_man_base = full(0.0)
+        self.ph_co2 = full(0.0)
+        self.ph_base = full(0.0)
+
+        self.do_pv = full(90.0)
+        self.do_sp = full(40.0)
+        self.do_db = full(1.0)
+        self.do_mode = full(AUTO, np.int8)
+        self.do_man_n2 = full(0.0)
+        self.do_man_o2 = full(0.0)
+        self.do_main_gas = full(0.5)
+        self.do_co2 = full(0.0)
+        self.do_n2 = full(0.0)
+        self.do_o2 = full(0.0)
+        self.do_air = full(1.0)
+        # DOProcess and its HeadspaceProcess, see DOLoop
+        self.do_k = full(DOProcess.default_k / 3600 * 1.1)
+        self.do_c = full(10 / 3600)
+        self.hs_vol = np.array([TOTAL_RVOLUME[m] for m in models], dtype=np.float64) - volume
+        self.hs_co2 = full(AIR_CNO[0])
+        self.hs_n2 = full(AIR_CNO[1])
+        self.hs_o2 = full(AIR_CNO[2])
+        self.hs_air = full(1 - sum(AIR_CNO))
+
+        self.maingas_mode = full(AUTO, np.int8)
+        self.maingas_man = full(0.5)
+        self.maingas = full(0.5)
+        self.level = volume
+        self.pressure = full(0.0)
+
+        # bumpless start for the gas loops, as in DOLoop and PHLoop
+        for row, pv, sp in ((CO2, -self.ph_pv, -(self.ph_sp + self.ph_db)),
+                            (BASE, self.ph_pv, self.ph_sp - self.ph_db),
+                            (N2, -self.do_pv, -(self.do_sp + self.do_db)),
+                            (O2, self.do_pv, self.do_sp - self.do_db)):
+            self.pid.man_to_auto(row, pv, sp, 0)
+
+        self._series = [(g, s) for g, series in trend_series.items() for s in series]
+        self.trend_time = np.zeros(trend_points)
+        self.trend = np.zeros((n, len(self._series), trend_points), dtype=np.float32)
+        self._trend_count = 0
+
+        self._bands = [(g, band, hold, full(0, np.int64))
+                       for g, (band, hold) in ReactorSim.alarm_bands.items()]
+
+        self._pv = np.empty((6, n))
+        self._sp = np.empty((6, n))
+
+        if names is None:
+            names = ["Virtual %d" % (i + 1) for i in range(n)]
+        self.reactors = [VirtualReactor(self, i, name, int(m))
+                         for i, (name, m) in enumerate(zip(names, models))]
+
+    def advance(self):
+        """ Step every reactor up to the clock.
+        @return: number of steps taken
+        """
+        with self._lock:
+            target = int((self._clock() - self._t0) * self.speed)
+            n = target - self.t
+            if n <= 0:
+                return 0
+            if n > self.max_catchup:
+                self.t += n - self.max_catchup
+                n = self.max_catchup
+            for _ in range(n):
+                self._step()
+            return n
+
+    def _step(self):
+        self.t += 1
+        noise = self._rng.uniform(-1, 1, (4, self.n))
+
+        # every pid in the fleet at once
+        pv, sp = self._pv, self._sp
+        pv[:2] = self.lpv
+        pv[CO2] = pv[BASE] = self.ph_pv
+        pv[N2] = pv[O2] = self.do_pv
+        sp[:2] = self.lsp
+        sp[CO2] = self.ph_sp + self.ph_db
+        sp[BASE] = self.ph_sp - self.ph_db
+        sp[N2] = self.do_sp + self.do_db
+        sp[O2] = self.do_sp - self.do_db
+        out = self.pid.step(pv * _pid_sign, sp * _pid_sign)
+
+        # Loop.step
+        self.lout = out[:2]
+        self.lpv += (self.lambient + self.lgain * self.lout - self.lpv) / self.ltau + noise[:2] * self.lnoise
+
+        # PHLoop.step
+        self.ph_co2 = co2 = out[CO2]
+        self.ph_base = base = out[BASE]
+        self.ph_pv += (7.2 - self.ph_pv) / 20000 - co2 * 2e-5 + base * 2e-5 + noise[2] * 0.0005
+
+        # ReactorSim._step's main gas, then DOLoop.step
+        man = self.maingas_mode == MAN
+        self.maingas = np.where(man, self.maingas_man, self.maingas)
+        self.do_main_gas = np.where(self.maingas_mode != OFF, self.maingas, 0.0)
+        mg = np.maximum(self.do_main_gas, 0.01)
+        self._gas_request(mg, co2 / 100, out[N2] / 100, out[O2] / 100)
+        self._headspace(mg)
+        pv = self.do_pv + self.do_k * (self.hs_o2 * 100 / 0.2095 - self.do_pv) - self.do_c
+        self.do_pv = np.maximum(pv, 0.0)
+
+        self.pressure = 0.02 + noise[3] * 0.005
+        if self.t % self.trend_interval == 0:
+            self._sample()
+        if self.t % 10 == 0:
+            self._check_alarms(10)
+
+    def _gas_request(self, main_gas, co2_req, n2_req, o2_req):
+        """ GasController(1, 10, 10, 10).request """
+        mg = np.minimum(main_gas, 10)
+        co2 = np.minimum(np.minimum(co2_req, 1), 1 / mg)
+        o2 = np.minimum(np.minimum(o2_req, 1 - co2), 10 / mg)
+        n2 = np.minimum(np.minimum(n2_req, 1 - co2 - o2), 10 / mg)
+        self.do_co2, self.do_n2, self.do_o2 = co2, n2, o2
+        self.do_air = 1 - co2 - o2 - n2
+
+    def _headspace(self, main_gas):
+        """ HeadspaceProcess.calc_gas """
+        mg = main_gas / 60
+        vol = self.hs_vol
+        air = mg * self.do_air
+        self.hs_co2 = (mg * self.do_co2 + 0.0004 * air - mg * self.hs_co2) / vol + self.hs_co2
+        self.hs_n2 = (mg * self.do_n2 + 0.7809 * air - mg * self.hs_n2) / vol + self.hs_n2
+        self.hs_o2 = (mg * self.do_o2 + 0.2095 * air - mg * self.hs_o2) / vol + self.hs_o2
+        self.hs_air = (0.0092 * air - mg * self.hs_air) / vol + self.hs_air
+
+    def _sample(self):
+        pos = self._trend_count % self.trend_time.shape[0]
+        self.trend_time[pos] = self.epoch + self.t
+        lpv, lsp, lout = self.lpv, self.lsp, self.lout
+        # same order as trend_series
+        rows = (lpv[1], lsp[1], lout[1], lpv[0], lsp[0], lout[0],
+                self.do_pv, self.do_sp, self.do_n2 * 100, self.do_o2 * 100,
+                self.ph_pv, self.ph_sp, self.ph_co2, self.ph_base)
+        self.trend[:, :, pos] = np.array(rows).T
+        self._trend_count += 1
+
+    def _check_alarms(self, dt):
+        reactors = self.reactors
+        for group, band, hold, deviating in self._bands:
+            if group in ('temperature', 'agitation'):
+                row = 0 if group == 'temperature' else 1
+                mode, pv, sp = self.lmode[row], self.lpv[row], self.lsp[row]
+            else:
+                mode = getattr(self, group + '_mode')
+                pv = getattr(self, group + '_pv')
+                sp = getattr(self, group + '_sp')
+            out = (mode == AUTO) & (np.abs(pv - sp) > band)
+            was = deviating.copy()
+            deviating[:] = np.where(out, was + dt, 0)
+            for i in np.flatnonzero(out & (was < hold) & (deviating >= hold)):
+                reactors[i].add_alarm(group.capitalize(), "%s PV %.2f is more than %g from SP %.2f" %
+                                      (group, pv[i], band, sp[i]))
+
+    def trend_snapshot(self, i, group=None):
+        """ VirtualReactor._trend_snapshot for reactor i """
+        with self._lock:
+            points = self.trend_time.shape[0]
+            count = self._trend_count
+            if count <= points:
+                order = slice(0, count)
+            else:
+                order = np.roll(np.arange(points), -(count % points))
+            times = self.trend_time[order].tolist()
+            data = self.trend[i][:, order]
+            out = {}
+            for j, (g, s) in enumerate(self._series):
+                if group is None or g == group:
+                    out.setdefault(g, {})[s] = data[j].tolist()
+        if group is not None and group not in out:
+            raise KeyError(group)
+        return times, out
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        return self.reactors[i]
+
+
+class VirtualFleet():
+    """ FleetSim's reactors served on one port each, from one thread
+    that accepts for all of them (connections then get a thread each,
+    as with MockHelloServer).
+
+    @param n: number of reactors
+    @param port: first port, the rest follow on. 0 for any free ports.
+    @param sim: FleetSim to serve, or None to make one from kw
+    @param service_kw: passed to every HelloService
+    """
+    def __init__(self, n=None, host='127.0.0.1', port=0, certfile=None, keyfile=None, sim=None,
+                 service_kw=None, **kw):
+        if sim is None:
+            sim = FleetSim(n, **kw)
+        self.sim = sim
+        self.servers = []
+        try:
+            for i, reactor in enumerate(sim.reactors):
+                service = HelloService(reactor, **(service_kw or {}))
+                self.servers.append(MockHelloServer(service, host, port + i if port else 0,
+                                                    certfile, keyfile))
+        except OSError:
+            self._close_servers()
+            raise
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def addresses(self):
+        return [s.address for s in self.servers]
+
+    def serve_forever(self, poll_interval=0.5):
+        with selectors.DefaultSelector() as sel:
+            for s in self.servers:
+                sel.register(s.httpd, selectors.EVENT_READ, s.httpd)
+            while not self._stop.is_set():
+                for key, _ in sel.select(poll_interval):
+                    key.data.handle_request()
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self.serve_forever, daemon=True,
+                                            name="VirtualFleet x%d" % len(self.servers))
+            self._thread.start()
+        return self
+
+    def close(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self._close_servers()
+
+    def _close_servers(self):
+        for s in self.servers:
+            s.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Many simulated reactors behind mock Hello webservers")
+    p.add_argument('-n', type=int, default=100, help="number of reactors")
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--port', type=int, default=9000, help="first port, 0 for any free ports")
+    p.add_argument('--speed', type=float, default=1.0, help="simulated seconds per second")
+    p.add_argument('--tls', nargs=2, metavar=('CERT', 'KEY'), help="serve https")
+    p.add_argument('--control', action='store_true',
+                   help="print addresses one per line, then read commands from stdin: "
+                        "'cpu' prints this process's cpu seconds, EOF quits")
+    args = p.parse_args(argv)
+    certfile, keyfile = args.tls or (None, None)
+    vf = VirtualFleet(args.n, args.host, args.port, certfile, keyfile, speed=args.speed)
+    if args.control:
+        with vf:
+            print("\n".join(vf.addresses))
+            print(flush=True)
+            for line in sys.stdin:
+                if line.strip() == 'cpu':
+                    from time import process_time
+                    print(process_time(), flush=True)
+        return
+    print("Serving %d reactors on %s .. %s" % (args.n, vf.addresses[0], vf.addresses[-1]))
+    try:
+        with vf:
+            while True:
+                threading.Event().wait(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
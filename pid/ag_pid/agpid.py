@@ -308,7 +308,11 @@ class PIDTest():
 
     def start_batch(self):
         self.app.login()
-        batches = self.app.getbatches()
+        # hello (2.x) apps don't have a catalog
+        if hasattr(self.app, 'batch_catalog'):
+            batches = self.app.batch_catalog()
+        else:
+            batches = self.app.getBatches()
         i = 1
         fmt = "pid #%d"
         s = fmt % i
@@ -1,6 +1,5 @@
 from hello.pid.delay import hours, minutes
 import numpy as np
-import peakutils
 
 
 class Fitness2():
@@ -89,6 +88,7 @@ def peaks(x, pv, sp=150, band=5, thresh=0.1):
     return _peaks(pv, t, len(x), thresh)
 
 def _peaks(x, start, end, thresh=0.5):
+    import peakutils
     return peakutils.indexes(x[start:end], thres=thresh,min_dist=5*minutes) + start
 
 
@@ -1,4 +1,3 @@
-from matplotlib.ticker import MultipleLocator, FuncFormatter
 import numpy as np
 
 class RingBuffer():
@@ -217,6 +216,7 @@ class Plot():
         self._hline = self.ax.axhline(y=y, **kw)
         
     def set_tick_interval(self, n):
+        from matplotlib.ticker import MultipleLocator
         l = MultipleLocator(n)
         self.ax.xaxis.set_major_locator(l)
         
@@ -259,6 +259,7 @@ class PVPlot(Plot):
             ("pv", dict(color="blue", ls="-", label="PV")),
             ("c", dict(color="green", ls="-", label="c"))
         ]
+        from matplotlib.ticker import FuncFormatter
         fm = FuncFormatter(lambda y, _: "%.2f%%"%y)
         super().__init__(ax, xdata, pts, fm, *series)
         self.c.line.set_visible(False)
@@ -282,6 +283,7 @@ class GasesPlot(Plot):
             ("o2", dict(color="green", ls="-", label="O2")),
             ("air", dict(color="cyan", ls="-", label="Air")),
         ]
+        from matplotlib.ticker import FuncFormatter
         fm = FuncFormatter(lambda y, _: "%d%%"%(y*100))
         super().__init__(ax, xdata, pts, fm, *series)
         self.ax.set_ylim((-0.05, 1.1))
@@ -0,0 +1,336 @@
+"""
+Export many reports from one or more reactors at once.
+
+    exporter = ReportExporter("C:\\exports\\campaign 7")
+    results = exporter.export_batches(app, [101, 102, 103])
+    results += exporter.export_dates(app, [(d1, d2)])
+
+Each report takes two steps: getReport, which makes the server
+generate the file (slow, and mostly server side), then getfile to
+download it. The exporter runs these as a pipeline with separate
+per-reactor limits on how many reports are being generated and how
+many are being downloaded at once, so the next report is generated
+while the last one downloads. Reports stream straight to disk.
+
+A manifest in the export folder remembers what was exported. A batch
+that had already finished when it was exported, and whose file is
+still there at the same size, is skipped next time. So is a date
+range that was entirely in the past when it was exported.
+"""
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.client import HTTPException
+from time import time
+import json
+import logging
+import os
+import re
+import threading
+
+from hello.hello3 import HelloError
+from hello.transport import PoolTimeout
+
+__author__ = 'Nathan Starkweather'
+
+_logger = logging.getLogger(__name__)
+
+
+class ExportResult():
+    """ Outcome of one report export. """
+    __slots__ = ('key', 'path', 'skipped', 'error', 'nbytes', 'elapsed')
+
+    def __init__(self, key, path, skipped=False, error=None, nbytes=0, elapsed=0.0):
+        self.key = key
+        self.path = path
+        self.skipped = skipped
+        self.error = error
+        self.nbytes = nbytes
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        if self.error is not None:
+            what = "error=%r" % (self.error,)
+        elif self.skipped:
+            what = "skipped"
+        else:
+            what = "%d bytes in %.1fs" % (self.nbytes, self.elapsed)
+        return "%s(%r, %s)" % (self.__class__.__name__, self.key, what)
+
+
+def _safe_name(s):
+    return re.sub(r'[<>:"/\\|?*\x00-\x1f]', "_", str(s)).strip(" .")
+
+
+class _Job():
+    __slots__ = ('app', 'key', 'path', 'stamp', 'final', 'make_report',
+                 'start', 'fname', 'future')
+
+    def __init__(self, app, key, path, stamp, final, make_report):
+        self.app = app
+        self.key = key
+        self.path = path
+        self.stamp = stamp
+        self.final = final
+        self.make_report = make_report
+        self.start = None
+        self.fname = None
+        self.future = Future()
+
+
+class _ReactorQueue():
+    """ One reactor's jobs waiting on its generate and download limits.
+    Jobs only go to the pool once a slot is free, so pool threads never
+    sit blocked on a reactor's limit while other reactors have work. """
+    def __init__(self, generate, download):
+        self.generate = generate
+        self.download = download
+        self.generating = 0
+        self.downloading = 0
+        self.to_generate = deque()
+        self.to_download = deque()
+
+
+class ReportExporter():
+    """
+    @param folder: where reports (and the manifest) are written
+    @param generate: reports each reactor may be generating at once
+    @param download: reports each reactor may be downloading at once
+    @param max_workers: threads shared by all reactors
+    @param progress: optional callback progress(ExportResult), called
+                     as each report finishes, fails or is skipped
+    """
+    manifest_name = "export_manifest.json"
+
+    def __init__(self, folder, generate=1, download=2, max_workers=8, progress=None):
+        self.folder = folder
+        self.generate = generate
+        self.download = download
+        self.progress = progress
+        os.makedirs(folder, exist_ok=True)
+
+        self._pool = ThreadPoolExecutor(max_workers, thread_name_prefix="ReportExporter")
+        self._lock = threading.Lock()
+        self._queue_lock = threading.Lock()
+        self._queues = {}
+        self._manifest_path = os.path.join(folder, self.manifest_name)
+        self._manifest = self._load_manifest()
+
+    # ----- manifest -----
+
+    def _load_manifest(self):
+        try:
+            with open(self._manifest_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            _logger.warning("Ignoring unreadable export manifest %s: %s", self._manifest_path, e)
+            return {}
+
+    def _record(self, key, entry):
+        with self._lock:
+            self._manifest[key] = entry
+            tmp = self._manifest_path + ".tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(self._manifest, f, indent=1, sort_keys=True)
+            os.replace(tmp, self._manifest_path)
+
+    def _unchanged(self, key, path, stamp):
+        """ True if `key` was exported before with the same `stamp`,
+        was final at the time, and its file is still intact. """
+        entry = self._manifest.get(key)
+        if entry is None or not entry.get('final') or entry.get('stamp') != stamp:
+            return False
+        try:
+            return os.path.getsize(path) == entry['size']
+        except OSError:
+            return False
+
+    # ----- pipeline -----
+
+    def _reactor_queue(self, app):
+        q = self._queues.get(app.ipv4)
+        if q is None:
+            q = self._queues[app.ipv4] = _ReactorQueue(self.generate, self.download)
+        return q
+
+    def _pump(self, q):
+        """ Hand `q`'s waiting jobs to the pool, as far as its limits allow.
+        Call with _queue_lock held. """
+        while q.downloading < q.download and q.to_download:
+            q.downloading += 1
+            self._pool.submit(self._download, q, q.to_download.popleft())
+        while q.generating < q.generate and q.to_generate:
+            q.generating += 1
+            self._pool.submit(self._generate, q, q.to_generate.popleft())
+
+    def _generate(self, q, job):
+        job.start = time()
+        try:
+            job.fname = job.make_report()
+        except Exception as e:
+            self._finish(job, e)
+            job = None
+        finally:
+            with self._queue_lock:
+                q.generating -= 1
+                if job is not None:
+                    q.to_download.append(job)
+                self._pump(q)
+
+    def _download(self, q, job):
+        try:
+            # a leftover .part is from some earlier generation of this
+            # report, not necessarily byte-identical to this one
+            try:
+                os.remove(job.path + ".part")
+            except FileNotFoundError:
+                pass
+            # getfile raises on anything but a 200/206 and only moves
+            # the file into place once all of it has arrived, so getting
+            # past here means the file on disk is the whole report
+            job.app.getfile(job.fname, job.path)
+            nbytes = os.path.getsize(job.path)
+            self._record(job.key, {'file': os.path.basename(job.path), 'size': nbytes,
+                                   'stamp': job.stamp, 'final': job.final, 'exported': time()})
+        except Exception as e:
+            self._finish(job, e)
+        else:
+            self._finish(job, None, nbytes)
+        finally:
+            with self._queue_lock:
+                q.downloading -= 1
+                self._pump(q)
+
+    def _finish(self, job, error, nbytes=0):
+        elapsed = time() - job.start
+        if error is None:
+            result = ExportResult(job.key, job.path, nbytes=nbytes, elapsed=elapsed)
+        elif isinstance(error, (HelloError, OSError, HTTPException, PoolTimeout)):
+            _logger.warning("Export of %s failed: %s", job.key, error)
+            result = ExportResult(job.key, job.path, error=error, elapsed=elapsed)
+        else:
+            job.future.set_exception(error)
+            return
+        try:
+            if self.progress is not None:
+                self.progress(result)
+        except Exception as e:
+            job.future.set_exception(e)
+        else:
+            job.future.set_result(result)
+
+    def _submit_all(self, jobs, force):
+        """
+        @param jobs: list of (app, key, path, stamp, final, make_report)
+        @return: list of ExportResult, in the same order
+        """
+        results = [None] * len(jobs)
+        pending = []
+        for i, args in enumerate(jobs):
+            job = _Job(*args)
+            if not force and self._unchanged(job.key, job.path, job.stamp):
+                results[i] = ExportResult(job.key, job.path, skipped=True)
+                if self.progress is not None:
+                    self.progress(results[i])
+                continue
+            pending.append((i, job))
+        with self._queue_lock:
+            touched = []
+            for i, job in pending:
+                q = self._reactor_queue(job.app)
+                q.to_generate.append(job)
+                if q not in touched:
+                    touched.append(q)
+            for q in touched:
+                self._pump(q)
+        for i, job in pending:
+            results[i] = job.future.result()
+        return results
+
+    # ----- public -----
+
+    def _batch_jobs(self, app, batch_ids, type):
+        catalog = app.batch_catalog()
+        jobs = []
+        for b in batch_ids:
+            batch = catalog[b]
+            key = "%s/batch/%s/%d" % (app.ipv4, type, batch.id)
+            path = os.path.join(self.folder, _safe_name("%s %d %s %s.csv" % (
+                                app.ipv4, batch.id, batch.name, type)))
+            make_report = (lambda id=batch.id: app.getReport('byBatch', type, id))
+            jobs.append((app, key, path, list(batch.astuple()), not batch.running, make_report))
+        return jobs
+
+    def export_batches(self, app, batch_ids, type='process_data', force=False):
+        """ Export one report per batch.
+
+        Jobs for the same app run on several pool threads at once, so
+        `app` must be a hello3.HelloApp, which is safe to share.
+
+        @param app: hello3.HelloApp
+        @param batch_ids: batch IDs (or names)
+        @param type: report type, see HelloApp.getReport
+        @param force: export even if an unchanged copy is on disk
+        @rtype: list[ExportResult]
+        """
+        return self._submit_all(self._batch_jobs(app, batch_ids, type), force)
+
+    def export_dates(self, app, ranges, type='process_data', force=False):
+        """ Export one report per date range.
+
+        @param app: hello3.HelloApp
+        @param ranges: iterable of (start, end) datetimes
+        @param type: report type, see HelloApp.getReport
+        @param force: export even if an unchanged copy is on disk
+        @rtype: list[ExportResult]
+        """
+        now = time()
+        jobs = []
+        for d1, d2 in ranges:
+            s1 = int(d1.timestamp())
+            s2 = int(d2.timestamp())
+            key = "%s/date/%s/%d-%d" % (app.ipv4, type, s1, s2)
+            path = os.path.join(self.folder, _safe_name("%s %s to %s %s.csv" % (
+                                app.ipv4, d1.strftime("%Y%m%d %H%M%S"), d2.strftime("%Y%m%d %H%M%S"), type)))
+            final = s2 < now
+            make_report = (lambda s1=s1, s2=s2: app.getReport('byDate', type, s1, s2))
+            jobs.append((app, key, path, [s1, s2], final, make_report))
+        return self._submit_all(jobs, force)
+
+    def export_many(self, work, type='process_data', force=False):
+        """ Batches from several reactors in one go, each reactor
+        with its own concurrency limits.
+
+        @param work: {app: batch_ids}
+        @return: {app: list of ExportResult}
+        """
+        # Each reactor's jobs wait in its own queue and only go to the
+        # pool when that reactor has a free slot, so one reactor's
+        # backlog can't tie up the workers another reactor could use.
+        jobs = []
+        counts = []
+        for app, ids in work.items():
+            app_jobs = self._batch_jobs(app, ids, type)
+            jobs.extend(app_jobs)
+            counts.append((app, len(app_jobs)))
+        results = self._submit_all(jobs, force)
+        out = {}
+        i = 0
+        for app, n in counts:
+            out[app] = results[i:i + n]
+            i += n
+        return out
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,122 @@
+"""
+Per-call timeouts learned from recent latency.
+
+One timeout for every call is either too long to notice a hung
+getMainValues quickly, or too short for getReport. With a policy
+installed, each call's timeout is a multiple of its recent p99
+latency on that reactor, clamped to a sane range:
+
+    app.timeouts = TimeoutPolicy()           # per app
+    HelloApp.timeouts = TimeoutPolicy()      # or for every app
+
+Calls in `overrides` always use the given timeout. Until a call has
+`min_samples` successful replies, it uses the app's own timeout.
+
+A call that times out forgets what it learned and goes back to the
+app's timeout, so a reactor that got slower for real isn't stuck
+failing at a timeout learned when it was fast.
+"""
+from collections import deque
+import math
+import threading
+
+__author__ = 'Nathan Starkweather'
+
+
+class _Window():
+    __slots__ = ('samples', 'since', 'timeout')
+
+    def __init__(self, size):
+        self.samples = deque(maxlen=size)
+        self.since = 0       # samples since timeout was calculated
+        self.timeout = None  # learned timeout, None until enough samples
+
+
+class TimeoutPolicy():
+    """
+    @param quantile: latency quantile to scale from
+    @param factor: timeout = quantile latency * factor
+    @param min_timeout: never go below this (seconds)
+    @param max_timeout: never go above this. None for the app's own timeout.
+    @param window: number of recent samples kept per (call, reactor)
+    @param min_samples: samples needed before the learned timeout is used
+    @param overrides: {call name: seconds} for calls with a fixed timeout,
+                      on top of default_overrides
+    """
+
+    # known slow calls. getReport blocks while the server generates the
+    # report (the call itself asks the server for up to 120s); getfile
+    # times out per read, not for the whole download.
+    default_overrides = {
+        'getReport': 180,
+        'getfile': 60,
+    }
+
+    def __init__(self, quantile=0.99, factor=3.0, min_timeout=0.5, max_timeout=None,
+                 window=200, min_samples=30, overrides=None):
+        self.quantile = quantile
+        self.factor = factor
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.window = window
+        self.min_samples = min_samples
+        self.overrides = dict(self.default_overrides)
+        self.overrides.update(overrides or {})
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def _learn(self, w):
+        s = sorted(w.samples)
+        q = s[min(len(s) - 1, int(math.ceil(self.quantile * len(s))) - 1)]
+        w.timeout = max(q * self.factor, self.min_timeout)
+        w.since = 0
+
+    def timeout_for(self, call, reactor, default):
+        """
+        @param default: the app's own timeout (None for no timeout)
+        @return: timeout to use for this call, in seconds
+        """
+        override = self.overrides.get(call)
+        if override is not None:
+            return override
+        w = self._windows.get((call, reactor))
+        learned = w.timeout if w is not None else None
+        if learned is None:
+            return default
+        cap = self.max_timeout if self.max_timeout is not None else default
+        if cap is not None and learned > cap:
+            return cap
+        return learned
+
+    def observe(self, call, reactor, seconds):
+        """ Record the latency of a successful call. """
+        if call in self.overrides:
+            return
+        key = (call, reactor)
+        with self._lock:
+            w = self._windows.get(key)
+            if w is None:
+                w = self._windows[key] = _Window(self.window)
+            w.samples.append(seconds)
+            w.since += 1
+            n = len(w.samples)
+            # recalculating on every sample would mean sorting the
+            # window on every call; every 10% of the window is plenty
+            if n >= self.min_samples and (w.timeout is None or w.since >= self.window // 10):
+                self._learn(w)
+
+    def observe_timeout(self, call, reactor):
+        """ A call timed out: start learning it over. """
+        with self._lock:
+            self._windows.pop((call, reactor), None)
+
+    def reset(self):
+        with self._lock:
+            self._windows.clear()
+
+    def stats(self):
+        """
+        @return: {(call, reactor): (learned timeout or None, samples)}
+        """
+        with self._lock:
+            return {k: (w.timeout, len(w.samples)) for k, w in self._windows.items()}
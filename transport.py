@@ -0,0 +1,437 @@
+"""
+Connection handling shared by the hello (2.x) and hello3 clients.
+
+Transport is a drop-in for the old per-app connection objects
+(hello.LVWSHTTPConnection, hello3.HTTPSSession): it has the same
+do_request/connect/close/timeout interface, but underneath keeps
+a pool of keep-alive http.client connections, retries requests
+that failed before reaching the server (and reads that failed after)
+with jittered exponential backoff, and opens its first
+connection in the background so that constructing an app doesn't
+block on an unreachable reactor.
+"""
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from collections import deque
+from io import BytesIO
+from time import monotonic, sleep
+import logging
+import os
+import random
+import select
+import socket
+import ssl
+import threading
+
+__author__ = 'Nathan Starkweather'
+
+_logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    """ Every pooled connection stayed busy for the whole timeout.
+
+    Nothing was sent and the reactor isn't at fault (this process just
+    has too many requests going at once), so this isn't an OSError:
+    it isn't retried, and circuit breakers don't count it as the
+    reactor failing.
+    """
+
+
+class Response():
+    """ http response with the parts of requests.Response that
+    the hello clients use.
+
+    Regular responses are read in full before being handed back
+    (.content, .read()). Streamed responses leave the body on the
+    wire for iter_content(), and must be close()d.
+    """
+    def __init__(self, status, reason, headers, content=None, raw=None, release=None):
+        self.status_code = self.status = status
+        self.reason = reason
+        self.headers = headers
+        self._content = content
+        self._raw = raw
+        self._release = release
+        # how many times the transport had to retry the request
+        self.retries = 0
+        if content is not None:
+            self.read = BytesIO(content).read
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = b"".join(self.iter_content(65536))
+            self.read = BytesIO(self._content).read
+        return self._content
+
+    def iter_content(self, chunk_size=65536):
+        if self._raw is None:
+            if self._content:
+                yield self._content
+            return
+        while True:
+            chunk = self._raw.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+        self.close()
+
+    def close(self):
+        raw = self._raw
+        if raw is None:
+            return
+        self._raw = None
+        # only a fully read response leaves the connection reusable
+        self._release(raw.isclosed() and not raw.will_close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __repr__(self):
+        return "<%s [%d]>" % (self.__class__.__name__, self.status_code)
+
+
+def _is_stale(conn):
+    """ Probe an idle keep-alive connection without blocking.
+
+    An idle connection has no business being readable. If it is,
+    the server has either closed it (EOF) or sent something we
+    didn't ask for, and either way it can't be reused. TLS sockets
+    can be readable just from post-handshake records (session
+    tickets), so those get a non-blocking read to tell the cases
+    apart.
+    """
+    sock = conn.sock
+    if sock is None:
+        return True
+    try:
+        readable = select.select([sock], [], [], 0)[0]
+    except (OSError, ValueError):
+        return True
+    if not readable:
+        return False
+    sock.setblocking(False)
+    try:
+        sock.recv(1)
+    except (ssl.SSLWantReadError, BlockingIOError):
+        return False
+    except OSError:
+        return True
+    finally:
+        try:
+            sock.settimeout(conn.timeout)
+        except OSError:
+            pass
+    return True
+
+
+class Transport():
+    """ Pool of keep-alive HTTP(S) connections to one server.
+
+    @param host: host to connect to
+    @param port: port, or None for the scheme default
+    @param timeout: socket timeout (seconds) for connect and reads
+    @param use_ssl: https (certificate checks off, the reactors are
+                    self-signed) or plain http
+    @param pool_size: maximum number of connections, idle or in use.
+                      Callers beyond that wait for a free connection,
+                      for up to `timeout`, then get PoolTimeout.
+    @param retries: how many times to retry a request that failed with
+                    a connection error. None retries forever. Requests
+                    are only retried if they failed before being sent,
+                    or if the caller marks them idempotent. See
+                    do_request.
+    @param backoff: base delay (seconds) between retries. Attempt n waits
+                    a random time between backoff*2**(n-1)/2 and
+                    backoff*2**(n-1), capped at backoff_max.
+    @param backoff_max: longest delay between retries
+    @param idle_timeout: idle connections older than this are closed
+                         instead of reused
+    @param background: open the first connection on a background thread
+                       when connect() is called, instead of on first use
+    """
+    def __init__(self, host, port=None, timeout=5, use_ssl=True, pool_size=4, retries=3,
+                 backoff=0.1, backoff_max=5, idle_timeout=30, background=True):
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.idle_timeout = idle_timeout
+        self.background = background
+        self._timeout = timeout
+
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._idle = deque()  # (conn, last used)
+        self._generation = 0
+        self._warming = None
+
+        self.connects = 0
+        self.reused = 0
+        self.stale = 0
+        self.retried = 0
+
+    # ----- connection pool -----
+
+    @property
+    def timeout(self):
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, timeout):
+        self._timeout = timeout
+        with self._lock:
+            for conn, _ in self._idle:
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+
+    def _new_conn(self):
+        if self.use_ssl:
+            conn = HTTPSConnection(self.host, self.port, timeout=self._timeout,
+                                   context=ssl._create_unverified_context())
+        else:
+            conn = HTTPConnection(self.host, self.port, timeout=self._timeout)
+        conn.connect()
+        # let the OS notice a reactor that dropped off the network
+        # while the connection sat idle
+        conn.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.connects += 1
+        return conn
+
+    def _check_fork(self):
+        """ A forked child inherits the parent's pooled sockets, and
+        possibly its locks in a held state. Both belong to the parent,
+        so the child starts over with an empty pool. The inherited
+        connections are dropped, not closed: closing would only close
+        the child's copies anyway, but there's no point poking at them.
+        """
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.pool_size)
+        self._idle = deque()
+        self._warming = None
+
+    def _checkout(self):
+        """
+        @return: (connection, generation, reused)
+        @raise PoolTimeout: if no connection came free within the timeout
+        """
+        self._check_fork()
+        if not self._slots.acquire(timeout=self._timeout):
+            raise PoolTimeout("No free connection to %s within %ss" % (self.host, self._timeout))
+        try:
+            now = monotonic()
+            while True:
+                with self._lock:
+                    gen = self._generation
+                    if not self._idle:
+                        break
+                    conn, last = self._idle.pop()
+                if now - last > self.idle_timeout or _is_stale(conn):
+                    self.stale += 1
+                    conn.close()
+                    continue
+                self.reused += 1
+                return conn, gen, True
+            return self._new_conn(), gen, False
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _checkin(self, conn, gen, reusable):
+        try:
+            with self._lock:
+                if reusable and gen == self._generation and conn.sock is not None:
+                    if conn.timeout != self._timeout:
+                        conn.timeout = self._timeout
+                        conn.sock.settimeout(self._timeout)
+                    self._idle.append((conn, monotonic()))
+                    return
+            conn.close()
+        finally:
+            self._slots.release()
+
+    def connect(self):
+        """ Start opening a connection, without waiting for it unless
+        this transport isn't in background mode. Failure to connect
+        here isn't an error: the next request will try again (and
+        raise if it can't).
+        """
+        self._check_fork()
+        if not self.background:
+            self._warm()
+            return
+        with self._lock:
+            if self._warming is not None and self._warming.is_alive():
+                return
+            self._warming = threading.Thread(target=self._warm, daemon=True,
+                                             name="Transport connect %s" % self.host)
+            self._warming.start()
+
+    def _warm(self):
+        if not self._slots.acquire(blocking=False):
+            return
+        with self._lock:
+            gen = self._generation
+            idle = bool(self._idle)
+        if idle:
+            self._slots.release()
+            return
+        try:
+            conn = self._new_conn()
+        except (OSError, HTTPException) as e:
+            self._slots.release()
+            _logger.debug("Background connect to %s failed: %s", self.host, e)
+            return
+        self._checkin(conn, gen, True)
+
+    def close(self):
+        """ Close idle connections. Connections in use are closed
+        when they're handed back. """
+        with self._lock:
+            self._generation += 1
+            idle = list(self._idle)
+            self._idle.clear()
+        for conn, _ in idle:
+            conn.close()
+
+    def _settings(self):
+        return (self.host, self.port, self._timeout, self.use_ssl, self.pool_size, self.retries,
+                self.backoff, self.backoff_max, self.idle_timeout, self.background)
+
+    def clone(self):
+        """ New, empty pool with the same settings. """
+        return self.__class__(*self._settings())
+
+    def __reduce__(self):
+        # unpickles as an empty pool, which connects on first use
+        return self.__class__, self._settings()
+
+    def stats(self):
+        return {
+            'connects': self.connects,
+            'reused': self.reused,
+            'stale': self.stale,
+            'retried': self.retried,
+            'idle': len(self._idle),
+        }
+
+    # ----- requests -----
+
+    def _backoff(self, attempt, meth, url, err):
+        """ Sleep before retry number `attempt`.
+        @return: False if we're out of retries
+        """
+        if self.retries is not None and attempt > self.retries:
+            return False
+        self.retried += 1
+        delay = min(self.backoff * 2 ** (attempt - 1), self.backoff_max)
+        delay = random.uniform(delay / 2, delay)
+        _logger.debug("%s %s failed (%s), retry %d in %.2fs", meth, url, err, attempt, delay)
+        sleep(delay)
+        return True
+
+    def _request(self, meth, url, body, headers, stream, timeout, idempotent):
+        attempt = 0
+        while True:
+            try:
+                conn, gen, reused = self._checkout()
+            except (OSError, HTTPException) as e:
+                # couldn't connect, so nothing was sent
+                attempt += 1
+                if not self._backoff(attempt, meth, url, e):
+                    e.retries = attempt - 1
+                    raise
+                continue
+            sent = False
+            try:
+                if timeout is not None and timeout != conn.timeout:
+                    # just for this request, _checkin puts it back
+                    conn.timeout = timeout
+                    conn.sock.settimeout(timeout)
+                conn.request(meth, url, body, headers or {})
+                sent = True
+                raw = conn.getresponse()
+                if stream:
+                    def release(reusable, conn=conn, gen=gen):
+                        self._checkin(conn, gen, reusable)
+                    rsp = Response(raw.status, raw.reason, raw.headers, raw=raw, release=release)
+                    rsp.retries = attempt
+                    return rsp
+                content = raw.read()
+            except (OSError, HTTPException) as e:
+                conn.close()
+                self._checkin(conn, gen, False)
+                if not sent:
+                    # The request never made it out whole, so the
+                    # server can't have acted on it.
+                    if reused:
+                        # Most likely the server dropped an idle
+                        # keep-alive connection, and the rest of the
+                        # idle ones with it. Go again right away on a
+                        # fresh connection; that doesn't count
+                        # against the retry limit.
+                        self.close()
+                        continue
+                    attempt += 1
+                    if not self._backoff(attempt, meth, url, e):
+                        e.retries = attempt - 1
+                        raise
+                    continue
+                # The server may have got the request and acted on it.
+                # Only go again if the caller says that's harmless, and
+                # never after a timeout: a reactor that doesn't answer
+                # in time won't answer the retry either, and the caller
+                # would wait several timeouts to find that out.
+                attempt += 1
+                if not idempotent or isinstance(e, socket.timeout) or \
+                        not self._backoff(attempt, meth, url, e):
+                    e.retries = attempt - 1
+                    raise
+                continue
+            except BaseException:
+                conn.close()
+                self._checkin(conn, gen, False)
+                raise
+            self._checkin(conn, gen, not raw.will_close)
+            rsp = Response(raw.status, raw.reason, raw.headers, content)
+            rsp.retries = attempt
+            return rsp
+
+    def do_request(self, meth, url, body=None, headers=None, timeout=None, idempotent=False):
+        """
+        @param timeout: read timeout for this request only, instead of
+                        self.timeout. Connecting uses self.timeout.
+        @param idempotent: the request is safe to send twice. Requests
+                           that fail before they're sent are always
+                           retried. Ones that fail after are only
+                           retried if this is set, and not after a
+                           timeout.
+        @return: fully read response
+        @rtype: Response
+        """
+        return self._request(meth, url, body, headers, False, timeout, idempotent)
+
+    def do_stream_request(self, meth, url, headers=None, timeout=None, idempotent=False):
+        """ Like do_request, but the body is left unread so that the
+        caller can consume it with rsp.iter_content(). The caller
+        must close the response.
+        """
+        return self._request(meth, url, None, headers, True, timeout, idempotent)
+
+    def __repr__(self):
+        return "%s(%r, %r, use_ssl=%r)" % (self.__class__.__name__, self.host, self.port, self.use_ssl)
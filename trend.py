@@ -0,0 +1,25 @@
+"""
+getTrendData replies as numpy arrays.
+
+Used by HelloApp.getTrendData(span, group, as_arrays=True), after the
+reply has been decoded and checked like any other json reply. numpy is
+only imported when this module is.
+
+Every array member of the reply becomes a float64 numpy array under the
+same name, json nulls becoming NaN. Nothing else about the reply is
+assumed: the time column comes back as the server sent it, and scalar
+members (if any) are left out.
+"""
+import numpy as np
+
+__author__ = 'Nathan Starkweather'
+
+
+def trend_arrays(reply):
+    """
+    @param reply: decoded getTrendData reply
+    @type reply: dict
+    @return: {member name: float64 array} for each array in the reply
+    @rtype: dict[str, numpy.ndarray]
+    """
+    return {k: np.asarray(v, dtype=np.float64) for k, v in reply.items() if isinstance(v, list)}